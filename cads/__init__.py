@@ -110,6 +110,10 @@ def create_app(config=CONFIG):
             from sqlalchemy import event
             event.listen(db.engine, 'connect', _pragma_on_connect)
 
+    # add columns introduced after the database was created
+    with app.app_context():
+        database.migrate_db()
+
     # say hello
     @app.get('/hello')
     @app.doc(tags=['Easter Eggs'])
@@ -129,7 +133,8 @@ def create_app(config=CONFIG):
         return redirect(request.base_url + "docs")
 
     # register blueprints
-    from . import collocation, corpus, keyword, query, semantic_map, ufa, users
+    from . import (collocation, corpus, jobs, keyword, query, semantic_map, ufa,
+                   users)
 
     app.register_blueprint(users.bp)
     app.register_blueprint(corpus.bp)
@@ -138,6 +143,11 @@ def create_app(config=CONFIG):
     app.register_blueprint(semantic_map.bp)
     app.register_blueprint(keyword.bp)
     app.register_blueprint(ufa.bp)
+    app.register_blueprint(jobs.bp)
+    jobs.init_jobs(app)
+
+    from .concordance import page_cache
+    page_cache.resize(app.config.get('CONCORDANCE_CACHE_BYTES', page_cache.max_bytes))
 
     from . import mmda
     app.register_blueprint(mmda.bp)
@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""ASGI deployment of the (synchronous) app, e.g.
+
+    uvicorn --factory cads.asgi:create_asgi_app
+
+the event loop only accepts connections and passes data; requests are
+processed in three thread pools:
+
+- heavy requests (endpoints processed with @asynchronous, see jobs, and
+  ASGI_HEAVY_ENDPOINTS) run in their own executor, at most
+  ASGI_HEAVY_WORKERS at a time; further ones wait for at most
+  ASGI_QUEUE_TIMEOUT seconds (then 503)
+- long-lived streams (progress events, ASGI_STREAM_ENDPOINTS) hold a
+  thread of their own pool (ASGI_STREAM_WORKERS) while they are open
+- all other requests (listings, item pages, cached maps) are served by
+  ASGI_WORKERS threads and never wait for heavy ones or streams
+
+responses stop (and their iterables are closed, which e.g. cancels jobs
+of progress events) as soon as the client disconnects.
+
+heavy requests mostly wait for CQP processes or for numpy / pandas code
+that releases the GIL, so one process serves many clients without
+having to provision a worker process (and its memory) per request.
+
+"""
+
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from io import BytesIO
+from urllib.parse import parse_qs
+
+from werkzeug.exceptions import HTTPException
+
+from . import CONFIG, create_app
+
+
+def wsgi_environ(scope, body):
+    """WSGI environment of ASGI HTTP request
+
+    """
+
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name == 'content-length':
+            continue
+        key = 'CONTENT_TYPE' if name == 'content-type' else 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+
+    return environ
+
+
+class ASGIApp:
+    """serve WSGI app from thread pools for heavy and other requests (see module docstring)
+
+    """
+
+    def __init__(self, app):
+
+        self.app = app
+        self.heavy_endpoints = set(app.config.get('ASGI_HEAVY_ENDPOINTS', []))
+        self.stream_endpoints = set(app.config.get('ASGI_STREAM_ENDPOINTS', ['job.get_job_events', 'job.get_request_events']))
+        self.heavy_workers = app.config.get('ASGI_HEAVY_WORKERS', 4)
+        self.queue_timeout = app.config.get('ASGI_QUEUE_TIMEOUT', 60)
+        self.executor = ThreadPoolExecutor(app.config.get('ASGI_WORKERS', 16), thread_name_prefix='asgi')
+        self.heavy_executor = ThreadPoolExecutor(self.heavy_workers, thread_name_prefix='asgi-heavy')
+        self.stream_executor = ThreadPoolExecutor(app.config.get('ASGI_STREAM_WORKERS', 64), thread_name_prefix='asgi-stream')
+        self._limit = None
+
+    @property
+    def limit(self):
+        # semaphores belong to the event loop of the server
+        if self._limit is None:
+            self._limit = asyncio.Semaphore(self.heavy_workers)
+        return self._limit
+
+    def endpoint(self, environ):
+
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return None
+
+        return endpoint
+
+    def is_stream(self, environ):
+        """does request open a long-lived stream (e.g. progress events)?
+
+        """
+
+        return self.endpoint(environ) in self.stream_endpoints
+
+    def is_heavy(self, environ):
+        """is request processed synchronously by a heavy endpoint?
+
+        """
+
+        endpoint = self.endpoint(environ)
+        if endpoint is None:
+            return False
+
+        if endpoint in self.heavy_endpoints:
+            return True
+
+        # background jobs are only queued
+        view = self.app.view_functions.get(endpoint)
+        run_async = parse_qs(environ['QUERY_STRING']).get('async', ['false'])[-1].lower() in ['1', 't', 'true', 'y', 'yes', 'on']
+        return getattr(view, 'asynchronous', False) and not run_async
+
+    async def __call__(self, scope, receive, send):
+
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise NotImplementedError(f"ASGI scope type '{scope['type']}' is not supported")
+
+        # request body
+        body = BytesIO()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.write(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+
+        environ = wsgi_environ(scope, body.getvalue())
+        loop = asyncio.get_running_loop()
+        disconnected = Event()
+        watch = asyncio.create_task(self.watch(receive, disconnected))
+        try:
+            if self.is_stream(environ):
+                return await loop.run_in_executor(self.stream_executor, self.run, environ, send, loop, disconnected)
+            if not self.is_heavy(environ):
+                return await loop.run_in_executor(self.executor, self.run, environ, send, loop, disconnected)
+
+            try:
+                await asyncio.wait_for(self.limit.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.app.logger.warning(f"ASGIApp :: too many heavy requests, rejecting {environ['PATH_INFO']}")
+                return await self.unavailable(send)
+            try:
+                if disconnected.is_set():
+                    return
+                return await loop.run_in_executor(self.heavy_executor, self.run, environ, send, loop, disconnected)
+            finally:
+                self.limit.release()
+        finally:
+            watch.cancel()
+
+    async def watch(self, receive, disconnected):
+        """listen for client disconnect while request is processed
+
+        """
+
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+
+    def run(self, environ, send, loop, disconnected):
+        """process request in executor thread; response is sent (and streamed) by the event loop
+
+        stops after the next chunk if the client has disconnected
+        """
+
+        def sync_send(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response = dict()
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+        iterable = self.app(environ, start_response)
+        try:
+            started = False
+            for chunk in iterable:
+                if disconnected.is_set():
+                    self.app.logger.debug(f"ASGIApp :: client disconnected, closing {environ['PATH_INFO']}")
+                    return
+                if not started:
+                    sync_send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+                    started = True
+                if chunk:
+                    sync_send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not started:
+                sync_send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+            sync_send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            # e.g. cancels jobs of progress events on disconnect
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    async def unavailable(self, send):
+
+        await send({'type': 'http.response.start', 'status': 503, 'headers': [
+            (b'content-type', b'application/json'), (b'retry-after', str(self.queue_timeout).encode())
+        ]})
+        await send({'type': 'http.response.body', 'body': (
+            b'{"error": "Service Unavailable", "message": "too many concurrent requests, try again later"}'
+        )})
+
+    async def lifespan(self, receive, send):
+
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                self.heavy_executor.shutdown(wait=False)
+                self.stream_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def create_asgi_app(config=CONFIG):
+
+    return ASGIApp(create_app(config))
@@ -1,24 +1,89 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+from contextlib import ExitStack
+from time import monotonic
+
 from apiflask import APIBlueprint, Schema
 from apiflask.fields import Boolean, Float, Integer, Nested, String
 from apiflask.validators import OneOf
 from association_measures import measures
+from ccc.collocates import dump2cooc
 from flask import current_app
-from pandas import DataFrame, read_sql, to_numeric
+from numpy import flatnonzero, int64, maximum, minimum, sort, unique, where
+from numpy.random import default_rng
+from pandas import DataFrame, Index, concat, read_sql, to_numeric
+from scipy.stats import chi2
 from sqlalchemy import select
 
 from . import db
+from .cwb import BlockCache, corpus_streams, count_ids
 from .database import (Collocation, CollocationItem, CollocationItemScore,
-                       CotextLines)
+                       CotextLines, SubCorpus, single_flight)
+from .jobs import JobOut, cancellable, checkpoint, report
+from .pagination import clear_count_cache, paginate_keyset
 from .semantic_map import (CoordinatesOut, SemanticMapOut, ccc_semmap_init,
-                           ccc_semmap_update)
+                           ccc_semmap_update, get_item_coordinates)
 from .users import auth
+from .ufa import forget_ranked_lists
 from .utils import AMS_DICT, AMS_CUTOFF
 
 bp = APIBlueprint('collocation', __name__, url_prefix='/collocation')
 
+# frequencies of all lexicon ids in subcorpora (see get_marginals)
+_marginals = BlockCache(8)
+
+
+def get_marginals(corpus, p):
+    """frequencies of all lexicon ids of p-attribute in corpus or subcorpus (database objects)
+    - corpus: lexicon frequencies; subcorpus: counted in its spans in parallel threads (COUNT_WORKERS)
+    - raises FileNotFoundError / OSError if the data files of the corpus cannot be read
+
+    returns token stream and array of frequencies
+    """
+
+    cwb_id = corpus.corpus.cwb_id if isinstance(corpus, SubCorpus) else corpus.cwb_id
+    stream = corpus_streams(cwb_id, current_app.config['CCC_REGISTRY_DIR']).p(p)
+    if not isinstance(corpus, SubCorpus):
+        return stream, stream.frequencies()
+
+    marginals = _marginals.get((cwb_id, p, corpus.id))
+    if marginals is None:
+        current_app.logger.debug(f'get_marginals :: counting {p} in subcorpus {corpus.id}')
+        spans = DataFrame([vars(s) for s in corpus.spans], columns=['match', 'matchend'])
+        marginals = count_ids(stream, match=spans['match'].values, matchend=spans['matchend'].values,
+                              workers=current_app.config.get('COUNT_WORKERS', 1))
+        _marginals.put((cwb_id, p, corpus.id), marginals)
+
+    return stream, marginals
+
+
+def freq_frame(stream, freq, ids=None):
+    """frequencies (array of all lexicon ids) as DataFrame (index: item; column: freq) of ids (default: all that occur)
+
+    """
+
+    ids = flatnonzero(freq) if ids is None else ids
+    return DataFrame({'freq': freq[ids]}, index=Index(stream.lexicon.decode(ids), name='item'))
+
+
+def count_items(corpus, cpos, p):
+    """frequencies of items of p-attribute at corpus positions (f), in corpus or subcorpus (f2), and its size (N)
+    - counted in shards on the token stream in parallel threads (COUNT_WORKERS, see cwb.count_ids)
+
+    returns DataFrame (index: item; columns: f, f2, N)
+    """
+
+    stream, marginals = get_marginals(corpus, p)
+    f = count_ids(stream, cpos=cpos, workers=current_app.config.get('COUNT_WORKERS', 1))
+    ids = flatnonzero(f)
+
+    counts = freq_frame(stream, f, ids).rename(columns={'freq': 'f'})
+    counts['f2'] = marginals[ids]
+    counts['N'] = int(marginals.sum())
+
+    return counts
+
 
 def get_filtered_cotext(focus_query, window, s_break, remove_focus_cpos=True):
     """retrieve cotext of focus query, removing duplicates and focus cpos if needed.
@@ -63,62 +128,355 @@ def put_counts(collocation, remove_focus_cpos=True, include_negative=False, reco
     returns True except if cotext is empty (then False)
     """
 
-    current_app.logger.debug("put_counts :: getting counts")
-    old = CollocationItem.query.filter_by(collocation_id=collocation.id)
-    if old.first():
-        current_app.logger.debug("put_counts :: counts already exist")
-        if recount:
-            current_app.logger.debug("put_counts :: deleting counts")
-            CollocationItem.query.filter_by(collocation_id=collocation.id).delete()
-            db.session.commit()
-            current_app.logger.debug("deleted")
+    # scores are saved after counts: concurrent requests wait until both are complete
+    with single_flight('collocation_items', collocation.id):
+
+        current_app.logger.debug("put_counts :: getting counts")
+        old = CollocationItem.query.filter_by(collocation_id=collocation.id)
+        if old.first():
+            current_app.logger.debug("put_counts :: counts already exist")
+            if recount:
+                current_app.logger.debug("put_counts :: deleting counts")
+                CollocationItem.query.filter_by(collocation_id=collocation.id).delete()
+                db.session.commit()
+                current_app.logger.debug("deleted")
+            else:
+                return True
+
+        # parse parameters
+        focus_query = collocation._query
+        window = collocation.window
+        s_break = collocation.s_break
+
+        # create and return
+        current_app.logger.debug(f'put_counts :: getting context of query {focus_query.id}')
+        report(stage='cotext')
+        df_cooc = get_filtered_cotext(focus_query, window, s_break, remove_focus_cpos)
+        if df_cooc is None:
+            return False
+
+        current_app.logger.debug(f'put_counts :: counting items in context for window {window}')
+        report(stage='counting', done=0, total=len(df_cooc))
+        if focus_query.subcorpus and collocation.marginals == 'local':
+            corpus = collocation._query.subcorpus
         else:
-            return True
-
-    # parse parameters
-    focus_query = collocation._query
-    window = collocation.window
-    s_break = collocation.s_break
-
-    # create and return
-    current_app.logger.debug(f'put_counts :: getting context of query {focus_query.id}')
-    df_cooc = get_filtered_cotext(focus_query, window, s_break, remove_focus_cpos)
-    if df_cooc is None:
-        return False
-
-    current_app.logger.debug(f'put_counts :: counting items in context for window {window}')
-    if focus_query.subcorpus and collocation.marginals == 'local':
-        corpus = collocation._query.subcorpus.ccc()
-    else:
-        corpus = collocation._query.corpus.ccc()
-    # create context counts of items for window
-    f = corpus.counts.cpos(df_cooc['cpos'], [collocation.p])[['freq']].rename(columns={'freq': 'f'})
-    # add marginals
-    f2 = corpus.marginals(f.index, [collocation.p])[['freq']].rename(columns={'freq': 'f2'})
-    counts = f.join(f2)
-    counts['f2'] = to_numeric(counts['f2'].fillna(0), downcast='integer')
-    counts['f1'] = len(df_cooc)
-    counts['N'] = corpus.size()
+            corpus = collocation._query.corpus
+        try:
+            counts = count_items(corpus, df_cooc['cpos'].values, collocation.p)
+        except (FileNotFoundError, OSError) as e:
+            current_app.logger.warning(f"put_counts :: cannot read token stream ({e}), counting with cwb-ccc")
+            corpus = corpus.ccc()
+            # create context counts of items for window
+            f = corpus.counts.cpos(df_cooc['cpos'], [collocation.p])[['freq']].rename(columns={'freq': 'f'})
+            # add marginals
+            f2 = corpus.marginals(f.index, [collocation.p])[['freq']].rename(columns={'freq': 'f2'})
+            counts = f.join(f2)
+            counts['N'] = corpus.size()
+        counts['f2'] = to_numeric(counts['f2'].fillna(0), downcast='integer')
+        counts['f1'] = len(df_cooc)
+
+        checkpoint()
+        current_app.logger.debug(f'put_counts :: saving {len(counts)} items to database')
+        counts['collocation_id'] = collocation.id
+        counts.reset_index().to_sql('collocation_item', con=db.engine, if_exists='append', index=False)
+        db.session.commit()
+
+        # counts without scores are removed (cancellation, errors)
+        try:
+            current_app.logger.debug('put_counts :: adding scores')
+            report(stage='scoring')
+            collocation.sample_factor = focus_query.sample_factor if focus_query.sampled else None
+            db.session.commit()
+            counts = DataFrame([vars(s) for s in collocation.items], columns=['id', 'f', 'f1', 'f2', 'N']).set_index('id')
+            scores = score_counts(counts, include_negative, collocation.sample_factor)
+            scores['collocation_id'] = collocation.id
 
-    current_app.logger.debug(f'put_counts :: saving {len(counts)} items to database')
-    counts['collocation_id'] = collocation.id
-    counts.reset_index().to_sql('collocation_item', con=db.engine, if_exists='append', index=False)
+            current_app.logger.debug('put_counts :: saving scores')
+            scores.to_sql('collocation_item_score', con=db.engine, if_exists='append', index=False)
+            db.session.commit()
+        except Exception:
+            delete_counts([collocation.id])
+            raise
+        forget_ranked_lists('collocation', [collocation.id])
+        clear_count_cache()
+
+    return True
+
+
+def delete_counts(collocation_ids):
+
+    current_app.logger.debug(f'delete_counts :: removing counts of collocation analyses {collocation_ids}')
+    db.session.rollback()
+    CollocationItemScore.query.filter(CollocationItemScore.collocation_id.in_(collocation_ids)).delete()
+    CollocationItem.query.filter(CollocationItem.collocation_id.in_(collocation_ids)).delete()
     db.session.commit()
+    forget_ranked_lists('collocation', collocation_ids)
+    clear_count_cache()
+
+
+def score_counts(counts, include_negative=False, sample_factor=None):
+    """association scores of CollocationItems (index: id; columns: f, f1, f2, N) in long format
+
+    counts on sampled matches are scaled by sample_factor (estimated counts on all matches)
+    """
+
+    if sample_factor is not None:
+        counts = counts.assign(
+            f=(counts['f'] * sample_factor).clip(upper=counts['f2']),
+            f1=(counts['f1'] * sample_factor).clip(upper=counts['N'])
+        )
 
-    current_app.logger.debug('put_counts :: adding scores')
-    counts = DataFrame([vars(s) for s in collocation.items], columns=['id', 'f', 'f1', 'f2', 'N']).set_index('id')
     scores = measures.score(counts, freq=True, digits=6, boundary='poisson', vocab=len(counts)).reset_index()
     if not include_negative:
         scores = scores.loc[scores.E11 <= scores.O11]
     scores = scores.drop(['O12', 'O21', 'O22', 'E12', 'E21', 'E22', 'R1', 'R2', 'C1', 'C2', 'N'], axis=1)
     scores = scores.melt(id_vars=['id'], var_name='measure', value_name='score').rename({'id': 'collocation_item_id'}, axis=1)
-    scores['collocation_id'] = collocation.id
 
-    current_app.logger.debug('put_counts :: saving scores')
-    scores.to_sql('collocation_item_score', con=db.engine, if_exists='append', index=False)
-    db.session.commit()
+    return scores
 
-    return True
+
+def put_counts_sliced(collocations, remove_focus_cpos=True, include_negative=False):
+    """make sure that CollocationItems (counts and scores) exist for several collocation analyses with the same p, window and s_break
+    (e.g. on the slices of a subcorpus collection, see get_or_create_cotext_sliced)
+
+    - cotext lines of all analyses are read at once
+    - item counts of all analyses are created in one grouped count over the token stream
+    - marginals are shared by all analyses on the same corpus or subcorpus (see get_marginals)
+    - CollocationItems and scores of all analyses are saved in bulk
+
+    """
+
+    from .query import get_or_create_cotext
+
+    # counts of analyses that are computed in other requests are awaited
+    with ExitStack() as stack:
+        for collocation_id in sorted(collocation.id for collocation in collocations):
+            stack.enter_context(single_flight('collocation_items', collocation_id))
+
+        collocations = [collocation for collocation in collocations if not CollocationItem.query.filter_by(collocation_id=collocation.id).first()]
+        if len(collocations) == 0:
+            current_app.logger.debug("put_counts_sliced :: counts already exist")
+            return
+
+        p, window, s_break = collocations[0].p, collocations[0].window, collocations[0].s_break
+        corpus = collocations[0]._query.corpus
+        try:
+            stream = corpus_streams(corpus.cwb_id, current_app.config['CCC_REGISTRY_DIR']).p(p)
+        except (FileNotFoundError, OSError) as e:
+            current_app.logger.warning(f"put_counts_sliced :: cannot read token stream ({e}), counting separately")
+            for collocation in collocations:
+                put_counts(collocation, remove_focus_cpos=remove_focus_cpos, include_negative=include_negative)
+            return
+
+        # cotexts
+        cotext2collocation = dict()
+        for collocation in collocations:
+            cotext = get_or_create_cotext(collocation._query, window, s_break)
+            if cotext is not None:
+                cotext2collocation[cotext.id] = collocation
+        if len(cotext2collocation) == 0:
+            current_app.logger.error('put_counts_sliced :: empty cotexts')
+            return
+
+        current_app.logger.debug(f'put_counts_sliced :: getting {len(cotext2collocation)} cotexts')
+        cotext_lines_stmt = select(
+            CotextLines.cotext_id, CotextLines.cpos, CotextLines.offset
+        ).filter(
+            CotextLines.cotext_id.in_(list(cotext2collocation.keys())),
+            CotextLines.offset.between(-window, window)
+        )
+        df_cooc = read_sql(cotext_lines_stmt, con=db.engine)
+        df_cooc['abs_offset'] = df_cooc['offset'].abs()
+        df_cooc = df_cooc.sort_values(by='abs_offset').drop_duplicates(subset=['cotext_id', 'cpos'])
+        if remove_focus_cpos:
+            df_cooc = df_cooc[df_cooc['offset'] != 0]
+
+        # grouped count: (cotext, item id) pairs are encoded as one integer
+        current_app.logger.debug(f'put_counts_sliced :: counting items in {len(df_cooc)} cotext lines')
+        report(stage='counting', done=0, total=len(df_cooc))
+        cotext_ids, group = unique(df_cooc['cotext_id'].values, return_inverse=True)
+        ids = stream.cpos2id(df_cooc['cpos'].values)
+        keys, f = unique(group * len(stream.lexicon) + ids, return_counts=True)
+        counts = DataFrame({
+            'cotext_id': cotext_ids[keys // len(stream.lexicon)],
+            'item_id': keys % len(stream.lexicon),
+            'f': f
+        })
+        counts['item'] = stream.lexicon.decode(counts['item_id'].values)
+        f1 = df_cooc.groupby('cotext_id').size()
+
+        # marginals: lexicon frequencies of the corpus or frequencies in subcorpora, each counted once (see get_marginals)
+        current_app.logger.debug('put_counts_sliced :: adding marginals')
+        items = list()
+        for cotext_id, counts_cotext in counts.groupby('cotext_id'):
+            collocation = cotext2collocation[cotext_id]
+            if collocation._query.subcorpus and collocation.marginals == 'local':
+                _, marginals = get_marginals(collocation._query.subcorpus, p)
+            else:
+                _, marginals = get_marginals(corpus, p)
+            counts_cotext = counts_cotext.drop('cotext_id', axis=1).set_index('item')
+            counts_cotext['f2'] = marginals[counts_cotext.pop('item_id').values]
+            counts_cotext['f1'] = f1[cotext_id]
+            counts_cotext['N'] = int(marginals.sum())
+            counts_cotext['collocation_id'] = collocation.id
+            items.append(counts_cotext.reset_index())
+        if len(items) == 0:
+            current_app.logger.error('put_counts_sliced :: empty cotexts')
+            return
+
+        checkpoint()
+        current_app.logger.debug(f'put_counts_sliced :: saving {sum(len(i) for i in items)} items of {len(items)} analyses to database')
+        concat(items).to_sql('collocation_item', con=db.engine, if_exists='append', index=False)
+        db.session.commit()
+
+        # counts without scores are removed (cancellation, errors)
+        try:
+            current_app.logger.debug('put_counts_sliced :: adding scores')
+            report(stage='scoring', done=0, total=len(cotext2collocation))
+            items_stmt = select(
+                CollocationItem.id, CollocationItem.collocation_id, CollocationItem.f, CollocationItem.f1, CollocationItem.f2, CollocationItem.N
+            ).filter(
+                CollocationItem.collocation_id.in_([collocation.id for collocation in cotext2collocation.values()])
+            )
+            counts = read_sql(items_stmt, con=db.engine).set_index('id')
+            collocations = {collocation.id: collocation for collocation in cotext2collocation.values()}
+            for collocation in collocations.values():
+                collocation.sample_factor = collocation._query.sample_factor if collocation._query.sampled else None
+            db.session.commit()
+            scores = list()
+            for collocation_id, counts_collocation in counts.groupby('collocation_id'):
+                scores_collocation = score_counts(counts_collocation.drop('collocation_id', axis=1), include_negative,
+                                                  collocations[collocation_id].sample_factor)
+                scores_collocation['collocation_id'] = collocation_id
+                scores.append(scores_collocation)
+
+            current_app.logger.debug('put_counts_sliced :: saving scores')
+            concat(scores).to_sql('collocation_item_score', con=db.engine, if_exists='append', index=False)
+            db.session.commit()
+        except Exception:
+            delete_counts([collocation.id for collocation in cotext2collocation.values()])
+            raise
+        forget_ranked_lists('collocation', list(collocations.keys()))
+        clear_count_cache()
+
+
+def get_contexts(corpus, matches_df, window, s_break):
+    """contexts of matches within window, confined to the region of s_break of each match (see ccc's dump2context)
+    - computed on the data files of the corpus (database object) without CQP
+    - raises FileNotFoundError / OSError if the data files of the corpus cannot be read
+
+    returns DataFrame (index: match, matchend; columns: context, contextend) in the order of matches_df
+    """
+
+    streams = corpus_streams(corpus.cwb_id, current_app.config['CCC_REGISTRY_DIR'])
+    match = matches_df['match'].to_numpy(dtype=int64)
+    matchend = matches_df['matchend'].to_numpy(dtype=int64)
+    context = maximum(match - window, 0)
+    contextend = minimum(matchend + window, streams.p('word').size - 1)
+    if s_break is not None:
+        regions = streams.s(s_break)
+        struc = regions.cpos2struc(match)
+        inside = struc >= 0
+        struc = maximum(struc, 0)
+        context = where(inside, maximum(context, regions.starts[struc]), context)
+        contextend = where(inside, minimum(contextend, regions.ends[struc]), contextend)
+
+    return DataFrame({'match': match, 'matchend': matchend, 'context': context, 'contextend': contextend}).set_index(['match', 'matchend'])
+
+
+def preview_counts(query, p, window, s_break, marginals, size, budget, nr_regions, remove_focus_cpos=True):
+    """counts of items in cotext of a random sample of at most size matches of query
+    - stored matches are reused; queries without stored matches are run on nr_regions random regions (see preview_matches)
+    - matches are processed in random order until the time budget (in seconds, including the query) is exhausted
+
+    returns counts (index: item; columns: f, f1, f2, N) on the sample and sample factor (all / sampled matches)
+    """
+
+    from .query import preview_matches
+    deadline = monotonic() + budget
+    matches_df, sample_factor = preview_matches(query, nr_regions)
+    if len(matches_df) == 0:
+        return None, None
+
+    # contexts of matches in random order (at once), processed in chunks
+    order = default_rng(query.random_seed).permutation(len(matches_df))[:size]
+    try:
+        contexts = get_contexts(query.corpus, matches_df.iloc[order], window, s_break)
+    except (FileNotFoundError, OSError) as e:
+        current_app.logger.warning(f"preview_counts :: cannot read data files ({e}), creating contexts with cwb-ccc")
+        contexts = cancellable(query.corpus.ccc()).subcorpus(
+            subcorpus_name=None,
+            df_dump=matches_df.iloc[sort(order)],
+            overwrite=False
+        ).set_context(
+            window,
+            s_break,
+            overwrite=False
+        ).df
+        contexts = contexts.iloc[default_rng(query.random_seed).permutation(len(contexts))]
+    chunk_size = max(1, len(contexts) // 20)
+    df_cooc = list()
+    nr_sampled = 0
+    while nr_sampled < len(contexts) and (nr_sampled == 0 or monotonic() < deadline):
+        checkpoint()
+        chunk = contexts.iloc[nr_sampled:nr_sampled + chunk_size]
+        df_cooc.append(dump2cooc(chunk, rm_nodes=False, drop_duplicates=False))
+        nr_sampled += len(chunk)
+        report(stage='preview', done=nr_sampled, total=len(contexts))
+    current_app.logger.debug(f'preview_counts :: sampled {nr_sampled} of {len(matches_df)} matches in {budget - deadline + monotonic():.2f}s')
+
+    # remove duplicates and focus cpos (see get_filtered_cotext)
+    df_cooc = concat(df_cooc)
+    if len(df_cooc) == 0:
+        return None, None
+    df_cooc['abs_offset'] = df_cooc['offset'].abs()
+    df_cooc = df_cooc.sort_values(by='abs_offset').drop_duplicates(subset='cpos')
+    if remove_focus_cpos:
+        df_cooc = df_cooc[df_cooc['offset'] != 0]
+    if len(df_cooc) == 0:
+        return None, None
+
+    # count (see put_counts)
+    corpus = query.subcorpus if query.subcorpus and marginals == 'local' else query.corpus
+    try:
+        counts = count_items(corpus, df_cooc['cpos'].values, p)
+    except (FileNotFoundError, OSError) as e:
+        current_app.logger.warning(f"preview_counts :: cannot read token stream ({e}), counting with cwb-ccc")
+        corpus = corpus.ccc()
+        f = corpus.counts.cpos(df_cooc['cpos'], [p])[['freq']].rename(columns={'freq': 'f'})
+        f2 = corpus.marginals(f.index, [p])[['freq']].rename(columns={'freq': 'f2'})
+        counts = f.join(f2)
+        counts['N'] = corpus.size()
+    counts['f2'] = to_numeric(counts['f2'].fillna(0), downcast='integer')
+    counts['f1'] = len(df_cooc)
+    counts.index.name = 'id'
+
+    # matches may already be a sample (of stored matches or of regions)
+    sample_factor = len(matches_df) * sample_factor / nr_sampled
+
+    return counts, sample_factor
+
+
+def preview_scores(counts, sample_factor, confidence=.95, include_negative=False):
+    """association scores of counts on sampled matches (see preview_counts) with bounds
+    - bounds are the scores at the limits of the exact Poisson confidence interval of f
+
+    returns scores in long format (columns: item, measure, score, lower, upper)
+    """
+
+    alpha = 1 - confidence
+    f_lower = chi2.ppf(alpha / 2, 2 * counts['f']) / 2
+    f_upper = minimum(chi2.ppf(1 - alpha / 2, 2 * (counts['f'] + 1)) / 2, counts['f1'])
+
+    keys = ['collocation_item_id', 'measure']
+    scores = score_counts(counts, include_negative, sample_factor)
+    lower = score_counts(counts.assign(f=f_lower), True, sample_factor).set_index(keys)['score']
+    upper = score_counts(counts.assign(f=f_upper), True, sample_factor).set_index(keys)['score']
+    scores = scores.loc[scores['measure'].isin(AMS_DICT.keys())].set_index(keys)
+    scores['lower'] = minimum(lower.reindex(scores.index), upper.reindex(scores.index))
+    scores['upper'] = maximum(lower.reindex(scores.index), upper.reindex(scores.index))
+
+    return scores.reset_index().rename({'collocation_item_id': 'item'}, axis=1)
 
 
 ################
@@ -135,6 +493,8 @@ class CollocationIn(Schema):
     window = Integer(required=False, load_default=10)
     marginals = String(required=False, load_default='local', validate=OneOf(['local', 'global']))
     s_break = String(required=False)
+    exact = Boolean(required=False, load_default=False,
+                    metadata={'description': 'use all matches of sampled queries (processed in background)'})
 
     # filtering for second-order collocation
     filter_item = String(required=False, allow_none=True)
@@ -142,6 +502,14 @@ class CollocationIn(Schema):
     filter_overlap = String(required=False, load_default='partial', validate=OneOf(['partial', 'full', 'match', 'matchend']))
 
 
+class CollocationPreviewIn(Schema):
+
+    preview = Boolean(required=False, load_default=False,
+                      metadata={'description': 'estimate scores on a random sample of matches and process exact analysis in background'})
+    sort_by = String(required=False, load_default='conservative_log_ratio', validate=OneOf(AMS_DICT.keys()))
+    page_size = Integer(required=False, load_default=10)
+
+
 # Output
 class CollocationOut(Schema):
 
@@ -157,6 +525,45 @@ class CollocationOut(Schema):
 
     nr_items = Integer(required=True)
 
+    sampled = Boolean(required=True, dump_default=False)
+    sample_factor = Float(required=True, allow_none=True, dump_default=None,
+                          metadata={'description': 'counts on sampled matches are scaled by this factor for scoring'})
+
+
+class CollocationPreviewScoreOut(Schema):
+
+    measure = String(required=True)
+    score = Float(required=True)
+    lower = Float(required=True)
+    upper = Float(required=True)
+
+
+class CollocationPreviewItemOut(Schema):
+
+    item = String(required=True)
+    scores = Nested(CollocationPreviewScoreOut(many=True), required=True)
+
+
+class CollocationPreviewOut(Schema):
+
+    query_id = Integer(required=True)
+
+    p = String(required=True)
+    window = Integer(required=True)
+    marginals = String(required=True)
+    s_break = String(required=True)
+
+    sort_by = String(required=True)
+    nr_items = Integer(required=True)
+    sample_factor = Float(required=True, metadata={'description': 'counts on sampled matches are scaled by this factor for scoring'})
+    confidence = Float(required=True)
+    items = Nested(CollocationPreviewItemOut(many=True), required=True, dump_default=[])
+
+    collocation_id = Integer(required=True, allow_none=True, dump_default=None,
+                             metadata={'description': 'exact analysis (if it already exists)'})
+    job = Nested(JobOut, required=True, allow_none=True, dump_default=None,
+                 metadata={'description': 'background job processing exact analysis'})
+
 
 # IDENTICAL TO KEYWORDS ↓
 
@@ -166,6 +573,7 @@ class CollocationItemsIn(Schema):
     sort_by = String(required=False, load_default='conservative_log_ratio', validate=OneOf(AMS_DICT.keys()))
     page_size = Integer(required=False, load_default=10)
     page_number = Integer(required=False, load_default=1)
+    cursor = String(required=False, load_default=None, metadata={'description': 'cursor of next page (takes precedence over page number)'})
     min_score = Float(required=False, load_default=None, allow_none=True)
 
 
@@ -192,6 +600,7 @@ class CollocationItemsOut(Schema):
     page_size = Integer(required=True)
     page_number = Integer(required=True)
     page_count = Integer(required=True)
+    next_cursor = String(required=False, allow_none=True, dump_default=None)
     min_score = Float(required=False, dump_default=None, allow_none=True)
 
     items = Nested(CollocationItemOut(many=True), required=True, dump_default=[])
@@ -237,6 +646,8 @@ def delete_collocation(id):
     collocation = db.get_or_404(Collocation, id)
     db.session.delete(collocation)
     db.session.commit()
+    forget_ranked_lists('collocation', [collocation.id])
+    clear_count_cache()
 
     return 'Deletion successful.', 200
 
@@ -255,6 +666,7 @@ def get_collocation_items(id, query_data):
     # pagination settings
     page_size = query_data.pop('page_size')
     page_number = query_data.pop('page_number')
+    cursor = query_data.pop('cursor')
     sort_order = query_data.pop('sort_order')
     sort_by = query_data.pop('sort_by')
 
@@ -268,14 +680,9 @@ def get_collocation_items(id, query_data):
         CollocationItemScore.score > min_score
     )
 
-    # order
-    if sort_order == 'ascending':
-        scores = scores.order_by(CollocationItemScore.score)
-    elif sort_order == 'descending':
-        scores = scores.order_by(CollocationItemScore.score.desc())
-
-    # paginate
-    scores = scores.paginate(page=page_number, per_page=page_size)
+    # order and paginate
+    scores = paginate_keyset(scores, [CollocationItemScore.score, CollocationItemScore.id],
+                             sort_order == 'descending', page_number, page_size, cursor)
     nr_items = scores.total
     page_count = scores.pages
 
@@ -288,7 +695,7 @@ def get_collocation_items(id, query_data):
     if collocation.semantic_map:
         requested_items = [item['item'] for item in items]
         ccc_semmap_update(collocation.semantic_map, requested_items)
-        coordinates = [CoordinatesOut().dump(coordinates) for coordinates in collocation.semantic_map.coordinates if coordinates.item in requested_items]
+        coordinates = [CoordinatesOut().dump(coordinates) for coordinates in get_item_coordinates(collocation.semantic_map.id, requested_items)]
 
     # TODO: also return ranks (to ease frontend pagination)?
     collocation_items = {
@@ -298,6 +705,7 @@ def get_collocation_items(id, query_data):
         'page_size': page_size,
         'page_number': page_number,
         'page_count': page_count,
+        'next_cursor': scores.next_cursor,
         'items': items,
         'coordinates': coordinates
     }
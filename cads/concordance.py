@@ -1,17 +1,26 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
+import json
+from collections import OrderedDict, defaultdict
+from threading import Lock
 
-from apiflask import Schema
-from apiflask.fields import Boolean, Dict, Integer, List, Nested, String
+from apiflask import Schema, abort
+from apiflask.fields import Boolean, Dict, Float, Integer, List, Nested, String
 from apiflask.validators import OneOf
 from ccc import SubCorpus
 from flask import current_app
-from pandas import DataFrame, concat
+from numpy import (arange, argsort, array, cumsum, int64, lexsort, maximum,
+                   minimum, repeat, searchsorted, unique, where)
+from pandas import DataFrame, Series, concat, read_sql, to_numeric
+from sqlalchemy import select
 
 from . import db
+from .cwb import BlockCache, corpus_streams
 from .database import Concordance, ConcordanceLines, Matches
+from .pagination import cached_count, paginate_keyset
+
+_interval_indices = BlockCache(256)
 
 
 def ccc2attributes(line, p_show, s_show):
@@ -55,21 +64,260 @@ def ccc2attributes(line, p_show, s_show):
     return row
 
 
+def ccc_lines(cwb_id, df_dump, p_show, s_show, window, context_break, extended_window, extended_context_break):
+    """create concordance lines via cwb-ccc
+
+    """
+
+    lines = SubCorpus(
+        subcorpus_name=None,
+        df_dump=df_dump,
+        corpus_name=cwb_id,
+        cqp_bin=current_app.config['CCC_CQP_BIN'],
+        registry_dir=current_app.config['CCC_REGISTRY_DIR'],
+        data_dir=current_app.config['CCC_DATA_DIR'],
+        overwrite=False,
+        lib_dir=None
+    )
+    lines_in_context = lines.set_context(
+        context=window,
+        context_break=context_break
+    ).concordance(
+        form='dict',
+        p_show=p_show,
+        s_show=s_show,
+        order='asis'
+    )
+    lines_in_extended_context = lines.set_context(
+        context=extended_window,
+        context_break=extended_context_break
+    ).concordance(
+        form='dict',
+        p_show=p_show,
+        s_show=s_show,
+        order='asis'
+    )
+    lines = lines_in_extended_context.drop(
+        ['context', 'contextend'], axis=1
+    ).join(
+        lines_in_context[['context', 'contextend']]
+    )
+
+    return list(lines.apply(lambda line: ccc2attributes(line, p_show, s_show), axis=1))
+
+
+def context_boundaries(match, matchend, window, corpus_size, context_break=None):
+    """vectorised context (start and end cpos) of matches
+
+    - window tokens left of match and right of matchend
+    - confined to the region of context_break (StructuralStream) containing the match (if any)
+    - whole region if window is None
+
+    """
+
+    if window is None and context_break is None:
+        window = 0
+
+    if window is None:
+        start, end = match.copy(), matchend.copy()
+    else:
+        start = maximum(match - window, 0)
+        end = minimum(matchend + window, corpus_size - 1)
+
+    if context_break is not None:
+        struc = context_break.cpos2struc(match)
+        inside = struc >= 0
+        region_start = context_break.starts[struc.clip(0)]
+        region_end = context_break.ends[struc.clip(0)]
+        if window is None:
+            start = where(inside, region_start, start)
+            end = where(inside, region_end, end)
+        else:
+            start = where(inside, maximum(start, region_start), start)
+            end = where(inside, minimum(end, region_end), end)
+
+    return start, end
+
+
+def kwic_lines(cwb_id, df_dump, p_show, s_show, window, context_break, extended_window, extended_context_break):
+    """create concordance lines directly from memory-mapped token streams
+
+    token ids of all lines are read in one slice per p-attribute and
+    decoded via the (cached) lexicon; window and extended context are
+    determined in one pass
+
+    """
+
+    if len(p_show) != 2:
+        raise NotImplementedError()
+
+    streams = corpus_streams(cwb_id, current_app.config['CCC_REGISTRY_DIR'])
+
+    match = df_dump.index.get_level_values('match').to_numpy(dtype=int64)
+    matchend = df_dump.index.get_level_values('matchend').to_numpy(dtype=int64)
+    contextid = df_dump['contextid'].tolist()
+
+    # context (out of window) and extended context (to display)
+    corpus_size = streams.p(p_show[0]).size
+    context, contextend = context_boundaries(
+        match, matchend, window, corpus_size, streams.s(context_break) if context_break else None
+    )
+    start, end = context_boundaries(
+        match, matchend, extended_window, corpus_size, streams.s(extended_context_break) if extended_context_break else None
+    )
+    start, end = minimum(start, match), maximum(end, matchend)
+
+    # corpus positions of all lines
+    lengths = end - start + 1
+    line = repeat(arange(len(match)), lengths)
+    cpos = start[line] + arange(lengths.sum()) - repeat(cumsum(lengths) - lengths, lengths)
+
+    offset = where(cpos < match[line], cpos - match[line], where(cpos > matchend[line], cpos - matchend[line], 0))
+    out_of_window = (cpos < context[line]) | (cpos > contextend[line])
+
+    primary = streams.p(p_show[0]).cpos2str(cpos).tolist()
+    secondary = streams.p(p_show[1]).cpos2str(cpos).tolist()
+
+    structural = dict()
+    for s_att in s_show:
+        stream = streams.s(s_att)
+        structural[s_att] = (stream.cpos2str(match) if stream.has_values else stream.cpos2struc(match)).tolist()
+
+    # formatting
+    cpos, offset, out_of_window = cpos.tolist(), offset.tolist(), out_of_window.tolist()
+    rows = list()
+    boundaries = cumsum(lengths).tolist()
+    left = 0
+    for i, right in enumerate(boundaries):
+        rows.append({
+            'tokens': [{
+                'cpos': cpos[j],
+                'offset': offset[j],
+                'primary': primary[j],
+                'secondary': secondary[j],
+                'out_of_window': out_of_window[j]
+            } for j in range(left, right)],
+            'structural': {s_att: values[i] for s_att, values in structural.items()},
+            'id': int(match[i]),
+            'contextid': contextid[i]
+        })
+        left = right
+
+    return rows
+
+
+class IntervalIndex:
+    """sorted match and matchend arrays of a query for vectorised range lookups
+
+    """
+
+    def __init__(self, match, matchend):
+
+        order = argsort(match, kind='stable')
+        self.match = match[order]
+        self.matchend = matchend[order]
+        self.max_length = int((self.matchend - self.match).max()) if len(self.match) > 0 else 0
+
+    def __len__(self):
+        return len(self.match)
+
+    def overlapping(self, start, end):
+        """all matches overlapping with any of the ranges [start, end]
+
+        :return: line (index of range), match, matchend
+        """
+
+        lower = searchsorted(self.match, start - self.max_length, side='left')
+        upper = searchsorted(self.match, end, side='right')
+        lengths = (upper - lower).clip(0)
+
+        line = repeat(arange(len(start)), lengths)
+        idx = lower[line] + arange(lengths.sum()) - repeat(cumsum(lengths) - lengths, lengths)
+        keep = self.matchend[idx] >= start[line]
+
+        return line[keep], self.match[idx][keep], self.matchend[idx][keep]
+
+
+def interval_index(query):
+    """get interval index of query matches; cached per query and version of its matches (modification time)
+
+    """
+
+    key = (query.id, query.modified)
+    index = _interval_indices.get(key)
+    if index is None:
+        matches = read_sql(
+            select(Matches.match, Matches.matchend).where(Matches.query_id == query.id), con=db.engine
+        )
+        index = IntervalIndex(matches['match'].to_numpy(dtype=int64), matches['matchend'].to_numpy(dtype=int64))
+        if len(index) > 0:
+            # matches of a query are written once; empty results might not have been written yet
+            _interval_indices.put(key, index)
+
+    return index
+
+
+def sort_by_s_att_values(query, sort_by_offset, sort_by_s_att):
+    """sort matches of query by annotation of s-attribute region at (offset of) match
+
+    - region numbers and values are looked up vectorised on the memory-mapped region index
+    - numeric annotations are sorted numerically, others alphabetically
+    - matches outside of any region (or without annotation) come first
+    - ties are broken by corpus position
+
+    """
+
+    matches = read_sql(
+        select(Matches.match, Matches.matchend, Matches.contextid).where(Matches.query_id == query.id), con=db.engine
+    )
+    match = matches['match'].to_numpy(dtype=int64)
+    matchend = matches['matchend'].to_numpy(dtype=int64)
+
+    sort_by_offset = 0 if sort_by_offset is None else sort_by_offset
+    if sort_by_offset < 0:
+        cpos = match + sort_by_offset
+    elif sort_by_offset > 0:
+        cpos = matchend + sort_by_offset
+    else:
+        cpos = match
+
+    s_att = corpus_streams(query.corpus.cwb_id, current_app.config['CCC_REGISTRY_DIR']).s(sort_by_s_att)
+    struc = s_att.cpos2struc(cpos)
+
+    # rank distinct regions by their values
+    regions, inverse = unique(struc, return_inverse=True)
+    if s_att.has_values:
+        values = Series(s_att.struc2str(regions))
+        numeric = to_numeric(values, errors='coerce')
+        if numeric.notna().sum() == values.notna().sum():
+            values = numeric
+        region_rank = values.rank(method='dense', na_option='top').to_numpy()
+    else:
+        region_rank = regions.astype(float)
+    rank = region_rank[inverse]
+
+    order = lexsort((match, rank))
+
+    return matches[['match', 'contextid']].iloc[order].reset_index(drop=True)
+
+
 def sort_matches(query, sort_by_offset, sort_by_p_att, sort_by_s_att=None):
     """
 
     """
 
-    current_app.logger.debug(f"sort_matches :: query {query.id}, sorting by {sort_by_p_att} at offset {sort_by_offset}")
+    sort_by = sort_by_s_att if sort_by_s_att else sort_by_p_att
+    current_app.logger.debug(f"sort_matches :: query {query.id}, sorting by {sort_by} at offset {sort_by_offset}")
 
-    if sort_by_s_att:
+    if sort_by_p_att and sort_by_s_att:
         raise NotImplementedError()
 
     # retrieve from database if possible
+    # NB: names of p- and s-attributes are unique within a corpus
     random_seed = query.random_seed
     concordance = Concordance.query.filter_by(
         query_id=query.id,
-        sort_by=sort_by_p_att,
+        sort_by=sort_by,
         sort_offset=sort_by_offset,
         random_seed=random_seed
     ).first()
@@ -82,14 +330,29 @@ def sort_matches(query, sort_by_offset, sort_by_p_att, sort_by_s_att=None):
         concordance = Concordance(
             query_id=query.id,
             sort_offset=sort_by_offset,
-            sort_by=sort_by_p_att,
+            sort_by=sort_by,
             random_seed=random_seed
         )
         db.session.add(concordance)
         db.session.commit()
 
+        if sort_by_s_att:
+            # sorting on s-attribute
+            concordance_lines = sort_by_s_att_values(query, sort_by_offset, sort_by_s_att)
+            concordance_lines['concordance_id'] = concordance.id
+            concordance_lines.to_sql('concordance_lines', con=db.engine, if_exists='append', index=False)
+            current_app.logger.debug("sort_matches :: exit")
+            return concordance
+
+        if query.nqr_cqp is None:
+            # matches sliced from a parent query (see ccc_query_sliced) do not have an NQR yet
+            current_app.logger.debug("sort_matches :: creating NQR")
+            df_dump = DataFrame([vars(s) for s in query.matches], columns=['match', 'matchend']).sort_values(by='match')
+            query.nqr_cqp = query.corpus.ccc().subcorpus(subcorpus_name=None, df_dump=df_dump, overwrite=False).subcorpus_name
+            db.session.commit()
+
         # sort randomly
-        if not sort_by_p_att and not sort_by_s_att:
+        if not sort_by_p_att:
             sort_clause = f"sort {query.nqr_cqp} randomize {random_seed}"
 
         else:
@@ -140,6 +403,121 @@ def sort_matches(query, sort_by_offset, sort_by_p_att, sort_by_s_att=None):
     return concordance
 
 
+class PageCache:
+    """byte-bounded LRU cache of rendered concordance pages
+
+    """
+
+    def __init__(self, max_bytes=256 * 1024**2):
+
+        self.max_bytes = max_bytes
+        self.nr_bytes = 0
+        self._pages = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.prefetch_hits = 0
+        self.prefetches = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(query, query_data, **update):
+        """canonical key: query, version of its matches (modification time), its random seed and all display / sort / filter / page parameters
+
+        the page number is left out if a cursor is given (which takes precedence)
+        """
+
+        query_data = dict(query_data, **update)
+        if query_data.get('cursor'):
+            query_data.pop('page_number', None)
+        params = tuple(sorted(
+            (k, tuple(v) if isinstance(v, list) else v) for k, v in query_data.items()
+        ))
+
+        return (query.id, query.modified, query.random_seed, params)
+
+    def get(self, key):
+
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._pages.move_to_end(key)
+            payload, size, prefetched = entry
+            self.hits += 1
+            if prefetched:
+                self.prefetch_hits += 1
+                self._pages[key] = (payload, size, False)
+            return payload
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._pages
+
+    def put(self, key, payload, prefetched=False):
+
+        size = len(json.dumps(payload, default=str))
+        with self._lock:
+            if size > self.max_bytes:
+                return
+            if key in self._pages:
+                self.nr_bytes -= self._pages.pop(key)[1]
+            self._pages[key] = (payload, size, prefetched)
+            self.nr_bytes += size
+            if prefetched:
+                self.prefetches += 1
+            while self.nr_bytes > self.max_bytes:
+                self.nr_bytes -= self._pages.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def clear(self, match=None):
+        """remove all pages (or the ones whose key matches)
+
+        """
+        with self._lock:
+            for key in [key for key in self._pages if match is None or match(key)]:
+                self.nr_bytes -= self._pages.pop(key)[1]
+
+    def resize(self, max_bytes):
+
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self.nr_bytes > self.max_bytes:
+                self.nr_bytes -= self._pages.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def stats(self):
+
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'nr_pages': len(self._pages),
+                'nr_bytes': self.nr_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.,
+                'prefetches': self.prefetches,
+                'prefetch_hits': self.prefetch_hits,
+                'evictions': self.evictions
+            }
+
+
+page_cache = PageCache()
+
+
+def forget_matches(query_id):
+    """remove cached concordance pages and interval index of query (after its matches have been written or deleted)
+
+    the ones cached by other processes are not found anymore since the
+    modification time of the query is part of their keys
+    """
+
+    page_cache.clear(lambda key: key[0] == query_id)
+    _interval_indices.clear(lambda key: key[0] == query_id)
+
+
 def ccc_concordance(focus_query,
                     p_show, s_show,
                     window, context_break=None,
@@ -147,7 +525,7 @@ def ccc_concordance(focus_query,
                     highlight_queries=dict(),
                     match_id=None,
                     filter_queries=dict(), overlap='partial',
-                    page_number=None, page_size=None,
+                    page_number=None, page_size=None, cursor=None,
                     sort_order='random',
                     sort_by_offset=0, sort_by_p_att=None, sort_by_s_att=None):
     """Central concordance function.
@@ -172,6 +550,7 @@ def ccc_concordance(focus_query,
 
     :param int page_number: pagination page number
     :param int page_size: pagination page size
+    :param str cursor: keyset pagination cursor (returned as 'next_cursor'); takes precedence over page_number
 
     :param str sort_order: ascending / descending (alphabetical order of attribute) or random / first / last (based on cpos)
 
@@ -197,6 +576,9 @@ def ccc_concordance(focus_query,
         # TODO 400
         raise NotImplementedError("ccc_concordance :: cannot sort by s-att and p-att")
 
+    if sort_by_s_att and sort_by_s_att not in focus_query.corpus.s_atts + focus_query.corpus.s_annotations:
+        abort(404, f's-attribute "{sort_by_s_att}" does not exist in corpus "{focus_query.corpus.cwb_id}"')
+
     if sort_by_offset is None and (sort_by_p_att or sort_by_s_att):
         # default to sorting on match if sorting
         sort_by_offset = 0
@@ -210,6 +592,7 @@ def ccc_concordance(focus_query,
         ).all()
         nr_lines = 1
         page_count = 1
+        next_cursor = None
 
     else:
 
@@ -227,10 +610,11 @@ def ccc_concordance(focus_query,
 
         # SORTING
         current_app.logger.debug("ccc_concordance :: sorting")
+        nr_lines = cached_count(matches)
         if sort_order == 'first':
-            pass
+            sort_key, descending = Matches.id, False
         elif sort_order == 'last':
-            matches = matches.order_by(Matches.id.desc())
+            sort_key, descending = Matches.id, True
         elif sort_order in ('random', 'ascending', 'descending'):
             concordance = sort_matches(
                 focus_query,
@@ -244,20 +628,17 @@ def ccc_concordance(focus_query,
                 (ConcordanceLines.match == Matches.match)  # &
                 # (ConcordanceLines.contextid == Matches.contextid)
             )
-            if sort_order == 'ascending' or sort_order == 'random':
-                matches = matches.order_by(ConcordanceLines.id)
-            elif sort_order == 'descending':
-                matches = matches.order_by(ConcordanceLines.id.desc())
+            sort_key, descending = ConcordanceLines.id, sort_order == 'descending'
         else:
             raise ValueError()
 
         # PAGINATION
         current_app.logger.debug("ccc_concordance :: pagination")
-        matches = matches.paginate(page=page_number, per_page=page_size)
-        nr_lines = matches.total
+        matches = paginate_keyset(matches, [sort_key], descending, page_number, page_size, cursor, total=nr_lines)
         page_count = matches.pages
+        next_cursor = matches.next_cursor
 
-    # RETRIEVE DATA FROM CWB-CCC
+    # RETRIEVE DATA
     current_app.logger.debug("ccc_concordance :: retrieving selected concordance lines from database")
 
     df_dump = DataFrame(
@@ -272,70 +653,41 @@ def ccc_concordance(focus_query,
             'page_count': 0
         }
 
-    current_app.logger.debug("ccc_concordance :: creating selected concordance lines from cwb-ccc")
-    lines = SubCorpus(
-        subcorpus_name=None,
-        df_dump=df_dump,
-        corpus_name=focus_query.corpus.cwb_id,
-        cqp_bin=current_app.config['CCC_CQP_BIN'],
-        registry_dir=current_app.config['CCC_REGISTRY_DIR'],
-        data_dir=current_app.config['CCC_DATA_DIR'],
-        overwrite=False,
-        lib_dir=None
-    )
-    lines_in_context = lines.set_context(
-        context=window,
-        context_break=context_break
-    ).concordance(
-        form='dict',
-        p_show=p_show,
-        s_show=s_show,
-        order='asis'
-    )
-    lines_in_extended_context = lines.set_context(
-        context=extended_window,
-        context_break=extended_context_break
-    ).concordance(
-        form='dict',
-        p_show=p_show,
-        s_show=s_show,
-        order='asis'
-    )
-    lines = lines_in_extended_context.drop(
-        ['context', 'contextend'], axis=1
-    ).join(
-        lines_in_context[['context', 'contextend']]
-    )
-
-    # FORMATTING
-    current_app.logger.debug("ccc_concordance :: formatting")
-    lines = lines.apply(lambda line: ccc2attributes(line, p_show, s_show), axis=1)
+    current_app.logger.debug("ccc_concordance :: creating selected concordance lines")
+    try:
+        lines = kwic_lines(focus_query.corpus.cwb_id, df_dump, p_show, s_show,
+                           window, context_break, extended_window, extended_context_break)
+    except FileNotFoundError as e:
+        current_app.logger.debug(f"ccc_concordance :: cannot read data files directly ({e}), using cwb-ccc")
+        lines = ccc_lines(focus_query.corpus.cwb_id, df_dump, p_show, s_show,
+                          window, context_break, extended_window, extended_context_break)
 
     # HIGHLIGHTING
     current_app.logger.debug("ccc_concordance :: highlighting")
+    start = array([line['tokens'][0]['cpos'] if line['tokens'] else line['id'] for line in lines], dtype=int64)
+    end = array([line['tokens'][-1]['cpos'] if line['tokens'] else line['id'] for line in lines], dtype=int64)
     highlight_ranges = defaultdict(list)
-    filter_item_cpos = set()
+    filter_item_cpos = defaultdict(set)
     for key, hq in highlight_queries.items():
-        hd_matches = Matches.query.filter(
-            Matches.query_id == hq.id,
-            Matches.contextid.in_(list(df_dump['contextid']))
-        ).all()
-        for match in hd_matches:
-            if key == '_FILTER':
-                filter_item_cpos.add(match.match)
-            else:
-                highlight_ranges[match.contextid].append({
+        line_idx, match, matchend = interval_index(hq).overlapping(start, end)
+        if key == '_FILTER':
+            for i, m in zip(line_idx.tolist(), match.tolist()):
+                filter_item_cpos[i].add(m)
+        else:
+            for i, m, me in zip(line_idx.tolist(), match.tolist(), matchend.tolist()):
+                highlight_ranges[i].append({
                     'discourseme_id': key,
-                    'start': match.match,
-                    'end': match.matchend
+                    'start': m,
+                    'end': me
                 })
 
-    for line in lines:
+    for i, line in enumerate(lines):
         line['match_id'] = line.pop('id')
-        line['discourseme_ranges'] = highlight_ranges.get(line['contextid'], [])
-        for token in line['tokens']:
-            if token['cpos'] in filter_item_cpos:
-                token['is_filter_item'] = True
+        line['discourseme_ranges'] = highlight_ranges.get(i, [])
+        if i in filter_item_cpos:
+            for token in line['tokens']:
+                if token['cpos'] in filter_item_cpos[i]:
+                    token['is_filter_item'] = True
 
     current_app.logger.debug("ccc_concordance :: exit")
     return {
@@ -343,7 +695,8 @@ def ccc_concordance(focus_query,
         'nr_lines': nr_lines if nr_lines else 0,
         'page_size': page_size,
         'page_number': page_number,
-        'page_count': page_count
+        'page_count': page_count,
+        'next_cursor': next_cursor
     }
 
 
@@ -398,6 +751,10 @@ class ConcordanceIn(ConcordanceLineIn):
         required=False, load_default=1,
         metadata={'description': 'page number'}
     )
+    cursor = String(
+        required=False, load_default=None,
+        metadata={'description': 'cursor of next page as returned by previous request (takes precedence over page number)'}
+    )
 
     sort_order = String(
         required=False, load_default='random', validate=OneOf(['random', 'first', 'last', 'ascending', 'descending']),
@@ -458,11 +815,25 @@ class ConcordanceLineOut(Schema):
     discourseme_ranges = Nested(DiscoursemeRangeOut(many=True), required=True, dump_default=[])  # TODO rename to 'ranges'
 
 
+class ConcordanceCacheOut(Schema):
+
+    nr_pages = Integer(required=True)
+    nr_bytes = Integer(required=True)
+    max_bytes = Integer(required=True)
+    hits = Integer(required=True)
+    misses = Integer(required=True)
+    hit_rate = Float(required=True)
+    prefetches = Integer(required=True)
+    prefetch_hits = Integer(required=True)
+    evictions = Integer(required=True)
+
+
 class ConcordanceOut(Schema):
 
     nr_lines = Integer(required=True)
     page_size = Integer(required=True)
     page_number = Integer(required=True)
     page_count = Integer(required=True)
+    next_cursor = String(required=False, allow_none=True, dump_default=None)
 
     lines = Nested(ConcordanceLineOut(many=True), required=True, dump_default=[])
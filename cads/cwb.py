@@ -0,0 +1,506 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""direct read access to the binary CWB data files
+
+p-attribute token streams (uncompressed `.corpus` or huffman-coded
+`.huf`), lexicons and s-attribute regions / annotations are
+memory-mapped once per process and sliced with numpy, which avoids
+spawning CQP for read-only lookups such as rendering concordance lines.
+
+frequencies of lexicon ids are counted on the token streams in shards,
+optionally by several threads that share the memory maps (see
+count_ids). huffman blocks of a shard are decoded together, one token
+of all blocks at a time (see PositionalStream.decode_blocks), so that
+decoding runs in numpy, which releases the GIL.
+
+"""
+
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+from threading import Lock
+
+import numpy as np
+
+# number of tokens between two synchronisation points in huffman-coded streams
+SYNCHRONIZATION = 128
+# size of the huffman-coded-data header: length, size, min_codelen, max_codelen + 3 arrays of MAXCODELEN=32
+HCD_HEADER = 4 + 3 * 32
+# number of tokens counted at once by count_ids
+SHARD_SIZE = 2**22
+# number of leading bits from which the length of a huffman code is looked up
+PREFIX_BITS = 16
+# number of huffman blocks from which on they are decoded together (instead of one by one, cached)
+BATCH_BLOCKS = 16
+
+
+def _memmap(path, dtype='>i4'):
+    """memory-map a binary file; cached per path and modification time
+
+    """
+    return _memmap_cached(path, os.path.getmtime(path), dtype)
+
+
+@lru_cache(maxsize=1024)
+def _memmap_cached(path, mtime, dtype):
+
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def registry_home(cwb_id, registry_dir):
+    """get data directory of a corpus from its registry entry
+
+    """
+
+    path = os.path.join(registry_dir, cwb_id.lower())
+    with open(path, "rt") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("HOME"):
+                return line[4:].strip().strip('"')
+
+    raise FileNotFoundError(f"registry entry {path} does not specify HOME")
+
+
+class BlockCache:
+    """small thread-safe LRU cache
+
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self, match=None):
+        """remove all entries (or the ones whose key matches)
+
+        """
+        with self._lock:
+            for key in [key for key in self._data if match is None or match(key)]:
+                del self._data[key]
+
+
+class Lexicon:
+    """id ↔ string mapping of a p-attribute (`.lexicon` / `.lexicon.idx`)
+
+    """
+
+    def __init__(self, path):
+
+        self.strings = _memmap(path + ".lexicon", dtype='u1')
+        self.index = _memmap(path + ".lexicon.idx")
+        self._cache = BlockCache(2**16)
+
+    def __len__(self):
+        return len(self.index)
+
+    def id2str(self, i):
+
+        value = self._cache.get(i)
+        if value is None:
+            start = int(self.index[i])
+            end = int(self.index[i + 1]) - 1 if i + 1 < len(self.index) else len(self.strings) - 1
+            value = bytes(self.strings[start:end]).decode('utf-8', errors='replace')
+            self._cache.put(i, value)
+
+        return value
+
+    def decode(self, ids):
+        """decode array of ids; each distinct id is only looked up once
+
+        """
+
+        ids = np.asarray(ids, dtype=np.int64)
+        uniq, inverse = np.unique(ids, return_inverse=True)
+        if len(uniq) > len(self) / 4:
+            # large parts of the lexicon are decoded at once
+            strings = np.array(bytes(self.strings).decode('utf-8', errors='replace').split('\0')[:-1], dtype=object)[uniq]
+        else:
+            strings = np.array([self.id2str(int(i)) for i in uniq], dtype=object)
+
+        return strings[inverse.reshape(ids.shape)] if len(uniq) else np.empty(0, dtype=object)
+
+
+class PositionalStream:
+    """token stream of a p-attribute
+
+    """
+
+    def __init__(self, home, p):
+
+        self.p = p
+        path = os.path.join(home, p)
+        self.path = path
+        self.lexicon = Lexicon(path)
+
+        if os.path.exists(path + ".corpus"):
+            # uncompressed
+            self.compressed = False
+            self.stream = _memmap(path + ".corpus")
+            self.size = len(self.stream)
+
+        elif os.path.exists(path + ".huf"):
+            # huffman-coded
+            self.compressed = True
+            hcd = np.fromfile(path + ".hcd", dtype='>i4').astype(np.int64)
+            self.size = int(hcd[1])
+            self.min_codelen = int(hcd[2])
+            self.max_codelen = int(hcd[3])
+            self.symindex = hcd[36:68].tolist()
+            self.min_code = hcd[68:100].tolist()
+            self.symbols = hcd[HCD_HEADER:]
+            self.huf = _memmap(path + ".huf", dtype='u1')
+            self.sync = _memmap(path + ".huf.syn")
+            self._blocks = BlockCache(4096)
+            self._tables = None
+            self._tables_lock = Lock()
+
+        else:
+            raise FileNotFoundError(f"no token stream for p-attribute '{p}' in {home}")
+
+    def _block(self, block):
+        """decode one huffman block of SYNCHRONIZATION tokens
+
+        """
+
+        ids = self._blocks.get(block)
+        if ids is not None:
+            return ids
+
+        start = int(self.sync[block])
+        end = int(self.sync[block + 1]) if block + 1 < len(self.sync) else len(self.huf)
+        nr_tokens = min(SYNCHRONIZATION, self.size - block * SYNCHRONIZATION)
+
+        data = int.from_bytes(self.huf[start:end].tobytes(), 'big')
+        nr_bits = (end - start) * 8
+        position = 0
+        codes = list()
+        for _ in range(nr_tokens):
+            length = self.min_codelen
+            v = (data >> (nr_bits - position - length)) & ((1 << length) - 1)
+            position += length
+            while v < self.min_code[length]:
+                v = (v << 1) | ((data >> (nr_bits - position - 1)) & 1)
+                position += 1
+                length += 1
+            codes.append(self.symindex[length] + v - self.min_code[length])
+
+        ids = self.symbols[codes]
+        self._blocks.put(block, ids)
+
+        return ids
+
+    def _huffman_tables(self):
+        """big-endian 32-bit words of the huffman-coded data and table of code lengths by prefix (created once)
+
+        """
+
+        with self._tables_lock:
+            if self._tables is None:
+                nr_words = len(self.huf) // 4
+                words = np.memmap(self.path + ".huf", dtype='>u4', mode='r', shape=(nr_words, )) if nr_words else np.zeros(1, dtype='>u4')
+                tail = np.frombuffer((bytes(self.huf[4 * nr_words:]) + bytes(8))[:8], dtype='>u4').astype(np.uint64)
+
+                # length of all codes that start with a prefix of PREFIX_BITS (0: longer code)
+                prefix_bits = min(PREFIX_BITS, self.max_codelen)
+                prefix = np.arange(2**prefix_bits)
+                lengths = np.zeros(2**prefix_bits, dtype=np.int64)
+                for codelen in range(prefix_bits, self.min_codelen - 1, -1):
+                    lengths[(prefix >> (prefix_bits - codelen)) >= self.min_code[codelen]] = codelen
+
+                self._tables = (words, nr_words, tail, prefix_bits, lengths)
+
+        return self._tables
+
+    def decode_blocks(self, blocks):
+        """decode several huffman blocks at once, one token of all blocks per step
+
+        returns array of shape (len(blocks), SYNCHRONIZATION); positions
+        after the end of the corpus (in the last block) are undefined
+        """
+
+        words, nr_words, tail, prefix_bits, prefix_lengths = self._huffman_tables()
+        symindex, min_code = np.array(self.symindex, dtype=np.int64), np.array(self.min_code, dtype=np.int64)
+
+        # bit position of next code in each block
+        position = np.asarray(self.sync, dtype=np.int64)[np.asarray(blocks, dtype=np.int64)] * 8
+        codes = np.empty((len(position), SYNCHRONIZATION), dtype=np.int64)
+        for token in range(SYNCHRONIZATION):
+
+            # 64 bits of the two words around position, shifted to position (at least 33 valid bits; codes have at most 32)
+            word = position >> 5
+            window = np.zeros(len(position), dtype=np.uint64)
+            for k in (word, word + 1):
+                w = np.where(k < nr_words, words.take(np.minimum(k, max(nr_words - 1, 0))), tail[np.clip(k - nr_words, 0, 1)])
+                window = (window << np.uint64(32)) | w.astype(np.uint64)
+            window <<= (position & 31).astype(np.uint64)
+
+            # canonical code: shortest length whose prefix is not smaller than the first code of that length
+            length = prefix_lengths[(window >> np.uint64(64 - prefix_bits)).astype(np.int64)]
+            for codelen in range(prefix_bits + 1, self.max_codelen + 1):
+                todo = np.flatnonzero(length == 0)
+                if len(todo) == 0:
+                    break
+                v = (window[todo] >> np.uint64(64 - codelen)).astype(np.int64)
+                length[todo[v >= min_code[codelen]]] = codelen
+
+            # no valid code (only after the end of the corpus)
+            undefined = length == 0
+            length[undefined] = self.max_codelen
+            value = (window >> (64 - length).astype(np.uint64)).astype(np.int64)
+            codes[:, token] = np.where(undefined, 0, symindex[length] + value - min_code[length])
+            position += length
+
+        return self.symbols[np.clip(codes, 0, len(self.symbols) - 1)]
+
+    def cpos2id(self, cpos):
+        """get ids of (array of) corpus positions
+
+        """
+
+        cpos = np.asarray(cpos, dtype=np.int64)
+        if not self.compressed:
+            return np.asarray(self.stream[cpos], dtype=np.int64)
+
+        flat = cpos.ravel()
+        blocks = flat // SYNCHRONIZATION
+        if len(flat) > BATCH_BLOCKS * SYNCHRONIZATION:
+            uniq, inverse = np.unique(blocks, return_inverse=True)
+            if len(uniq) >= BATCH_BLOCKS:
+                ids = self.decode_blocks(uniq)[inverse, flat - blocks * SYNCHRONIZATION]
+                return ids.reshape(cpos.shape)
+
+        # positions are grouped by block, each block is decoded once (and cached)
+        order = np.argsort(blocks, kind='stable')
+        uniq, firsts = np.unique(blocks[order], return_index=True)
+        ids = np.empty(flat.shape, dtype=np.int64)
+        for block, first, last in zip(uniq, firsts, np.append(firsts[1:], len(order))):
+            index = order[first:last]
+            ids[index] = self._block(int(block))[flat[index] - block * SYNCHRONIZATION]
+
+        return ids.reshape(cpos.shape)
+
+    def span2id(self, start, end):
+        """get ids of all corpus positions from start to end (inclusive)
+
+        """
+
+        if not self.compressed:
+            return np.asarray(self.stream[start:end + 1], dtype=np.int64)
+
+        first, last = start // SYNCHRONIZATION, end // SYNCHRONIZATION
+        if last - first + 1 >= BATCH_BLOCKS:
+            ids = self.decode_blocks(np.arange(first, last + 1)).ravel()
+        else:
+            ids = np.concatenate([self._block(block) for block in range(first, last + 1)])
+
+        return ids[start - first * SYNCHRONIZATION:end - first * SYNCHRONIZATION + 1]
+
+    def frequencies(self):
+        """corpus frequencies of all lexicon ids (`.corpus.cnt`; counted if missing)
+
+        """
+
+        if os.path.exists(self.path + ".corpus.cnt"):
+            return np.asarray(_memmap(self.path + ".corpus.cnt"), dtype=np.int64)
+
+        return count_ids(self, match=np.array([0]), matchend=np.array([self.size - 1]))
+
+    def cpos2str(self, cpos):
+
+        return self.lexicon.decode(self.cpos2id(cpos))
+
+
+class StructuralStream:
+    """regions (`.rng`) and annotations (`.avx` / `.avs`) of an s-attribute
+
+    """
+
+    def __init__(self, home, s):
+
+        self.s = s
+        path = os.path.join(home, s)
+        regions = _memmap(path + ".rng").reshape(-1, 2)
+        self.starts = np.asarray(regions[:, 0], dtype=np.int64)
+        self.ends = np.asarray(regions[:, 1], dtype=np.int64)
+
+        self.has_values = os.path.exists(path + ".avs")
+        if self.has_values:
+            avx = _memmap(path + ".avx").reshape(-1, 2)
+            self._offsets = np.asarray(avx[:, 1], dtype=np.int64)
+            self._avs = _memmap(path + ".avs", dtype='u1')
+            self._cache = BlockCache(2**16)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def cpos2struc(self, cpos):
+        """get region numbers of (array of) corpus positions; -1 if outside of any region
+
+        """
+
+        cpos = np.asarray(cpos, dtype=np.int64)
+        if len(self.starts) == 0:
+            return np.full(cpos.shape, -1, dtype=np.int64)
+        struc = np.searchsorted(self.starts, cpos, side='right') - 1
+        inside = (struc >= 0) & (cpos <= self.ends[np.clip(struc, 0, None)])
+
+        return np.where(inside, struc, -1)
+
+    def struc2str(self, struc):
+        """get annotations of (array of) region numbers; None outside of regions
+
+        """
+
+        struc = np.asarray(struc, dtype=np.int64)
+        if not self.has_values:
+            raise ValueError(f"s-attribute '{self.s}' does not have annotations")
+
+        uniq, inverse = np.unique(struc, return_inverse=True)
+        values = list()
+        for s in uniq.tolist():
+            if s < 0:
+                values.append(None)
+                continue
+            value = self._cache.get(s)
+            if value is None:
+                start = int(self._offsets[s])
+                end = start
+                while self._avs[end] != 0:
+                    end += 1
+                value = bytes(self._avs[start:end]).decode('utf-8', errors='replace')
+                self._cache.put(s, value)
+            values.append(value)
+        values = np.array(values, dtype=object)
+
+        return values[inverse.reshape(struc.shape)]
+
+    def cpos2str(self, cpos):
+
+        return self.struc2str(self.cpos2struc(cpos))
+
+
+class CorpusStreams:
+    """lazily opened streams of all attributes of one corpus
+
+    """
+
+    def __init__(self, cwb_id, registry_dir):
+
+        self.cwb_id = cwb_id
+        self.home = registry_home(cwb_id, registry_dir)
+        self._p = dict()
+        self._s = dict()
+        self._lock = Lock()
+
+    def p(self, p):
+        with self._lock:
+            if p not in self._p:
+                self._p[p] = PositionalStream(self.home, p)
+            return self._p[p]
+
+    def s(self, s):
+        with self._lock:
+            if s not in self._s:
+                self._s[s] = StructuralStream(self.home, s)
+            return self._s[s]
+
+
+
+@lru_cache(maxsize=64)
+def corpus_streams(cwb_id, registry_dir):
+    """process-wide access point to the data files of a corpus
+
+    """
+
+    return CorpusStreams(cwb_id, registry_dir)
+
+
+def split_spans(match, matchend, size):
+    """cut spans into consecutive pieces of at most size tokens
+
+    """
+
+    match = np.asarray(match, dtype=np.int64)
+    matchend = np.asarray(matchend, dtype=np.int64)
+    pieces = (matchend - match + size) // size
+    offsets = np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    starts = np.repeat(match, pieces) + size * offsets
+    ends = np.minimum(starts + size - 1, np.repeat(matchend, pieces))
+
+    return starts, ends
+
+
+def _count(inputs, first, last):
+    """frequencies of lexicon ids at cpos[first:last] or in spans starts[first:last] .. ends[first:last] (sparse)
+
+    """
+
+    stream, cpos, starts, ends = inputs
+    if cpos is not None:
+        ids = stream.cpos2id(cpos[first:last])
+    elif stream.compressed:
+        # all positions of the shard at once: its huffman blocks are decoded together
+        lengths = ends[first:last] - starts[first:last] + 1
+        ids = stream.cpos2id(np.repeat(starts[first:last] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum()))
+    else:
+        ids = np.concatenate([stream.span2id(int(start), int(end)) for start, end in zip(starts[first:last], ends[first:last])])
+    counts = np.bincount(ids, minlength=len(stream.lexicon))
+    ids = np.flatnonzero(counts)
+
+    return ids, counts[ids]
+
+
+def count_ids(stream, cpos=None, match=None, matchend=None, workers=1, shard_size=SHARD_SIZE):
+    """frequencies of lexicon ids of a p-attribute at corpus positions (cpos) or in spans (match .. matchend)
+    - positions are counted in shards of about shard_size tokens, by several threads if workers > 1
+    - the counts of the shards are added up
+
+    returns array of frequencies of all lexicon ids
+    """
+
+    if cpos is not None:
+        # sorted positions: huffman blocks are decoded once per shard
+        cpos = np.sort(np.asarray(cpos, dtype=np.int64).ravel())
+        starts = ends = None
+        firsts = np.arange(0, len(cpos), shard_size)
+        lasts = np.minimum(firsts + shard_size, len(cpos))
+    else:
+        starts, ends = split_spans(match, matchend, shard_size)
+        lengths = ends - starts + 1
+        shard = (np.cumsum(lengths) - lengths) // shard_size
+        firsts = np.flatnonzero(np.diff(shard, prepend=-1))
+        lasts = np.append(firsts[1:], len(starts))
+
+    inputs = (stream, cpos, starts, ends)
+    counts = np.zeros(len(stream.lexicon), dtype=np.int64)
+    if workers > 1 and len(firsts) > 1:
+        with ThreadPoolExecutor(min(workers, len(firsts)), thread_name_prefix='count') as pool:
+            for ids, freq in pool.map(_count, repeat(inputs), firsts, lasts):
+                counts[ids] += freq
+    else:
+        for first, last in zip(firsts, lasts):
+            ids, freq = _count(inputs, first, last)
+            counts[ids] += freq
+
+    return counts
@@ -1,20 +1,69 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import fcntl
+import os
+from contextlib import contextmanager
 from datetime import datetime
+from hashlib import sha1
+from threading import local
 
 from ccc import Corpus as Crps
 from flask import Blueprint, current_app
 from flask_login import UserMixin
 from numpy import log
 from pandas import DataFrame
-from sqlalchemy import text
+from sqlalchemy import inspect, text
 from werkzeug.security import generate_password_hash
 
 from . import db
 
 bp = Blueprint('database', __name__, url_prefix='/database', cli_group='database')
 
+# keys of single-flight locks held by current thread
+_flights = local()
+
+
+def lock_dir():
+
+    directory = current_app.config.get('LOCK_DIR')
+    return directory if directory else os.path.join(current_app.instance_path, 'locks')
+
+
+@contextmanager
+def single_flight(*key):
+    """serialise identical computations across threads and worker processes (via file locks)
+
+    key: name of computation and its canonical parameters, e.g. ('matches', query.id)
+    yields True if another computation with the same key had to be awaited;
+    callers thus have to check for existing results (again) after entering.
+
+    locks are re-entrant within a thread and released if a process dies.
+    """
+
+    name = "|".join(str(k) for k in key)
+    held = _flights.__dict__.setdefault('keys', set())
+    if name in held:
+        yield False
+        return
+
+    directory = lock_dir()
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, sha1(name.encode()).hexdigest() + '.lock'), 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            waited = False
+        except BlockingIOError:
+            current_app.logger.debug(f'single_flight :: waiting for {name}')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            waited = True
+        held.add(name)
+        try:
+            yield waited
+        finally:
+            held.discard(name)
+            fcntl.flock(f, fcntl.LOCK_UN)
+
 
 def get_or_create(model, **kwargs):
     """
@@ -23,9 +72,13 @@ def get_or_create(model, **kwargs):
     instance = model.query.filter_by(**kwargs).first()
 
     if not instance:
-        instance = model(**kwargs)
-        db.session.add(instance)
-        db.session.commit()
+        key = sorted((k, v) for k, v in kwargs.items())
+        with single_flight(model.__tablename__, *key):
+            instance = model.query.filter_by(**kwargs).first()
+            if not instance:
+                instance = model(**kwargs)
+                db.session.add(instance)
+                db.session.commit()
 
     return instance
 
@@ -52,6 +105,34 @@ def init_db():
     db.session.commit()
 
 
+def migrate_db():
+    """add columns and indexes that are missing in existing tables
+
+    """
+
+    # workers starting at the same time must not add columns twice
+    with single_flight('migrate_db'):
+        inspector = inspect(db.engine)
+        existing_tables = inspector.get_table_names()
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                statement = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(dialect=db.engine.dialect)}'
+                if column.default is not None and column.default.is_scalar:
+                    statement += f' DEFAULT {int(column.default.arg) if isinstance(column.default.arg, bool) else repr(column.default.arg)}'
+                current_app.logger.info(f'migrate_db :: {statement}')
+                with db.engine.begin() as connection:
+                    connection.execute(text(statement))
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(db.engine)
+
+
 users_roles = db.Table(
     'users_roles',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
@@ -351,7 +432,11 @@ class Query(db.Model):
     s = db.Column(db.Unicode)   # should be segmentation_id
 
     nqr_cqp = db.Column(db.Unicode)  # resulting NQR in CWB
-    random_seed = db.Column(db.Integer, default=42)  # for concordancing
+    random_seed = db.Column(db.Integer, default=42)  # for concordancing and sampling
+
+    exact = db.Column(db.Boolean, default=False)  # never sample matches
+    sampled = db.Column(db.Boolean, default=False)  # only a random sample of matches is stored
+    nr_matches_total = db.Column(db.Integer)  # number of matches before sampling
 
     matches = db.relationship('Matches', backref='_query', passive_deletes=True, cascade='all, delete')
     breakdowns = db.relationship('Breakdown', backref='_query', passive_deletes=True, cascade='all, delete')
@@ -370,6 +455,16 @@ class Query(db.Model):
     def corpus_name(self):
         return self.corpus.name
 
+    @property
+    def sample_factor(self):
+        """factor from stored (sampled) matches to all matches
+
+        """
+        number_matches = self.number_matches if self.sampled else 0
+        if number_matches == 0:
+            return 1
+        return self.nr_matches_total / number_matches
+
     def get_breakdown(self, p):
 
         breakdowns = [b for b in self.breakdowns if b.p == p]
@@ -577,6 +672,8 @@ class Collocation(db.Model):
 
     semantic_map_id = db.Column(db.Integer, db.ForeignKey('semantic_map.id', ondelete='CASCADE'))
 
+    sample_factor = db.Column(db.Float)  # counts on sampled matches are scaled by this factor for scoring
+
     items = db.relationship('CollocationItem', backref='collocation', passive_deletes=True, cascade='all, delete')
 
     measure_ranges = dict()
@@ -592,6 +689,10 @@ class Collocation(db.Model):
     def corpus(self):
         return self._query.corpus
 
+    @property
+    def sampled(self):
+        return self.sample_factor is not None
+
     def get_measure_range(self, measure):
 
         if measure not in self.measure_ranges.keys():
@@ -941,9 +1042,53 @@ class KeywordItemScore(db.Model):
     score = db.Column(db.Float)
 
 
+# JOBS #
+########
+class Job(db.Model):
+    """Background job (request to a heavy endpoint that is processed by a worker, see jobs.py)
+
+    """
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer(), db.ForeignKey('user.id', ondelete='CASCADE'), index=True)
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+    modified = db.Column(db.DateTime, default=datetime.utcnow)
+
+    name = db.Column(db.Unicode)  # registered function
+    endpoint = db.Column(db.Unicode)
+    path = db.Column(db.Unicode)
+    arguments = db.Column(db.Unicode)  # JSON
+
+    request_id = db.Column(db.Unicode, index=True)  # X-Request-ID of synchronous requests
+    state = db.Column(db.Unicode, default='queued', index=True)  # queued, running, finished, failed, cancelled
+    stage = db.Column(db.Unicode)
+    done = db.Column(db.Integer)
+    total = db.Column(db.Integer)
+    progress = db.Column(db.Float, default=0)
+    timeout = db.Column(db.Integer)  # seconds
+    cancel_requested = db.Column(db.Boolean, default=False)
+
+    worker = db.Column(db.Unicode)  # host:pid
+    heartbeat = db.Column(db.DateTime)
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+
+    status_code = db.Column(db.Integer)
+    result = db.Column(db.Unicode)  # JSON
+    error = db.Column(db.Unicode)
+
+
 # CLI #
 #######
 @bp.cli.command('init')
 def init_db_cmd():
 
     init_db()
+
+
+@bp.cli.command('migrate')
+def migrate_db_cmd():
+
+    migrate_db()
@@ -0,0 +1,876 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""process-wide registry of word embeddings
+
+Each embeddings file is converted once into a float32 `.npy` matrix of
+L2-normalised vectors plus its vocabulary. The matrix is memory-mapped, so
+that all workers share the same pages, and items are looked up via a hash
+index. Semantic spaces built from the registry therefore neither re-read
+the embeddings nor load the sentence-transformers model; the latter is
+only needed for items that are not in the vocabulary, whose vectors are
+encoded once and kept in an on-disk phrase cache.
+
+"""
+
+import json
+import os
+import sqlite3
+from functools import lru_cache
+from glob import glob
+from hashlib import sha1
+from threading import Lock
+from time import perf_counter
+
+import numpy as np
+from flask import current_app
+from pandas import DataFrame, concat
+from semmap import SemanticSpace
+
+# offset of the vector in an annoy node (in 4-byte words) per metric
+ANNOY_VECTOR_OFFSET = {
+    'angular': 3,               # n_descendants, children[2]
+    'euclidean': 4,             # n_descendants, a, children[2]
+    'manhattan': 4,             # n_descendants, a, children[2]
+    'dot': 4                    # n_descendants, children[2], dot_factor
+}
+
+# items per batch when encoding items that are not in the vocabulary
+ENCODE_BATCH_SIZE = 64
+
+_conversion_lock = Lock()
+
+
+def read_semmap(path):
+    """read vocabulary and vectors of a semmap database (JSON settings, annoy index, sqlite vocabulary)
+
+    """
+
+    with open(path, "rt") as f:
+        settings = json.load(f)
+
+    with sqlite3.connect(settings['path_db']) as con:
+        rows = con.execute("SELECT index_id, item FROM items ORDER BY index_id").fetchall()
+    index_ids = np.array([r[0] for r in rows], dtype=np.int64)
+    vocabulary = [r[1] for r in rows]
+
+    dim = settings['dim']
+    offset = ANNOY_VECTOR_OFFSET[settings.get('metric', 'angular')]
+    nodes = np.fromfile(settings['path_annoy'], dtype='<f4')
+    nodes = nodes[:len(nodes) - len(nodes) % (offset + dim)].reshape(-1, offset + dim)
+    vectors = np.ascontiguousarray(nodes[index_ids, offset:])
+
+    return vocabulary, vectors
+
+
+def normalise(vectors):
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return (vectors / norms).astype(np.float32)
+
+
+def embeddings_key(path):
+    """identifies an embeddings file and its version
+
+    """
+
+    stat = os.stat(path)
+    return sha1(f"{os.path.realpath(path)}:{stat.st_mtime_ns}:{stat.st_size}".encode()).hexdigest()[:16]
+
+
+def convert_embeddings(path, directory):
+    """convert embeddings to normalised float32 matrix (.npy) + vocabulary (.json); done once per file
+
+    """
+
+    key = embeddings_key(path)
+    path_vectors = os.path.join(directory, f"{key}.npy")
+    path_vocabulary = os.path.join(directory, f"{key}.json")
+
+    with _conversion_lock:
+        if os.path.exists(path_vectors) and os.path.exists(path_vocabulary):
+            return path_vectors, path_vocabulary
+
+        if not path.endswith('.semmap'):
+            raise ValueError(f"cannot convert embeddings {path}: unsupported format")
+
+        os.makedirs(directory, exist_ok=True)
+        vocabulary, vectors = read_semmap(path)
+
+        # write to temporary files first so that concurrent workers never see partial files
+        tmp_vectors = f"{path_vectors}.{os.getpid()}.tmp"
+        tmp_vocabulary = f"{path_vocabulary}.{os.getpid()}.tmp"
+        with open(tmp_vectors, "wb") as f:
+            np.save(f, normalise(vectors))
+        with open(tmp_vocabulary, "wt") as f:
+            json.dump({'path': path, 'vocabulary': vocabulary}, f)
+        os.replace(tmp_vectors, path_vectors)
+        os.replace(tmp_vocabulary, path_vocabulary)
+
+    return path_vectors, path_vocabulary
+
+
+class EmbeddingStore:
+    """memory-mapped, normalised vectors with hash index of vocabulary
+
+    """
+
+    def __init__(self, path_vectors, path_vocabulary):
+
+        self.vectors = np.load(path_vectors, mmap_mode='r')
+        self.key = os.path.basename(path_vectors)[:-len('.npy')]
+        self.path_ann = path_vectors[:-len('.npy')] + '.ivf.npz'
+        self._ann = None
+        self._layouts = dict()
+        with open(path_vocabulary, "rt") as f:
+            converted = json.load(f)
+        self.path = converted['path']
+        self.vocabulary = converted['vocabulary']
+        self.index = {item: i for i, item in enumerate(self.vocabulary)}
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    @property
+    def settings(self):
+
+        with open(self.path, "rt") as f:
+            return json.load(f)
+
+    def __contains__(self, item):
+        return item in self.index
+
+    def missing(self, items):
+
+        return [item for item in items if item not in self.index]
+
+    def rows(self, items):
+
+        return np.array([self.index[item] for item in items], dtype=np.int64)
+
+    def get(self, items):
+        """normalised vectors of (known) items
+
+        """
+
+        return DataFrame(np.asarray(self.vectors[self.rows(items)]), index=list(items))
+
+    @property
+    def ann(self):
+        """approximate nearest neighbour index, if it has been built
+
+        """
+
+        if self._ann is None and os.path.exists(self.path_ann):
+            self._ann = IVFIndex.load(self.path_ann)
+        return self._ann
+
+    def path_layout(self, method):
+
+        return self.path_ann[:-len('.ivf.npz')] + f'.layout-{method}.npz'
+
+    def global_layout(self, method):
+        """global 2d layout for method, if it has been built
+
+        """
+
+        if method not in self._layouts and os.path.exists(self.path_layout(method)):
+            self._layouts[method] = GlobalLayout.load(self.path_layout(method))
+        return self._layouts.get(method)
+
+    def centroid(self, positive):
+
+        return normalise(np.asarray(self.vectors[self.rows(positive)]).mean(axis=0, keepdims=True))[0]
+
+    def exact(self, vector, n):
+
+        similarity = np.asarray(self.vectors) @ vector
+        top = top_n(similarity, n)
+
+        return top, similarity[top]
+
+    def most_similar(self, positive, n=10, nprobe=0):
+        """items closest to the centroid of positive items (cosine similarity)
+
+        - nprobe > 0: search the nprobe closest lists of the ANN index (if built)
+        - nprobe = 0: exact search
+
+        """
+
+        return self.nearest(self.centroid(positive), n=n, nprobe=nprobe)
+
+    def nearest(self, vector, n=10, nprobe=0):
+        """vocabulary items closest to (normalised) vector
+
+        """
+
+        result = None
+        if nprobe and self.ann is not None:
+            result = self.ann.search(self.vectors, vector, n, nprobe)
+        if result is None:
+            result = self.exact(vector, n)
+        rows, similarity = result
+
+        similar = DataFrame({
+            'item': [self.vocabulary[i] for i in rows],
+            'similarity': similarity
+        }).set_index('item')
+
+        return similar
+
+
+def top_n(values, n):
+    """indices of the n largest values, sorted descendingly
+
+    """
+
+    n = min(n, len(values))
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-values, n - 1)[:n]
+
+    return top[np.argsort(-values[top], kind='stable')]
+
+
+class IVFIndex:
+    """inverted file index for cosine similarity
+
+    vectors are bucketed by their closest centroid (spherical k-means);
+    queries only score the vectors in the nprobe closest buckets
+
+    """
+
+    def __init__(self, centroids, order, offsets):
+
+        self.centroids = centroids  # nlist × dim
+        self.order = order          # rows sorted by bucket
+        self.offsets = offsets      # start of each bucket in order (+ end)
+
+    def __len__(self):
+        return len(self.centroids)
+
+    @staticmethod
+    def assign(vectors, centroids, batch_size=2**14):
+
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), batch_size):
+            batch = np.asarray(vectors[start:start + batch_size])
+            assignment[start:start + batch_size] = np.argmax(batch @ centroids.T, axis=1)
+
+        return assignment
+
+    @classmethod
+    def build(cls, vectors, nlist=None, iterations=10, sample_size=256, seed=42):
+        """train centroids on a sample of (at most sample_size per bucket) vectors, then assign all vectors
+
+        """
+
+        nr_vectors = len(vectors)
+        nlist = min(nlist if nlist else max(1, int(np.sqrt(nr_vectors))), nr_vectors)
+        rng = np.random.default_rng(seed)
+
+        sample = np.sort(rng.choice(nr_vectors, min(nr_vectors, sample_size * nlist), replace=False))
+        sample = np.asarray(vectors[sample])
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(assignment, kind='stable')
+            buckets, starts = np.unique(assignment[order], return_index=True)
+            centroids = centroids.copy()
+            centroids[buckets] = normalise(np.add.reduceat(sample[order], starts, axis=0))
+
+        assignment = cls.assign(vectors, centroids)
+        order = np.argsort(assignment, kind='stable').astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))]).astype(np.int64)
+
+        return cls(centroids.astype(np.float32), order, offsets)
+
+    def search(self, vectors, vector, n, nprobe):
+        """approximate top n; None if the probed buckets hold less than n vectors
+
+        """
+
+        buckets = top_n(self.centroids @ vector, nprobe)
+        candidates = np.sort(np.concatenate([self.order[self.offsets[b]:self.offsets[b + 1]] for b in buckets]))
+        if len(candidates) < n:
+            return None
+
+        similarity = np.asarray(vectors[candidates]) @ vector
+        top = top_n(similarity, n)
+
+        return candidates[top], similarity[top]
+
+    def save(self, path):
+
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, centroids=self.centroids, order=self.order, offsets=self.offsets)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+
+        with np.load(path) as data:
+            return cls(data['centroids'], data['order'], data['offsets'])
+
+
+def build_index(store, nlist=None, iterations=10):
+    """build and persist ANN index of embeddings
+
+    """
+
+    index = IVFIndex.build(store.vectors, nlist=nlist, iterations=iterations)
+    index.save(store.path_ann)
+    store._ann = index
+
+    return index
+
+
+def benchmark(store, k=10, nprobe=32, nr_queries=100, seed=42):
+    """recall@k and average latency of ANN search vs. exact search on random vocabulary items
+
+    """
+
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(len(store), min(nr_queries, len(store)), replace=False)
+
+    recall, time_exact, time_ann = list(), 0, 0
+    for row in queries:
+        vector = np.asarray(store.vectors[row])
+        start = perf_counter()
+        exact, _ = store.exact(vector, k)
+        time_exact += perf_counter() - start
+        start = perf_counter()
+        result = store.ann.search(store.vectors, vector, k, nprobe)
+        time_ann += perf_counter() - start
+        approximate = exact if result is None else result[0]
+        recall.append(len(set(exact) & set(approximate)) / len(exact))
+
+    return {
+        'recall': float(np.mean(recall)),
+        'ms_exact': 1000 * time_exact / len(queries),
+        'ms_ann': 1000 * time_ann / len(queries)
+    }
+
+
+def embeddings_dir():
+
+    directory = current_app.config.get('EMBEDDINGS_DIR')
+    return directory if directory else os.path.join(current_app.instance_path, 'embeddings')
+
+
+@lru_cache(maxsize=16)
+def _embedding_store(path, key, directory):
+
+    return EmbeddingStore(*convert_embeddings(path, directory))
+
+
+def embedding_store(path):
+    """process-wide access point to embeddings; None if they cannot be converted
+
+    """
+
+    try:
+        return _embedding_store(path, embeddings_key(path), embeddings_dir())
+    except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+        current_app.logger.warning(f"embedding_store :: cannot use registry for {path}: {e}")
+        return None
+
+
+class PhraseCache:
+    """on-disk cache of vectors of items that are not in the vocabulary: (embeddings, item) → float32 vector
+
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("CREATE TABLE IF NOT EXISTS vectors (embeddings TEXT, item TEXT, vector BLOB, PRIMARY KEY (embeddings, item))")
+
+    def _connect(self):
+
+        return sqlite3.connect(self.path, timeout=60)
+
+    def get(self, embeddings, items):
+
+        vectors = dict()
+        with self._connect() as con:
+            for start in range(0, len(items), 500):
+                chunk = items[start:start + 500]
+                rows = con.execute(
+                    f"SELECT item, vector FROM vectors WHERE embeddings = ? AND item IN ({', '.join('?' * len(chunk))})",
+                    [embeddings] + chunk
+                ).fetchall()
+                vectors.update({item: np.frombuffer(vector, dtype=np.float32) for item, vector in rows})
+
+        return vectors
+
+    def put(self, embeddings, vectors):
+
+        with self._connect() as con:
+            con.executemany("INSERT OR REPLACE INTO vectors VALUES (?, ?, ?)",
+                            [(embeddings, item, vector.astype(np.float32).tobytes()) for item, vector in vectors.items()])
+
+
+@lru_cache(maxsize=4)
+def _phrase_cache(path):
+
+    return PhraseCache(path)
+
+
+def phrase_cache():
+
+    return _phrase_cache(os.path.join(embeddings_dir(), 'phrases.sqlite'))
+
+
+@lru_cache(maxsize=2)
+def sentence_encoder(model_name):
+
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+
+def encode(store, items):
+    """vectors of items that are not in the vocabulary
+
+    - encoded in batches by the sentence-transformers model of the embeddings
+    - or, without model: composed (mean of normalised word vectors) if all words are in the vocabulary
+
+    """
+
+    try:
+        model_name = store.settings['model_name']
+        vectors = sentence_encoder(model_name).encode(items, batch_size=ENCODE_BATCH_SIZE, convert_to_numpy=True)
+        return dict(zip(items, normalise(np.asarray(vectors, dtype=np.float32))))
+    except (ImportError, OSError, KeyError, ValueError, RuntimeError) as e:
+        current_app.logger.warning(f"encode :: cannot encode items, composing vectors instead: {e}")
+
+    vectors = dict()
+    for item in items:
+        words = item.split(" ")
+        if all(word in store for word in words):
+            vectors[item] = store.centroid(words)
+
+    return vectors
+
+
+def item_vectors(store, items):
+    """normalised vectors of items (index: item); None if not all of them can be provided
+
+    items outside of the vocabulary are encoded once and then taken from the phrase cache
+
+    """
+
+    items = list(dict.fromkeys(items))
+    missing = store.missing(items)
+    if len(missing) == 0:
+        return store.get(items)
+
+    cache = phrase_cache()
+    vectors = cache.get(store.key, missing)
+    new = [item for item in missing if item not in vectors]
+    if len(new) > 0:
+        current_app.logger.debug(f'item_vectors :: encoding {len(new)} items')
+        encoded = encode(store, new)
+        cache.put(store.key, encoded)
+        vectors.update(encoded)
+        if len(encoded) < len(new):
+            return None
+
+    matrix = np.empty((len(items), store.vectors.shape[1]), dtype=np.float32)
+    known = [i for i, item in enumerate(items) if item in store]
+    matrix[known] = store.vectors[store.rows([items[i] for i in known])]
+    for i, item in enumerate(items):
+        if item not in store:
+            matrix[i] = vectors[item]
+
+    return DataFrame(matrix, index=items)
+
+
+def layout(vectors, method='tsne', parameters=None, init=None):
+    """project vectors to 2d; init: initial 2d positions (warm start)
+
+    """
+
+    parameters = dict() if parameters is None else dict(parameters)
+    if init is not None:
+        # small initial scale as for sklearn's PCA initialisation
+        parameters['init'] = (init - init.mean(axis=0)) / max(np.std(init[:, 0]), 1e-12) * 1e-4
+
+    if method == 'tsne':
+        from sklearn.manifold import TSNE
+        parameters = {
+            'perplexity': min(30, max(len(vectors) - 1, 1)),
+            'init': 'pca',
+            'random_state': 42,
+            **parameters
+        }
+        coordinates = TSNE(n_components=2, **parameters).fit_transform(vectors.values)
+
+    elif method == 'umap':
+        from umap import UMAP
+        parameters = {
+            'n_neighbors': min(15, max(len(vectors) - 1, 2)),
+            'metric': 'cosine',
+            'random_state': 42,
+            **parameters
+        }
+        coordinates = UMAP(n_components=2, **parameters).fit_transform(vectors.values)
+
+    else:
+        raise ValueError(f"unknown method {method}")
+
+    return DataFrame(coordinates, index=vectors.index, columns=['x', 'y'])
+
+
+def knn_project(vectors, anchor_vectors, anchor_xy, k=10, batch_size=256):
+    """place vectors at the similarity-weighted mean of the 2d positions of their k nearest anchors
+
+    """
+
+    k = min(k, len(anchor_vectors))
+    xy = np.empty((len(vectors), 2))
+    for start in range(0, len(vectors), batch_size):
+        neighbours = np.asarray(vectors[start:start + batch_size]) @ anchor_vectors.T
+        top = np.argpartition(-neighbours, k - 1, axis=1)[:, :k]
+        weights = np.take_along_axis(neighbours, top, axis=1).clip(min=1e-6)
+        xy[start:start + batch_size] = (anchor_xy[top] * weights[:, :, None]).sum(axis=1) / weights.sum(axis=1, keepdims=True)
+
+    return xy
+
+
+def project(store, coordinates, items, k=10):
+    """place new items at the similarity-weighted mean of their nearest neighbours on the map; None without vectors
+
+    """
+
+    items = list(items)
+    vectors = item_vectors(store, items + list(coordinates.index))
+    if vectors is None:
+        return None
+    xy = knn_project(vectors.loc[items].values, vectors.loc[coordinates.index].values, coordinates[['x', 'y']].values, k)
+
+    return DataFrame(xy, index=items, columns=['x', 'y'])
+
+
+class GlobalLayout:
+    """2d layout of the top vocabulary of an embedding space
+
+    items outside of the layout are projected out-of-sample via their
+    nearest neighbours in the layout
+
+    """
+
+    def __init__(self, rows, xy):
+
+        self.rows = rows        # rows of laid out items in embedding matrix
+        self.xy = xy            # their coordinates
+        self._position = {row: i for i, row in enumerate(rows.tolist())}
+
+    def __len__(self):
+        return len(self.rows)
+
+    @classmethod
+    def build(cls, store, method='tsne', n=20000, parameters=None):
+
+        rows = np.arange(min(n, len(store)), dtype=np.int64)
+        vectors = DataFrame(np.asarray(store.vectors[rows]))
+
+        return cls(rows, layout(vectors, method=method, parameters=parameters).values)
+
+    def get(self, store, items):
+
+        rows = store.rows(items)
+        position = np.array([self._position.get(row, -1) for row in rows.tolist()], dtype=np.int64)
+        xy = np.empty((len(rows), 2))
+        inside = position >= 0
+        xy[inside] = self.xy[position[inside]]
+        if not inside.all():
+            xy[~inside] = knn_project(store.vectors[rows[~inside]], np.asarray(store.vectors[self.rows]), self.xy)
+
+        return DataFrame(xy, index=list(items), columns=['x', 'y'])
+
+    def project(self, store, vectors):
+        """out-of-sample projection of (normalised) vectors
+
+        """
+
+        return knn_project(vectors, np.asarray(store.vectors[self.rows]), self.xy)
+
+    def save(self, path):
+
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, rows=self.rows, xy=self.xy)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+
+        with np.load(path) as data:
+            return cls(data['rows'], data['xy'])
+
+
+def build_global_layout(store, method='tsne', n=20000, parameters=None):
+    """compute and persist global layout of the n first (most frequent) items of the vocabulary
+
+    """
+
+    global_layout = GlobalLayout.build(store, method=method, n=n, parameters=parameters)
+    global_layout.save(store.path_layout(method))
+    store._layouts[method] = global_layout
+
+    return global_layout
+
+
+def global_layout(store, method):
+    """global layout of embedding space, if enabled (SEMANTIC_MAP_GLOBAL_LAYOUT) and built
+
+    """
+
+    if store is None or not current_app.config.get('SEMANTIC_MAP_GLOBAL_LAYOUT', False):
+        return None
+
+    return store.global_layout(method)
+
+
+class LayoutCache:
+    """content-addressed cache of computed layouts with size budget
+
+    layouts are identified by embeddings, method, parameters and the
+    (sorted) item set; they are stored as files so that all workers share
+    them and are evicted least recently used first
+
+    """
+
+    def __init__(self, directory, max_bytes):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._items = dict()    # path → item set (of cached layouts)
+        self._lock = Lock()
+
+    @staticmethod
+    def prefix(embeddings, method, parameters):
+
+        settings = json.dumps([embeddings_key(embeddings), method, parameters], sort_keys=True, default=str)
+        return sha1(settings.encode()).hexdigest()[:16]
+
+    def path(self, prefix, items):
+
+        item_hash = sha1("\n".join(sorted(set(items))).encode()).hexdigest()[:24]
+        return os.path.join(self.directory, f"{prefix}-{item_hash}.npz")
+
+    def _load(self, path):
+
+        with np.load(path) as data:
+            return DataFrame(data['xy'], index=data['items'].tolist(), columns=['x', 'y'])
+
+    def get(self, prefix, items):
+
+        path = self.path(prefix, items)
+        try:
+            coordinates = self._load(path)
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return coordinates.loc[[item for item in items if item in coordinates.index]]
+
+    def put(self, prefix, items, coordinates):
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(prefix, items)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, items=np.array(coordinates.index, dtype=str), xy=coordinates[['x', 'y']].values)
+        os.replace(tmp, path)
+        with self._lock:
+            self._items[path] = frozenset(coordinates.index)
+        self.evict()
+
+    def most_similar(self, prefix, items, threshold):
+        """cached layout (same embeddings, method and parameters) sharing most items; None if overlap < threshold
+
+        """
+
+        items = set(items)
+        best, best_overlap = None, 0
+        paths = glob(os.path.join(self.directory, f"{prefix}-*.npz"))
+        for path in paths:
+            with self._lock:
+                cached = self._items.get(path)
+            if cached is None:
+                try:
+                    cached = frozenset(self._load(path).index)
+                except (OSError, ValueError, KeyError):
+                    continue
+                with self._lock:
+                    self._items[path] = cached
+            overlap = len(items & cached) / len(items)
+            if overlap > best_overlap:
+                best, best_overlap = path, overlap
+
+        if best is None or best_overlap < threshold:
+            return None
+        try:
+            return self._load(best)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def evict(self):
+
+        files = list()
+        for path in glob(os.path.join(self.directory, "*.npz")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            with self._lock:
+                self._items.pop(path, None)
+            total -= size
+
+
+@lru_cache(maxsize=4)
+def _layout_cache(directory, max_bytes):
+
+    return LayoutCache(directory, max_bytes)
+
+
+def layout_cache():
+
+    return _layout_cache(os.path.join(embeddings_dir(), 'layouts'),
+                         current_app.config.get('SEMANTIC_MAP_LAYOUT_CACHE_BYTES', 512 * 1024**2))
+
+
+def warm_start(store, cached, items):
+    """initial positions of items: cached coordinates or projection via nearest cached neighbours
+
+    """
+
+    init = project(store, cached, items)
+    if init is None:
+        return None
+    init = init.values
+    shared = [i for i, item in enumerate(items) if item in cached.index]
+    init[shared] = cached.loc[[items[i] for i in shared], ['x', 'y']].values
+
+    return init
+
+
+def generate2d(embeddings, items, method='tsne', parameters=None):
+    """create coordinates for items; uses the registry if vectors of all items can be provided
+
+    - with global layout: coordinates are sliced from the layout (items
+      outside of it are projected)
+    - otherwise: new layout of items, cached per item set; warm start from
+      the cached layout of the most similar item set (if the overlap is
+      at least SEMANTIC_MAP_WARM_START_OVERLAP)
+
+    """
+
+    store = embedding_store(embeddings)
+    items = list(items)
+
+    layout_global = global_layout(store, method)
+    if layout_global is not None:
+        known = [item for item in items if item in store]
+        missing = store.missing(items)
+        vectors = item_vectors(store, missing) if len(missing) > 0 else None
+        if len(missing) == 0 or vectors is not None:
+            current_app.logger.debug(f'generate2d :: {len(items)} items from global layout')
+            coordinates = layout_global.get(store, known)
+            if len(missing) > 0:
+                coordinates = concat([coordinates, DataFrame(layout_global.project(store, vectors.values),
+                                                             index=missing, columns=['x', 'y'])])
+            return coordinates
+
+    cache = layout_cache()
+    prefix = cache.prefix(embeddings, method, parameters)
+    coordinates = cache.get(prefix, items)
+    if coordinates is not None:
+        current_app.logger.debug(f'generate2d :: {len(items)} items from layout cache')
+        return coordinates
+
+    vectors = item_vectors(store, items) if store is not None and len(items) > 2 else None
+    if vectors is not None:
+        current_app.logger.debug(f'generate2d :: {len(items)} items from embedding registry')
+        init = None
+        cached = cache.most_similar(prefix, items, current_app.config.get('SEMANTIC_MAP_WARM_START_OVERLAP', .5))
+        if cached is not None:
+            current_app.logger.debug('generate2d :: warm start from cached layout')
+            init = warm_start(store, cached, items)
+        coordinates = layout(vectors, method=method, parameters=parameters, init=init)
+
+    else:
+        current_app.logger.debug('generate2d :: falling back to semantic space')
+        semspace = SemanticSpace(embeddings, normalise=True)
+        coordinates = semspace.generate2d(items, method=method, parameters=parameters)
+
+    cache.put(prefix, items, coordinates)
+
+    return coordinates
+
+
+def add2d(embeddings, coordinates, items, method='tsne'):
+    """create coordinates for new items on existing map; uses the registry if vectors of all items can be provided
+
+    new items of maps taken from the global layout are taken from there as well
+
+    """
+
+    store = embedding_store(embeddings)
+    if store is not None and len(coordinates) > 0:
+
+        layout_global = global_layout(store, method)
+        anchors = [item for item in coordinates.index if item in store]
+        if layout_global is not None and len(anchors) > 0 and not store.missing(items):
+            if np.allclose(layout_global.get(store, anchors).values, coordinates.loc[anchors, ['x', 'y']].values):
+                current_app.logger.debug(f'add2d :: {len(items)} items from global layout')
+                return layout_global.get(store, items)
+
+        new_coordinates = project(store, coordinates, items)
+        if new_coordinates is not None:
+            current_app.logger.debug(f'add2d :: {len(items)} items from embedding registry')
+            return new_coordinates
+
+    current_app.logger.debug('add2d :: falling back to semantic space')
+    semspace = SemanticSpace(embeddings, normalise=True)
+    semspace.coordinates = coordinates[['x', 'y']]
+    return semspace.add(items)
+
+
+def most_similar(embeddings, positive, n=10, nprobe=None):
+    """items most similar to positive ones; uses the registry if vectors of all of them can be provided
+
+    nprobe trades recall for speed if there is an ANN index (default:
+    EMBEDDINGS_NPROBE, 0 = exact search)
+
+    """
+
+    store = embedding_store(embeddings)
+    vectors = item_vectors(store, positive) if store is not None and len(positive) > 0 else None
+    if vectors is not None:
+        nprobe = current_app.config.get('EMBEDDINGS_NPROBE', 0) if nprobe is None else nprobe
+        current_app.logger.debug(f'most_similar :: {len(positive)} items from embedding registry (nprobe={nprobe})')
+        vector = normalise(vectors.values.mean(axis=0, keepdims=True))[0]
+        return store.nearest(vector, n=n, nprobe=nprobe)
+
+    semspace = SemanticSpace(embeddings)
+    return semspace.most_similar(positive=positive, n=n)
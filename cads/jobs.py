@@ -0,0 +1,807 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""background jobs for heavy endpoints
+
+endpoints decorated with @asynchronous accept `?async=true`: the request is
+stored in the job table and answered with 202; a worker pool of the same
+process later calls the view function with the stored arguments.
+synchronous requests with an `X-Request-ID` header are recorded as jobs as
+well, so that their progress can be followed (see /job/request/<id>/events).
+
+jobs and requests can be cancelled (explicitly, when the client disconnects
+from the event stream, or when their deadline has passed): the CQP processes
+they started are killed, and the pipeline raises Cancelled at the next
+checkpoint, where partially written results are removed.
+
+jobs are claimed atomically via the job table, and each process keeps
+the heartbeat of its running jobs alive. jobs of dead processes (no
+heartbeat for JOB_HEARTBEAT_TIMEOUT seconds) are queued again, so job
+state survives restarts of workers.
+
+"""
+
+import json
+import os
+import signal
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import wraps
+from threading import Event, Lock, Thread, local
+from time import monotonic, sleep
+from weakref import WeakSet
+
+from apiflask import APIBlueprint, HTTPError, Schema, abort
+from apiflask.fields import Boolean, Float, Integer, String
+from apiflask.validators import Range
+from ccc import SubCorpus
+from flask import (Response, current_app, g, jsonify, request,
+                   stream_with_context, url_for)
+from marshmallow import post_dump
+from sqlalchemy import select, update
+from werkzeug.exceptions import HTTPException
+
+from . import db
+from .database import Job, User, single_flight
+from .users import auth
+
+bp = APIBlueprint('job', __name__, url_prefix='/job')
+
+WORKER = f"{socket.gethostname()}:{os.getpid()}"
+
+# registered view functions
+_functions = dict()
+# cancellation token of current thread
+_current = local()
+# tokens of this process
+_tokens = set()
+_tokens_lock = Lock()
+_dispatcher_lock = Lock()
+
+
+class Cancelled(HTTPError):
+    """raised at checkpoints of cancelled jobs and requests
+
+    """
+
+    def __init__(self, message='request was cancelled', status_code=409):
+        super().__init__(status_code, message)
+
+
+class Token:
+    """cancellation token of a job (job_id) or a request (job_id None) with optional deadline
+
+    CQP processes started by the pipeline are registered, so that they can be killed on cancellation.
+    """
+
+    def __init__(self, job_id=None, timeout=None, background=False):
+
+        self.job_id = job_id
+        self.background = background
+        self.deadline = monotonic() + timeout if timeout else None
+        self.timeout = timeout
+        self.reason = None
+        self.checked = monotonic()
+        self.processes = WeakSet()
+        self.lock = Lock()
+
+    def register(self, cqp):
+
+        with self.lock:
+            self.processes.add(cqp)
+        if self.reason:
+            self.kill()
+
+    def cancel(self, reason):
+
+        if self.reason is None:
+            self.reason = reason
+            self.kill()
+
+    def kill(self):
+
+        with self.lock:
+            processes = list(self.processes)
+        for cqp in processes:
+            if getattr(cqp, 'CQPrunning', False):
+                # stop reading from CQP, then kill its process group
+                cqp.CQPrunning = False
+                try:
+                    os.killpg(cqp.CQP_process.pid, signal.SIGKILL)
+                except (ProcessLookupError, PermissionError, AttributeError):
+                    pass
+
+    def expired(self):
+
+        return self.deadline is not None and monotonic() > self.deadline
+
+    def check(self):
+
+        if self.reason is None and self.expired():
+            self.cancel('deadline')
+        if self.reason is None and self.job_id is not None and monotonic() - self.checked > 1:
+            self.checked = monotonic()
+            if db.session.execute(select(Job.cancel_requested).where(Job.id == self.job_id)).scalar():
+                self.cancel('cancel')
+        if self.reason == 'deadline':
+            raise Cancelled(f'deadline of {self.timeout} seconds exceeded', 408)
+        if self.reason is not None:
+            raise Cancelled()
+
+
+class Dispatcher:
+    """claims queued jobs and runs them on a thread pool; keeps heartbeats of running jobs alive
+
+    """
+
+    def __init__(self, app):
+
+        self.app = app
+        self.workers = app.config.get('JOB_WORKERS', 2)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+        self.running = set()
+        self.inline = set()     # synchronous requests recorded as jobs
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.thread = Thread(target=self.loop, name='job-dispatcher', daemon=True)
+
+    def start(self):
+
+        with self.app.app_context():
+            Job.__table__.create(db.engine, checkfirst=True)
+        self.thread.start()
+
+    def loop(self):
+
+        interval = self.app.config.get('JOB_POLL_INTERVAL', 2)
+        while True:
+            try:
+                with self.app.app_context():
+                    self.heartbeat()
+                    self.watch()
+                    self.requeue()
+                    self.claim()
+                    db.session.remove()
+            except Exception as e:
+                self.app.logger.error(f'Dispatcher.loop :: {e}')
+            self.wakeup.wait(interval)
+            self.wakeup.clear()
+
+    def heartbeat(self):
+
+        with self.lock:
+            running = list(self.running | self.inline)
+        if len(running) > 0:
+            db.session.execute(update(Job).where(Job.id.in_(running)).values(heartbeat=datetime.utcnow()))
+            db.session.commit()
+
+    def watch(self):
+        """cancel tokens of this process whose deadline has passed or whose job is to be cancelled
+
+        """
+
+        with _tokens_lock:
+            tokens = list(_tokens)
+        job_ids = [token.job_id for token in tokens if token.job_id is not None]
+        cancel = set()
+        if len(job_ids) > 0:
+            cancel = set(db.session.execute(
+                select(Job.id).where(Job.id.in_(job_ids), Job.cancel_requested.is_(True))
+            ).scalars())
+        for token in tokens:
+            if token.job_id in cancel:
+                token.cancel('cancel')
+            elif token.expired():
+                token.cancel('deadline')
+
+    def requeue(self):
+        """queue jobs of processes that stopped sending heartbeats
+
+        """
+
+        timeout = datetime.utcnow() - timedelta(seconds=self.app.config.get('JOB_HEARTBEAT_TIMEOUT', 60))
+        nr_jobs = db.session.execute(
+            update(Job).where(Job.state == 'running', Job.heartbeat < timeout).values(state='queued', worker=None)
+        ).rowcount
+        db.session.commit()
+        if nr_jobs > 0:
+            self.app.logger.warning(f'Dispatcher.requeue :: queued {nr_jobs} jobs of lost workers again')
+
+    def claim(self):
+
+        while True:
+            with self.lock:
+                if len(self.running) >= self.workers:
+                    return
+            job = Job.query.filter_by(state='queued').order_by(Job.id).first()
+            if job is None:
+                return
+            now = datetime.utcnow()
+            claimed = db.session.execute(
+                update(Job).where(Job.id == job.id, Job.state == 'queued').values(
+                    state='running', worker=WORKER, started=now, heartbeat=now, modified=now
+                )
+            ).rowcount
+            db.session.commit()
+            if claimed == 1:
+                with self.lock:
+                    self.running.add(job.id)
+                self.pool.submit(self.run, job.id)
+
+    def run(self, job_id):
+
+        try:
+            run_job(self.app, job_id)
+        finally:
+            with self.lock:
+                self.running.discard(job_id)
+            self.wakeup.set()
+
+
+def dispatcher(app=None):
+    """dispatcher of app in this process (started on first use)
+
+    """
+
+    app = current_app._get_current_object() if app is None else app
+    with _dispatcher_lock:
+        if 'jobs' not in app.extensions:
+            app.extensions['jobs'] = Dispatcher(app)
+            app.extensions['jobs'].start()
+    return app.extensions['jobs']
+
+
+def init_jobs(app):
+    """start dispatcher with the first request, so that jobs queued before a restart are picked up
+
+    """
+
+    @app.before_request
+    def start_dispatcher():
+        if 'jobs' not in app.extensions:
+            dispatcher(app)
+
+
+@contextmanager
+def tracking(job_id=None, timeout=None, background=False):
+    """cancellation token for the pipeline in this thread; report() updates job (if any)
+
+    """
+
+    token = Token(job_id, timeout, background)
+    with _tokens_lock:
+        _tokens.add(token)
+    _current.token = token
+    try:
+        yield token
+    finally:
+        _current.token = None
+        with _tokens_lock:
+            _tokens.discard(token)
+
+
+@contextmanager
+def sharing(token):
+    """process part of the pipeline of another thread (e.g. in a worker thread) under its cancellation token
+
+    """
+
+    previous = current_token()
+    _current.token = token
+    try:
+        yield token
+    finally:
+        _current.token = previous
+
+
+def current_token():
+
+    return getattr(_current, 'token', None)
+
+
+def in_background():
+    """is this thread processing a background job?
+
+    """
+
+    token = current_token()
+    return token is not None and token.background
+
+
+def checkpoint():
+    """raise Cancelled if job / request processed in this thread has been cancelled or its deadline has passed
+
+    """
+
+    token = current_token()
+    if token is not None:
+        token.check()
+
+
+def cancellable(corpus, token=None):
+    """register CQP processes started by ccc corpus with the cancellation token of this thread (or given token)
+
+    the same holds for its subcorpora (e.g. for set_context), which already start CQP while they are initialised
+    """
+
+    token = current_token() if token is None else token
+    if token is None:
+        return corpus
+
+    start_cqp = corpus.start_cqp
+
+    def start_registered_cqp():
+        cqp = start_cqp()
+        token.register(cqp)
+        return cqp
+
+    def registered_subcorpus(subcorpus_name=None, df_dump=None, overwrite=True):
+        subcorpus = cancellable(SubCorpus.__new__(SubCorpus), token)
+        subcorpus.__init__(subcorpus_name, df_dump, corpus.corpus_name, corpus.lib_dir, corpus.cqp_bin,
+                           corpus.registry_dir, corpus.data_dir, overwrite, corpus.inval_cache)
+        return subcorpus
+
+    corpus.start_cqp = start_registered_cqp
+    corpus.subcorpus = registered_subcorpus
+    return corpus
+
+
+def finish(job_id, state, result=None, error=None, status_code=200):
+
+    db.session.rollback()
+    job = db.session.get(Job, job_id)
+    job.state = state
+    job.result = result
+    job.error = error
+    job.status_code = status_code
+    if state == 'finished':
+        job.progress = 1
+        job.done = job.total
+    job.finished = job.modified = datetime.utcnow()
+    db.session.commit()
+
+
+def run_job(app, job_id):
+    """call registered function of job with stored arguments; save result or error
+
+    """
+
+    with app.app_context():
+        job = db.session.get(Job, job_id)
+        function = _functions.get(job.name)
+
+        with app.test_request_context(job.path):
+            g.flask_httpauth_user = db.session.get(User, job.user_id)
+            app.logger.debug(f'run_job :: running job {job_id} ({job.name})')
+            try:
+                if function is None:
+                    raise ValueError(f"unknown job function '{job.name}'")
+                with tracking(job_id, job.timeout, background=True):
+                    rv = function(**json.loads(job.arguments))
+                status_code = 200
+                if isinstance(rv, tuple):
+                    rv, status_code = rv[0], rv[1]
+                if isinstance(rv, Response):
+                    rv, status_code = rv.get_json(), rv.status_code
+                state, result, error = 'finished', json.dumps(rv, default=str), None
+
+            except Cancelled as e:
+                state, result, error, status_code = 'cancelled', None, str(e.message), e.status_code
+            except HTTPError as e:
+                state, result, error, status_code = 'failed', None, str(e.message), e.status_code
+            except HTTPException as e:
+                state, result, error, status_code = 'failed', None, e.description, e.code
+            except Exception as e:
+                app.logger.exception(f'run_job :: job {job_id} failed')
+                state, result, error, status_code = 'failed', None, f"{type(e).__name__}: {e}", 500
+
+            finish(job_id, state, result, error, status_code)
+            app.logger.debug(f'run_job :: job {job_id} {state}')
+
+
+def report(stage=None, done=None, total=None):
+    """progress event of the job processed in this thread (if any): stage of pipeline and number of done / total steps
+    (also a checkpoint for cancellation)
+
+    """
+
+    token = current_token()
+    if token is None:
+        return
+    token.check()
+    job_id = token.job_id
+    if job_id is None:
+        return
+
+    values = {'heartbeat': datetime.utcnow(), 'modified': datetime.utcnow()}
+    if stage is not None:
+        values['stage'] = stage
+        values['done'] = done
+        values['total'] = total
+    if done is not None and total:
+        values['progress'] = min(done / total, 1)
+    db.session.execute(update(Job).where(Job.id == job_id).values(**values))
+    db.session.commit()
+
+
+def submit(name, arguments, **kwargs):
+    """create job for current request
+
+    """
+
+    job = Job(
+        user_id=auth.current_user.id,
+        name=name,
+        endpoint=request.endpoint,
+        path=request.path,
+        arguments=json.dumps(arguments, default=str),
+        **kwargs
+    )
+    db.session.add(job)
+    db.session.commit()
+    current_app.logger.debug(f'submit :: created job {job.id} ({name}, {job.state})')
+
+    if job.state == 'queued':
+        dispatcher().wakeup.set()
+
+    return job
+
+
+def run_inline(name, f, args, kwargs, timeout=None):
+    """process request synchronously as job (so that its progress can be followed and it can be cancelled)
+
+    """
+
+    now = datetime.utcnow()
+    job = submit(name, kwargs, request_id=request.headers['X-Request-ID'], state='running',
+                 worker=WORKER, started=now, heartbeat=now, timeout=timeout)
+    job_id = job.id
+    jobs = dispatcher()
+    with jobs.lock:
+        jobs.inline.add(job_id)
+
+    try:
+        with tracking(job_id, timeout):
+            rv = f(*args, **kwargs)
+    except Cancelled as e:
+        finish(job_id, 'cancelled', error=str(e.message), status_code=e.status_code)
+        raise
+    except HTTPError as e:
+        finish(job_id, 'failed', error=str(e.message), status_code=e.status_code)
+        raise
+    except HTTPException as e:
+        finish(job_id, 'failed', error=e.description, status_code=e.code)
+        raise
+    except Exception as e:
+        finish(job_id, 'failed', error=f"{type(e).__name__}: {e}", status_code=500)
+        raise
+    else:
+        status_code = rv[1] if isinstance(rv, tuple) else getattr(rv, 'status_code', 200)
+        finish(job_id, 'finished', status_code=status_code)
+    finally:
+        with jobs.lock:
+            jobs.inline.discard(job_id)
+
+    return rv
+
+
+def progress_event(job):
+
+    end = job.finished if job.finished else datetime.utcnow()
+    return {
+        'id': job.id,
+        'state': job.state,
+        'stage': job.stage,
+        'done': job.done,
+        'total': job.total,
+        'progress': job.progress,
+        'elapsed': round((end - job.started).total_seconds(), 3) if job.started else 0,
+        'result_url': url_for('job.get_job_result', id=job.id) if job.state == 'finished' and job.result is not None else None
+    }
+
+
+def cancel(job):
+    """cancel queued job right away, running jobs at their next checkpoint
+
+    """
+
+    now = datetime.utcnow()
+    cancelled = db.session.execute(
+        update(Job).where(Job.id == job.id, Job.state == 'queued').values(
+            state='cancelled', cancel_requested=True, error='request was cancelled', status_code=409,
+            finished=now, modified=now
+        )
+    ).rowcount
+    if not cancelled:
+        db.session.execute(update(Job).where(Job.id == job.id, Job.state == 'running').values(
+            cancel_requested=True, modified=now
+        ))
+    db.session.commit()
+    current_app.logger.debug(f'cancel :: job {job.id} cancelled')
+    dispatcher().wakeup.set()
+
+
+def progress_events(job_id=None, request_id=None, user_id=None, cancel_on_disconnect=False):
+    """server-sent events of job (until it is finished, failed or cancelled)
+
+    """
+
+    try:
+        yield from _progress_events(job_id, request_id, user_id)
+    except GeneratorExit:
+        # client disconnected
+        if cancel_on_disconnect:
+            job = db.session.get(Job, job_id) if job_id else \
+                Job.query.filter_by(request_id=request_id, user_id=user_id).order_by(Job.id.desc()).first()
+            if job is not None:
+                cancel(job)
+        raise
+
+
+def _progress_events(job_id, request_id, user_id):
+
+    interval = current_app.config.get('JOB_EVENTS_INTERVAL', .5)
+    timeout = current_app.config.get('JOB_HEARTBEAT_TIMEOUT', 60)
+    last, waited = None, 0
+    while True:
+        db.session.expire_all()
+        if job_id is None:
+            # request may not have arrived yet
+            job = Job.query.filter_by(request_id=request_id, user_id=user_id).order_by(Job.id.desc()).first()
+            if job is None:
+                if waited >= timeout:
+                    yield "event: error\ndata: {}\n\n"
+                    return
+                yield ": waiting\n\n"
+                sleep(interval)
+                waited += interval
+                continue
+            job_id = job.id
+        job = db.session.get(Job, job_id)
+        event = progress_event(job)
+        if event != last:
+            yield f"event: {job.state}\ndata: {json.dumps(event)}\n\n"
+            last = event
+        else:
+            # lets the server notice disconnected clients
+            yield ": keep-alive\n\n"
+        if job.state in ['finished', 'failed', 'cancelled']:
+            return
+        sleep(interval)
+
+
+def default_timeout():
+    """deadline of current request in seconds (JOB_TIMEOUTS of endpoint or JOB_TIMEOUT)
+
+    """
+
+    return current_app.config.get('JOB_TIMEOUTS', {}).get(request.endpoint, current_app.config.get('JOB_TIMEOUT'))
+
+
+def defer(f, kwargs, timeout=None, reuse=False):
+    """create background job processing view function (decorated with @asynchronous) with keyword arguments
+    - reuse: return queued or running job of the user with the same function and arguments instead (if any)
+
+    """
+
+    name = f"{f.__module__}.{f.__name__}"
+    if not reuse:
+        return submit(name, kwargs, timeout=timeout)
+
+    arguments = json.dumps(kwargs, default=str)
+    with single_flight('job', auth.current_user.id, name, arguments):
+        job = Job.query.filter(
+            Job.user_id == auth.current_user.id,
+            Job.name == name,
+            Job.arguments == arguments,
+            Job.request_id.is_(None),
+            Job.state.in_(['queued', 'running'])
+        ).order_by(Job.id.desc()).first()
+        if job is None:
+            job = submit(name, kwargs, timeout=timeout)
+        else:
+            current_app.logger.debug(f'defer :: re-using job {job.id} ({name}, {job.state})')
+
+    return job
+
+
+def enqueue(f, kwargs, timeout=None):
+    """process view function (decorated with @asynchronous) with keyword arguments as background job: 202 response
+
+    """
+
+    job = defer(f, kwargs, timeout)
+    response = jsonify(JobOut().dump(job))
+    response.status_code = 202
+    response.headers['Location'] = url_for('job.get_job', id=job.id)
+    return response
+
+
+def asynchronous(f):
+    """let view function be processed as background job if requested (`?async=true`)
+
+    must be applied below the route / input / output / auth decorators; expects query input `query_job` (JobIn)
+
+    """
+
+    name = f"{f.__module__}.{f.__name__}"
+    _functions[name] = f
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        query_job = kwargs.pop('query_job', {})
+        timeout = query_job.get('timeout')
+        if timeout is None:
+            timeout = default_timeout()
+        if not query_job.get('run_async'):
+            if request.headers.get('X-Request-ID'):
+                return run_inline(name, f, args, kwargs, timeout)
+            with tracking(None, timeout):
+                return f(*args, **kwargs)
+        return enqueue(f, kwargs, timeout)
+
+    # heavy endpoint (see asgi)
+    wrapper.asynchronous = True
+
+    return wrapper
+
+
+def get_user_job_or_404(id):
+    """job of current user (other users' jobs are not found)
+
+    """
+
+    return Job.query.filter_by(id=id, user_id=auth.current_user.id).first_or_404()
+
+
+################
+# API schemata #
+################
+
+# Input
+class JobIn(Schema):
+
+    run_async = Boolean(required=False, load_default=False, data_key='async',
+                        metadata={'description': 'process in background and return job (202)'})
+    timeout = Integer(required=False, load_default=None, validate=Range(min=1),
+                      metadata={'description': 'deadline in seconds (cancelled with 408 afterwards)'})
+
+
+class JobEventsIn(Schema):
+
+    cancel_on_disconnect = Boolean(required=False, load_default=False,
+                                   metadata={'description': 'cancel job when client closes the event stream'})
+
+
+# Output
+class JobOut(Schema):
+
+    id = Integer(required=True)
+    name = String(required=True)
+    endpoint = String(required=True, allow_none=True)
+    request_id = String(required=True, allow_none=True)
+    state = String(required=True)
+    stage = String(required=True, allow_none=True)
+    done = Integer(required=True, allow_none=True)
+    total = Integer(required=True, allow_none=True)
+    progress = Float(required=True, allow_none=True)
+    created = String(required=True)
+    started = String(required=True, allow_none=True)
+    finished = String(required=True, allow_none=True)
+    timeout = Integer(required=True, allow_none=True)
+    cancel_requested = Boolean(required=True, allow_none=True)
+    error = String(required=True, allow_none=True)
+    result_url = String(required=True, allow_none=True, dump_default=None)
+
+    @post_dump(pass_original=True)
+    def add_result_url(self, data, job, **kwargs):
+        if isinstance(job, Job) and job.state == 'finished' and job.result is not None:
+            data['result_url'] = url_for('job.get_job_result', id=job.id)
+        return data
+
+
+#################
+# API endpoints #
+#################
+@bp.get('/')
+@bp.output(JobOut(many=True))
+@bp.auth_required(auth)
+def get_jobs():
+    """Get all jobs of current user.
+
+    """
+
+    jobs = Job.query.filter_by(user_id=auth.current_user.id).order_by(Job.id.desc()).all()
+    return [JobOut().dump(job) for job in jobs], 200
+
+
+@bp.get('/<id>')
+@bp.output(JobOut)
+@bp.auth_required(auth)
+def get_job(id):
+    """Get state, stage and progress of job.
+
+    """
+
+    job = get_user_job_or_404(id)
+    return JobOut().dump(job), 200
+
+
+@bp.get('/<id>/result')
+@bp.auth_required(auth)
+def get_job_result(id):
+    """Get result of finished job (response of the original endpoint).
+
+    """
+
+    job = get_user_job_or_404(id)
+    if job.state == 'failed':
+        return abort(job.status_code or 500, job.error)
+    if job.state != 'finished':
+        return abort(409, f'job is {job.state}')
+    if job.result is None:
+        return abort(404, 'result of synchronous request is not stored')
+
+    return Response(job.result, status=job.status_code, mimetype='application/json')
+
+
+@bp.get('/<id>/events')
+@bp.input(JobEventsIn, location='query')
+@bp.auth_required(auth)
+def get_job_events(id, query_data):
+    """Stream progress of job as server-sent events (stage, done, total, elapsed seconds).
+
+    """
+
+    job = get_user_job_or_404(id)
+    events = progress_events(job_id=job.id, cancel_on_disconnect=query_data['cancel_on_disconnect'])
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@bp.get('/request/<request_id>/events')
+@bp.input(JobEventsIn, location='query')
+@bp.auth_required(auth)
+def get_request_events(request_id, query_data):
+    """Stream progress of synchronous request with header `X-Request-ID` as server-sent events.
+
+    """
+
+    events = progress_events(request_id=request_id, user_id=auth.current_user.id,
+                             cancel_on_disconnect=query_data['cancel_on_disconnect'])
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@bp.post('/<id>/cancel')
+@bp.output(JobOut)
+@bp.auth_required(auth)
+def cancel_job(id):
+    """Cancel job. Queued jobs are cancelled right away, running ones (and their CQP processes) as soon as possible.
+
+    """
+
+    job = get_user_job_or_404(id)
+    cancel(job)
+    db.session.refresh(job)
+
+    return JobOut().dump(job), 200
+
+
+@bp.post('/request/<request_id>/cancel')
+@bp.output(JobOut)
+@bp.auth_required(auth)
+def cancel_request(request_id):
+    """Cancel synchronous request with header `X-Request-ID`.
+
+    """
+
+    job = Job.query.filter_by(request_id=request_id, user_id=auth.current_user.id).order_by(Job.id.desc()).first()
+    if job is None:
+        return abort(404, 'no such request')
+    cancel(job)
+    db.session.refresh(job)
+
+    return JobOut().dump(job), 200
@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import ThreadPoolExecutor
+
 from apiflask import APIBlueprint, Schema
 from apiflask.fields import Boolean, Float, Integer, Nested, String
 from apiflask.validators import OneOf
@@ -10,8 +12,13 @@ from numpy import array_split
 from pandas import DataFrame, to_numeric
 
 from . import db
+from .collocation import freq_frame, get_marginals
 from .database import Keyword, KeywordItem, KeywordItemScore
-from .semantic_map import CoordinatesOut, ccc_semmap_init, ccc_semmap_update
+from .jobs import JobIn, asynchronous, checkpoint, report
+from .pagination import clear_count_cache, paginate_keyset
+from .semantic_map import (CoordinatesOut, ccc_semmap_init, ccc_semmap_update,
+                           get_item_coordinates)
+from .ufa import forget_ranked_lists
 from .users import auth
 from .utils import AMS_DICT
 
@@ -28,24 +35,33 @@ def ccc_keywords(keyword, include_negative=False):
     # delete old ones
     KeywordItem.query.filter_by(keyword_id=keyword.id).delete()
     db.session.commit()
+    forget_ranked_lists('keyword', [keyword.id])
+    clear_count_cache()
 
     # get target and reference corpora
     sub_vs_rest = keyword.sub_vs_rest_strategy()
-    corpus = sub_vs_rest['target'].ccc()
-    corpus_reference = sub_vs_rest['reference'].ccc()
+    corpus = sub_vs_rest['target']
+    corpus_reference = sub_vs_rest['reference']
 
-    # get and merge both dataframes of counts
+    # get both dataframes of counts concurrently
     current_app.logger.debug('ccc_keywords :: getting marginals')
-    target = corpus.marginals(p_atts=[keyword.p])[['freq']].rename(columns={'freq': 'f1'})
-    reference = corpus_reference.marginals(p_atts=[keyword.p_reference])[['freq']].rename(columns={'freq': 'f2'})
+    report(stage='marginals')
+    app = current_app._get_current_object()
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix='keyword-marginals') as pool:
+        target = pool.submit(get_keyword_marginals, app, type(corpus), corpus.id, keyword.p)
+        reference = pool.submit(get_keyword_marginals, app, type(corpus_reference), corpus_reference.id, keyword.p_reference)
+        target, N1 = target.result()
+        reference, N2 = reference.result()
+    target = target.rename(columns={'freq': 'f1'})
+    reference = reference.rename(columns={'freq': 'f2'})
 
     # combine frequency lists
     current_app.logger.debug('ccc_keywords :: combining frequency lists')
     counts = target.join(reference, how='outer')
     counts['f2'] = to_numeric(counts['f2'].fillna(0), downcast='integer')
     counts = counts.loc[counts['f1'] > keyword.min_freq]
-    counts['N1'] = corpus.size()
-    counts['N2'] = corpus_reference.size()
+    counts['N1'] = N1
+    counts['N2'] = N2
 
     # sub vs rest correction
     if sub_vs_rest['sub_vs_rest']:
@@ -58,13 +74,52 @@ def ccc_keywords(keyword, include_negative=False):
             counts['N1'] = counts['N1'] - counts['N2']
 
     # save counts
+    checkpoint()
     current_app.logger.debug(f'ccc_keywords :: saving {len(counts)} items to database')
     counts['keyword_id'] = keyword.id
     counts.reset_index().to_sql('keyword_item', con=db.engine, if_exists='append', index=False)
     db.session.commit()
 
+    try:
+        put_keyword_scores(keyword, include_negative)
+    except Exception:
+        # counts without scores are removed (cancellation, errors)
+        db.session.rollback()
+        KeywordItemScore.query.filter_by(keyword_id=keyword.id).delete()
+        KeywordItem.query.filter_by(keyword_id=keyword.id).delete()
+        db.session.commit()
+        forget_ranked_lists('keyword', [keyword.id])
+        clear_count_cache()
+        raise
+    clear_count_cache()
+
+    current_app.logger.debug('ccc_keywords :: exit')
+
+
+def get_keyword_marginals(app, model, id, p):
+    """marginal frequencies (DataFrame; index: item; column: freq) and size of corpus or subcorpus (in own thread)
+    - counted on the token stream (see get_marginals), with cwb-ccc as fallback
+
+    """
+
+    with app.app_context():
+        corpus = db.session.get(model, id)
+        try:
+            stream, marginals = get_marginals(corpus, p)
+            return freq_frame(stream, marginals), int(marginals.sum())
+        except (FileNotFoundError, OSError) as e:
+            app.logger.warning(f"get_keyword_marginals :: cannot read token stream ({e}), counting with cwb-ccc")
+            corpus = corpus.ccc()
+            return corpus.marginals(p_atts=[p])[['freq']], corpus.size()
+
+
+def put_keyword_scores(keyword, include_negative=False):
+    """score and save KeywordItems of keyword analysis
+
+    """
+
     # calculate scores
-    current_app.logger.debug('ccc_keywords :: calculating scores')
+    current_app.logger.debug('put_keyword_scores :: calculating scores')
     counts = DataFrame([vars(s) for s in keyword.items], columns=['id', 'f1', 'N1', 'f2', 'N2']).set_index('id')
     scores = measures.score(counts, freq=True, digits=6, boundary='poisson', vocab=len(counts)).reset_index()
     if not include_negative:
@@ -74,16 +129,15 @@ def ccc_keywords(keyword, include_negative=False):
     scores['keyword_id'] = keyword.id
 
     # save scores
-    current_app.logger.debug(f'ccc_keywords :: saving {len(scores)} scores')
+    current_app.logger.debug(f'put_keyword_scores :: saving {len(scores)} scores')
     nr_arrays = int(len(scores) / 10000000) + 1
     dfs = array_split(scores, nr_arrays)
     for i, df in enumerate(dfs):
+        report(stage='saving scores', done=i, total=len(dfs))
         current_app.logger.debug(f'.. batch {i+1} of {len(dfs)}')
         df.to_sql('keyword_item_score', con=db.engine, if_exists='append', index=False)
     db.session.commit()
 
-    current_app.logger.debug('ccc_keywords :: exit')
-
 
 ################
 # API schemata #
@@ -144,6 +198,7 @@ class KeywordItemsIn(Schema):
     sort_by = String(required=False, load_default='conservative_log_ratio', validate=OneOf(AMS_DICT.keys()))
     page_size = Integer(required=False, load_default=10)
     page_number = Integer(required=False, load_default=1)
+    cursor = String(required=False, load_default=None, metadata={'description': 'cursor of next page (takes precedence over page number)'})
 
 
 class KeywordScoreOut(Schema):
@@ -169,6 +224,7 @@ class KeywordItemsOut(Schema):
     page_size = Integer(required=True)
     page_number = Integer(required=True)
     page_count = Integer(required=True)
+    next_cursor = String(required=False, allow_none=True, dump_default=None)
 
     items = Nested(KeywordItemOut(many=True), required=True, dump_default=[])
     coordinates = Nested(CoordinatesOut(many=True), required=True, dump_default=[])
@@ -213,6 +269,8 @@ def delete_keyword(id):
     keyword = db.get_or_404(Keyword, id)
     db.session.delete(keyword)
     db.session.commit()
+    forget_ranked_lists('keyword', [keyword.id])
+    clear_count_cache()
 
     return 'Deletion successful.', 200
 
@@ -249,6 +307,7 @@ def get_keyword_items(id, query_data):
     # pagination settings
     page_size = query_data.pop('page_size')
     page_number = query_data.pop('page_number')
+    cursor = query_data.pop('cursor')
     sort_order = query_data.pop('sort_order')
     sort_by = query_data.pop('sort_by')
 
@@ -258,14 +317,9 @@ def get_keyword_items(id, query_data):
         KeywordItemScore.measure == sort_by
     )
 
-    # order
-    if sort_order == 'ascending':
-        scores = scores.order_by(KeywordItemScore.score)
-    elif sort_order == 'descending':
-        scores = scores.order_by(KeywordItemScore.score.desc())
-
-    # paginate
-    scores = scores.paginate(page=page_number, per_page=page_size)
+    # order and paginate
+    scores = paginate_keyset(scores, [KeywordItemScore.score, KeywordItemScore.id],
+                             sort_order == 'descending', page_number, page_size, cursor)
     nr_items = scores.total
     page_count = scores.pages
 
@@ -278,7 +332,7 @@ def get_keyword_items(id, query_data):
     if keyword.semantic_map:
         requested_items = [item['item'] for item in items]
         ccc_semmap_update(keyword.semantic_map, requested_items)
-        coordinates = [CoordinatesOut().dump(coordinates) for coordinates in keyword.semantic_map.coordinates if coordinates.item in requested_items]
+        coordinates = [CoordinatesOut().dump(coordinates) for coordinates in get_item_coordinates(keyword.semantic_map.id, requested_items)]
 
     # TODO: also return ranks (to ease frontend pagination)?
     keyword_items = {
@@ -288,6 +342,7 @@ def get_keyword_items(id, query_data):
         'page_size': page_size,
         'page_number': page_number,
         'page_count': page_count,
+        'next_cursor': scores.next_cursor,
         'items': items,
         'coordinates': coordinates
     }
@@ -297,8 +352,10 @@ def get_keyword_items(id, query_data):
 
 @bp.post('/')
 @bp.input(KeywordIn)
+@bp.input(JobIn, location='query', arg_name='query_job')
 @bp.output(KeywordOut)
 @bp.auth_required(auth)
+@asynchronous
 def create_keyword(json_data):
     """Create keyword analysis.
 
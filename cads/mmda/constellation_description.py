@@ -571,6 +571,7 @@ def concordance_lines(constellation_id, description_id, query_data, query_focus,
     # pagination
     page_size = query_data.get('page_size')
     page_number = query_data.get('page_number')
+    cursor = query_data.get('cursor')
 
     # sorting
     sort_order = query_data.get('sort_order')
@@ -634,7 +635,7 @@ def concordance_lines(constellation_id, description_id, query_data, query_focus,
                                       highlight_queries=highlight_queries,
                                       match_id=None,
                                       filter_queries=filter_queries, overlap='partial',
-                                      page_number=page_number, page_size=page_size,
+                                      page_number=page_number, page_size=page_size, cursor=cursor,
                                       sort_order=sort_order,
                                       sort_by_offset=sort_by_offset, sort_by_p_att=sort_by_p_att, sort_by_s_att=sort_by_s_att)
 
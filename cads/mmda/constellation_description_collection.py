@@ -1,99 +1,198 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
+from itertools import repeat
 
 from apiflask import APIBlueprint, Schema, abort
 from apiflask.fields import Float, Integer, Nested, String
-from apiflask.validators import OneOf
-from association_measures.comparisons import rbo
+from apiflask.validators import OneOf, Range
 from flask import current_app
 from pandas import DataFrame
 
 from .. import db
-from ..database import SubCorpusCollection
-from ..tsa import gam_smoothing
+from ..collocation import put_counts_sliced
+from ..database import (Collocation, CollocationItem, SubCorpusCollection,
+                        single_flight)
+from ..jobs import (Cancelled, JobIn, asynchronous, checkpoint, current_token,
+                    report, sharing)
+from ..query import ccc_query_sliced, get_or_create_cotext_sliced
+from ..semantic_map import ccc_semmap_init
+from ..tsa import gam_smoothing, loess_smoothing
+from ..ufa import (MAX_DEPTH, forget_ranked_lists, ranked_list,
+                   similarity_matrix)
 from ..users import auth
 from .constellation_description import ConstellationDescriptionOut
 from .constellation_description_collocation import (
-    ConstellationCollocationIn, ConstellationCollocationOut, get_collo_items,
-    get_or_create_coll)
+    ConstellationCollocationIn, ConstellationCollocationOut,
+    get_collo_blacklist, get_or_create_coll, get_or_create_collocation_object)
 from .database import (Constellation, ConstellationDescription,
                        ConstellationDescriptionCollection, Discourseme,
                        DiscoursemeDescription, DiscoursemeTemplateItems)
 from .discourseme import DiscoursemeIDs, DiscoursemeIn, DiscoursemeOut
-from .discourseme_description import discourseme_template_to_description
+from .discourseme_description import (discourseme_descriptions_sliced,
+                                      discourseme_template_to_description)
 
 bp = APIBlueprint('collection', __name__, url_prefix='/collection/')
 
 
-def calculate_rbo(description_left, collocation_left, description_right, collocation_right, sort_by="conservative_log_ratio", number=50, p=.95):
-    """RBO calculation of two constellation description collocation analyses
+def ufa_ranked_list(description, collocation, sort_by, number):
+    """ranked list of collocation analysis without focus and filter items (see get_collo_items)
+
+    """
+
+    return ranked_list('collocation', collocation.id, sort_by, number,
+                       get_collo_blacklist(description, collocation, True, True))
 
-    TODO: also return discourseme scores
+
+def ufa_slice(description, semantic_map_id, parameters, create_map=True):
+    """collocation analysis of one slice of a UFA; failures are reported instead of raised
 
     """
-    scores_left = get_collo_items(description_left, collocation_left, number, 1, 'descending', sort_by, True, True, False)
-    lrc_left = [score['score'] for item in scores_left['items'] for score in item['scores'] if score['measure'] == sort_by]
-    items_left = [item['item'] for lrc, item in zip(lrc_left, scores_left['items']) if lrc > 0]
 
-    scores_right = get_collo_items(description_right, collocation_right, number, 1, 'descending', sort_by, True, True, False)
-    lrc_right = [score['score'] for item in scores_right['items'] for score in item['scores'] if score['measure'] == sort_by]
-    items_right = [item['item'] for lrc, item in zip(lrc_right, scores_right['items']) if lrc > 0]
+    try:
+        collocation = get_or_create_coll(description, semantic_map_id=semantic_map_id, create_map=create_map, **parameters)
+        db.session.commit()
+        return {'description_id': description.id, 'collocation_id': collocation.id, 'error': None}
+    except Cancelled:
+        db.session.rollback()
+        raise
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f'ufa_slice :: description {description.id} failed: {e}')
+        return {'description_id': description.id, 'collocation_id': None, 'error': f"{type(e).__name__}: {e}"}
+
+
+def _ufa_slice_worker(app, token, description_id, semantic_map_id, parameters):
+
+    # own app context (and thus database session) per thread, cancelled with the request / job
+    with app.app_context(), sharing(token):
+        checkpoint()
+        description = db.session.get(ConstellationDescription, description_id)
+        return ufa_slice(description, semantic_map_id, parameters, create_map=False)
 
-    if len(set(items_left).intersection(set(items_right))) == 0:
-        r = 0.0
-    else:
-        r = rbo(items_left, items_right, p=p)[2]
-    return r
+
+def ufa_one_pass(collection, descriptions, window, p, marginals, include_negative, semantic_map_id, focus_discourseme_id):
+    """create counts of all slices from one cotext of the focus discourseme on the (sub)corpus of the collection
+    - matches and cotext of the focus query on the (sub)corpus are assigned to the slices
+    - item counts of all slices are created at once (see put_counts_sliced)
+
+    """
+
+    if len(descriptions) == 0:
+        return
+
+    discourseme = db.get_or_404(Discourseme, focus_discourseme_id)
+    parent, _ = discourseme_descriptions_sliced(discourseme, collection.corpus_id, collection.subcorpus_collection.subcorpus_id,
+                                                [description.subcorpus_id for description in descriptions],
+                                                collection.s, collection.match_strategy)
+    parent_query = parent._query
+
+    queries = dict()
+    for description in descriptions:
+        focus_query = [desc._query for desc in description.discourseme_descriptions
+                       if desc.discourseme_id == focus_discourseme_id and desc.filter_sequence is None][0]
+        if focus_query.cqp_query == parent_query.cqp_query:
+            queries[description.id] = focus_query
+    if len(queries) == 0 or not ccc_query_sliced(parent_query, list(queries.values())):
+        current_app.logger.debug('ufa_one_pass :: slices cannot be derived from one query')
+        return
+
+    current_app.logger.debug(f'ufa_one_pass :: counting {len(queries)} slices in one pass')
+    get_or_create_cotext_sliced(parent_query, list(queries.values()), window, collection.s)
+    collocations = [
+        get_or_create_collocation_object(queries[description.id], p, collection.s, window, marginals,
+                                         semantic_map_id if semantic_map_id else description.semantic_map_id)
+        for description in descriptions if description.id in queries
+    ]
+    put_counts_sliced(collocations, remove_focus_cpos=False, include_negative=include_negative)
 
 
 def calculate_ufa(collection, window, p, marginals, include_negative, semantic_map_id, focus_discourseme_id,
-                  filter_discourseme_ids, filter_item, filter_item_p_att, sort_by, max_depth):
+                  filter_discourseme_ids, filter_item, filter_item_p_att, sort_by, max_depth, smoothing='gam', n_boot=None):
 
     # get collocation objects
     current_app.logger.debug('calculate_ufa :: getting collocation objects')
     if len(collection.constellation_descriptions) < 2:
         return None
-    collocations = list()
-    for description in collection.constellation_descriptions:
-
-        collocation = get_or_create_coll(
-            description,
-            window, p, marginals, include_negative,
-            semantic_map_id,
-            focus_discourseme_id,
-            filter_discourseme_ids, filter_item, filter_item_p_att
-        )
-        collocation.focus_discourseme_id = focus_discourseme_id
+    descriptions = collection.constellation_descriptions
+    parameters = dict(
+        window=window, p=p, marginals=marginals, include_negative=include_negative,
+        focus_discourseme_id=focus_discourseme_id,
+        filter_discourseme_ids=filter_discourseme_ids, filter_item=filter_item, filter_item_p_att=filter_item_p_att
+    )
 
-        if semantic_map_id is None and not collocation._query.zero_matches:
-            # use same map for following analyses
-            semantic_map_id = collocation.semantic_map_id
+    # slices are processed in order until there is a semantic map to share ...
+    slices = list()
+    while len(slices) < len(descriptions) and semantic_map_id is None:
+        report(stage='slices', done=len(slices), total=len(descriptions))
+        result = ufa_slice(descriptions[len(slices)], semantic_map_id, parameters)
+        slices.append(result)
+        if result['collocation_id'] is not None:
+            collocation = db.session.get(Collocation, result['collocation_id'])
+            if not collocation._query.zero_matches:
+                # use same map for following analyses
+                semantic_map_id = collocation.semantic_map_id
+
+    # ... the remaining ones in parallel (without semantic map) ...
+    remaining = descriptions[len(slices):]
+    report(stage='slices', done=len(slices), total=len(descriptions))
+    if current_app.config.get('UFA_ONE_PASS', False) and not filter_discourseme_ids and not filter_item:
+        ufa_one_pass(collection, remaining, window, p, marginals, include_negative, semantic_map_id, focus_discourseme_id)
+    workers = min(current_app.config.get('UFA_WORKERS', 1), len(remaining))
+    if workers > 1:
+        current_app.logger.debug(f'calculate_ufa :: processing {len(remaining)} slices in {workers} threads')
+        description_ids = [description.id for description in remaining]
+        worker = partial(_ufa_slice_worker, current_app._get_current_object(), current_token())
+        with ThreadPoolExecutor(workers, thread_name_prefix='ufa-slice') as pool:
+            try:
+                slices += list(pool.map(worker, description_ids, repeat(semantic_map_id), repeat(parameters)))
+            except Cancelled:
+                # running slices stop at their next checkpoint
+                pool.shutdown(cancel_futures=True)
+                raise
+        db.session.expire_all()
+    else:
+        slices += [ufa_slice(description, semantic_map_id, parameters, create_map=False) for description in remaining]
 
+    # ... and their items are added to the semantic map in order
+    collocations = list()
+    for i, result in enumerate(slices):
+        collocation = None
+        if result['collocation_id'] is not None:
+            collocation = db.session.get(Collocation, result['collocation_id'])
+            collocation.focus_discourseme_id = focus_discourseme_id
+            if i >= len(slices) - len(remaining) and CollocationItem.query.filter_by(collocation_id=collocation.id).first():
+                ccc_semmap_init(collocation, semantic_map_id)
         collocations.append(collocation)
 
-    # calculate RBO scores
-    current_app.logger.debug('calculate_ufa :: calculating RBO and fitting GAM')
+    # calculate RBO scores of all non-empty slices at once
+    current_app.logger.debug(f'calculate_ufa :: calculating RBO and smoothing ({smoothing})')
+    report(stage='scores', done=len(descriptions), total=len(descriptions))
+    valid = [i for i, collocation in enumerate(collocations) if collocation is not None and not collocation._query.zero_matches]
+    position = {i: k for k, i in enumerate(valid)}
+    rbo = similarity_matrix([ufa_ranked_list(descriptions[i], collocations[i], sort_by, max_depth) for i in valid], 'rbo')
     xs = list()                 # time_str of right collocation analysis
     scores = list()
     for i in range(1, len(collocations)):
-        collocation_left = collocations[i-1]
-        collocation_right = collocations[i]
-        description_left = collection.constellation_descriptions[i-1]
-        description_right = collection.constellation_descriptions[i]
-        xs.append(description_right.subcorpus.name)
-        if collocation_left._query.zero_matches or collocation_right._query.zero_matches:
-            scores.append(0)    # no overlap between empty sets (None will not work with smoothing)
+        xs.append(descriptions[i].subcorpus.name)
+        if i - 1 in position and i in position:
+            scores.append(float(rbo[position[i - 1], position[i]]))
         else:
-            scores.append(calculate_rbo(description_left, collocation_left, description_right, collocation_right, sort_by=sort_by, number=max_depth))
+            scores.append(0)    # failed slices / no overlap between empty sets (None will not work with smoothing)
 
-    # GAM smoothing
+    # GAM / LOESS smoothing (cached per series)
     if collection.subcorpus_collection.time_interval in ['month', 'year']:
         seconds = [datetime.fromisoformat(time_str + "-01").timestamp() for time_str in xs]
     else:
         seconds = [datetime.fromisoformat(time_str).timestamp() for time_str in xs]
-    predictions = gam_smoothing(DataFrame({'x': seconds, 'score': scores}))
+    if smoothing == 'loess':
+        n_boot = n_boot or current_app.config.get('SMOOTHING_BOOTSTRAP', 50)
+        predictions = loess_smoothing(seconds, scores, n_boot=n_boot, workers=current_app.config.get('SMOOTHING_WORKERS', 1))
+    else:
+        predictions = gam_smoothing(DataFrame({'x': seconds, 'score': scores}))
 
     # create output format
     current_app.logger.debug('calculate_ufa :: formatting output')
@@ -105,9 +204,9 @@ def calculate_ufa(collection, window, p, marginals, include_negative, semantic_m
         description_right = collection.constellation_descriptions[i]
 
         ufa_score = {
-            'collocation_id_left': collocation_left.id,
+            'collocation_id_left': collocation_left.id if collocation_left else None,
             'description_id_left': description_left.id,
-            'collocation_id_right': collocation_right.id,
+            'collocation_id_right': collocation_right.id if collocation_right else None,
             'description_id_right': description_right.id,
             'x_label': x,
             'score': score,
@@ -124,7 +223,8 @@ def calculate_ufa(collection, window, p, marginals, include_negative, semantic_m
 
     return {
         'collocations': [ConstellationCollocationOut().dump(collocation) if collocation else None for collocation in collocations],
-        'ufa': ufa
+        'ufa': ufa,
+        'slices': slices
     }
 
 
@@ -169,10 +269,18 @@ class UFAScoreOut(Schema):
     score_confidence = Nested(UFAConfidenceIntervalOut, required=True)
 
 
+class UFASliceOut(Schema):
+
+    description_id = Integer(required=True)
+    collocation_id = Integer(required=True, allow_none=True, dump_default=None)
+    error = String(required=True, allow_none=True, dump_default=None)
+
+
 class UFAOut(Schema):
 
     collocations = Nested(ConstellationCollocationOut(many=True), required=True, dump_default=[])
     ufa = Nested(UFAScoreOut(many=True), required=True, dump_default=[])
+    slices = Nested(UFASliceOut(many=True), required=True, dump_default=[])
 
 
 #########################################
@@ -210,6 +318,12 @@ def create_constellation_description_collection(constellation_id, json_data):
     db.session.add(constellation_description_collection)
     db.session.commit()
 
+    if current_app.config.get('UFA_ONE_PASS', False):
+        # query (sub)corpus once for all subcorpora
+        for discourseme in constellation.discoursemes:
+            discourseme_descriptions_sliced(discourseme, corpus.id, collection.subcorpus_id,
+                                            [subcorpus.id for subcorpus in collection.subcorpora], s_query, match_strategy)
+
     for subcorpus in collection.subcorpora:
 
         current_app.logger.debug(f"creating constellation description collection: subcorpus {subcorpus.id}")
@@ -296,6 +410,12 @@ def get_or_create_constellation_description_collection(constellation_id, json_da
         db.session.add(constellation_description_collection)
         db.session.commit()
 
+        if current_app.config.get('UFA_ONE_PASS', False):
+            # query (sub)corpus once for all subcorpora
+            for discourseme in constellation.discoursemes:
+                discourseme_descriptions_sliced(discourseme, corpus.id, collection.subcorpus_id,
+                                                [subcorpus.id for subcorpus in collection.subcorpora], s_query, match_strategy)
+
         for subcorpus in collection.subcorpora:
 
             current_app.logger.debug(f"creating constellation description collection: subcorpus {subcorpus.id}")
@@ -379,9 +499,12 @@ def delete_constellation_description_collection(constellation_id, collection_id)
 ###################
 @bp.put('/<collection_id>/ufa')
 @bp.input(ConstellationCollocationIn)
-@bp.input({'sort_by': String(), 'max_depth': Integer()}, location='query')
+@bp.input({'sort_by': String(), 'max_depth': Integer(validate=Range(min=1, max=MAX_DEPTH)),
+           'smoothing': String(validate=OneOf(['gam', 'loess'])), 'n_boot': Integer(validate=Range(min=1, max=10000))}, location='query')
+@bp.input(JobIn, location='query', arg_name='query_job')
 @bp.output(UFAOut)
 @bp.auth_required(auth)
+@asynchronous
 def get_or_create_ufa(constellation_id, collection_id, json_data, query_data):
     """Get or create usage fluctuation analysis (list of collocation analyses).
 
@@ -393,6 +516,10 @@ def get_or_create_ufa(constellation_id, collection_id, json_data, query_data):
     sort_by = query_data.get('sort_by', 'conservative_log_ratio')
     max_depth = query_data.get('max_depth', 50)
 
+    # smoothing options
+    smoothing = query_data.get('smoothing', 'gam')
+    n_boot = query_data.get('n_boot')
+
     # context options
     window = json_data.get('window')
     p = json_data.get('p')
@@ -414,8 +541,11 @@ def get_or_create_ufa(constellation_id, collection_id, json_data, query_data):
     filter_item = json_data.get('filter_item')
     filter_item_p_att = json_data.get('filter_item_p_att')
 
-    ufa = calculate_ufa(collection, window, p, marginals, include_negative, semantic_map_id, focus_discourseme_id,
-                        filter_discourseme_ids, filter_item, filter_item_p_att, sort_by, max_depth)
+    # identical requests wait for this one and then re-use its collocation analyses
+    with single_flight('ufa', collection.id, window, p, marginals, include_negative, semantic_map_id, focus_discourseme_id,
+                       filter_discourseme_ids, filter_item, filter_item_p_att):
+        ufa = calculate_ufa(collection, window, p, marginals, include_negative, semantic_map_id, focus_discourseme_id,
+                            filter_discourseme_ids, filter_item, filter_item_p_att, sort_by, max_depth, smoothing, n_boot)
 
     if ufa is None:
         return abort(406, 'not enough subcorpora for UFA')
@@ -470,6 +600,9 @@ def patch_collection_add_discourseme(constellation_id, collection_id, json_data)
                 description.discourseme_descriptions.append(desc)
                 db.session.commit()
 
+    # rankings of the slices hide other discoursemes
+    forget_ranked_lists('collocation')
+
     return ConstellationDescriptionCollectionOut().dump(collection), 200
 
 
@@ -506,6 +639,9 @@ def patch_collection_remove_discourseme(constellation_id, collection_id, json_da
                 description.discourseme_descriptions.remove(desc)
                 db.session.commit()
 
+    # rankings of the slices hide other discoursemes
+    forget_ranked_lists('collocation')
+
     return ConstellationDescriptionCollectionOut().dump(collection), 200
 
 
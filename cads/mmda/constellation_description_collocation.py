@@ -18,11 +18,14 @@ from ..collocation import (CollocationIn, CollocationItemOut,
                            CollocationOut, put_counts)
 from ..database import (Breakdown, Collocation, CollocationItem,
                         CollocationItemScore, CotextLines, Matches, Query,
-                        get_or_create)
+                        get_or_create, single_flight)
+from ..jobs import JobIn, asynchronous
+from ..pagination import paginate_keyset
 from ..query import (ccc_query, get_or_create_cotext,
                      get_or_create_query_assisted,
                      get_or_create_query_iterative)
-from ..semantic_map import CoordinatesOut, ccc_semmap_init, ccc_semmap_update
+from ..semantic_map import (CoordinatesOut, ccc_semmap_init, ccc_semmap_update,
+                            get_item_coordinates)
 from ..users import auth
 from ..utils import AMS_CUTOFF, scale_score
 from .constellation_description import expand_scores_dataframe
@@ -75,6 +78,51 @@ def get_score_quantile_for_value(scores, value):
     }
 
 
+def get_or_create_collocation_object(focus_query, p, s, window, marginals, semantic_map_id=None):
+    """get or create collocation object (without counts)
+
+    """
+
+    with single_flight('collocation', focus_query.id, p, s, window, marginals, semantic_map_id):
+
+        if semantic_map_id is None:
+            collocation = Collocation.query.filter_by(
+                query_id=focus_query.id,
+                p=p,
+                s_break=s,
+                window=window,
+                marginals=marginals
+            ).order_by(Collocation.id.desc()).first()
+        else:
+            collocation = Collocation.query.filter_by(
+                semantic_map_id=semantic_map_id,
+                query_id=focus_query.id,
+                p=p,
+                s_break=s,
+                window=window,
+                marginals=marginals
+            ).order_by(Collocation.id.desc()).first()
+
+        if not collocation:
+            current_app.logger.debug("collocation object does not exist, creating new one")
+            # create collocation object
+            collocation = Collocation(
+                semantic_map_id=semantic_map_id,
+                query_id=focus_query.id,
+                p=p,
+                s_break=s,
+                window=window,
+                marginals=marginals
+            )
+            db.session.add(collocation)
+            db.session.commit()
+
+        else:
+            current_app.logger.debug("collocation object already exists")
+
+    return collocation
+
+
 def get_or_create_coll(description,
                        window, p, marginals, include_negative,
                        semantic_map_id,
@@ -114,40 +162,7 @@ def get_or_create_coll(description,
         #     description.discourseme_descriptions.append(discourseme_description)
         #     db.session.commit()
 
-    if semantic_map_id is None:
-        collocation = Collocation.query.filter_by(
-            query_id=focus_query.id,
-            p=p,
-            s_break=s,
-            window=window,
-            marginals=marginals
-        ).order_by(Collocation.id.desc()).first()
-    else:
-        collocation = Collocation.query.filter_by(
-            semantic_map_id=semantic_map_id,
-            query_id=focus_query.id,
-            p=p,
-            s_break=s,
-            window=window,
-            marginals=marginals
-        ).order_by(Collocation.id.desc()).first()
-
-    if not collocation:
-        current_app.logger.debug("collocation object does not exist, creating new one")
-        # create collocation object
-        collocation = Collocation(
-            semantic_map_id=semantic_map_id,
-            query_id=focus_query.id,
-            p=p,
-            s_break=s,
-            window=window,
-            marginals=marginals
-        )
-        db.session.add(collocation)
-        db.session.commit()
-
-    else:
-        current_app.logger.debug("collocation object already exists")
+    collocation = get_or_create_collocation_object(focus_query, p, s, window, marginals, semantic_map_id)
 
     counts_status = put_counts(collocation, remove_focus_cpos=False, include_negative=include_negative)
     if not counts_status:
@@ -165,49 +180,53 @@ def get_or_create_coll(description,
     return collocation
 
 
-def get_collo_items(description, collocation, page_size, page_number, sort_order, sort_by, hide_focus, hide_filter, return_coordinates):
+def get_collo_blacklist(description, collocation, hide_focus, hide_filter):
+    """unigrams of focus and filter discoursemes (to hide from collocation analysis)
 
-    # focus query
-    focus_query_id = collocation.query_id
-    focus_query = db.get_or_404(Query, focus_query_id)
+    """
 
-    # discourseme scores (calculated here to hide unigram breakdown if requested)
-    discourseme_scores = get_collocation_discourseme_scores(collocation.id, [d.id for d in description.discourseme_descriptions])
-    for s in discourseme_scores:
-        if s['item_scores']:
-            s['item_scores'] = [CollocationItemOut().dump(sc) for sc in s['item_scores']]
-    discourseme_scores = [DiscoursemeScoresOut().dump(s) for s in discourseme_scores]
+    focus_query = db.get_or_404(Query, collocation.query_id)
 
-    # hide focus
     blacklist = []
     if hide_focus:
-        focus_discourseme_description = DiscoursemeDescription.query.filter_by(query_id=focus_query_id).first()
+        focus_discourseme_description = DiscoursemeDescription.query.filter_by(query_id=focus_query.id).first()
         bd = focus_discourseme_description.breakdown(collocation.p)
         if bd is not None:
-            focus_unigrams = [i for i in chain.from_iterable(
+            blacklist += [i for i in chain.from_iterable(
                 [a.split(" ") for a in bd.index]
             )]
-            blacklist_focus = CollocationItem.query.filter(
-                CollocationItem.collocation_id == collocation.id,
-                CollocationItem.item.in_(focus_unigrams)
-            )
-            blacklist += [b.id for b in blacklist_focus]
 
-    # hide filter
     if hide_filter and focus_query.filter_sequence is not None:
         filter_query_ids = [int(x) for x in focus_query.filter_sequence.lstrip("Q-").split("-")[1:]]
         filter_descriptions = [d for d in description.discourseme_descriptions if d.query_id in filter_query_ids]
         for desc in filter_descriptions:
             bd = desc.breakdown(collocation.p)
             if bd is not None:
-                desc_unigrams = [i for i in chain.from_iterable(
+                blacklist += [i for i in chain.from_iterable(
                     [a.split(" ") for a in bd.index]
                 )]
-                blacklist_desc = CollocationItem.query.filter(
-                    CollocationItem.collocation_id == collocation.id,
-                    CollocationItem.item.in_(desc_unigrams)
-                )
-                blacklist += [b.id for b in blacklist_desc]
+
+    return blacklist
+
+
+def get_collo_items(description, collocation, page_size, page_number, sort_order, sort_by, hide_focus, hide_filter, return_coordinates,
+                    cursor=None):
+
+    # discourseme scores (calculated here to hide unigram breakdown if requested)
+    discourseme_scores = get_collocation_discourseme_scores(collocation.id, [d.id for d in description.discourseme_descriptions])
+    for s in discourseme_scores:
+        if s['item_scores']:
+            s['item_scores'] = [CollocationItemOut().dump(sc) for sc in s['item_scores']]
+    discourseme_scores = [DiscoursemeScoresOut().dump(s) for s in discourseme_scores]
+
+    # hide focus / filter
+    blacklist = []
+    blacklist_items = get_collo_blacklist(description, collocation, hide_focus, hide_filter)
+    if len(blacklist_items) > 0:
+        blacklist = [b.id for b in CollocationItem.query.filter(
+            CollocationItem.collocation_id == collocation.id,
+            CollocationItem.item.in_(blacklist_items)
+        )]
 
     # item scores
     scores = CollocationItemScore.query.filter(
@@ -216,14 +235,9 @@ def get_collo_items(description, collocation, page_size, page_number, sort_order
         ~ CollocationItemScore.collocation_item_id.in_(blacklist)
     )
 
-    # order
-    if sort_order == 'ascending':
-        scores = scores.order_by(CollocationItemScore.score)
-    elif sort_order == 'descending':
-        scores = scores.order_by(CollocationItemScore.score.desc())
-
-    # paginate
-    scores = scores.paginate(page=page_number, per_page=page_size)
+    # order and paginate
+    scores = paginate_keyset(scores, [CollocationItemScore.score, CollocationItemScore.id],
+                             sort_order == 'descending', page_number, page_size, cursor)
     nr_items = scores.total
     page_count = scores.pages
 
@@ -241,7 +255,7 @@ def get_collo_items(description, collocation, page_size, page_number, sort_order
             if discourseme_score['item_scores']:
                 requested_items.extend([d['item'] for d in discourseme_score['item_scores']])
         ccc_semmap_update(collocation.semantic_map, requested_items)
-        coordinates = [CoordinatesOut().dump(coordinates) for coordinates in collocation.semantic_map.coordinates if coordinates.item in requested_items]
+        coordinates = [CoordinatesOut().dump(coordinates) for coordinates in get_item_coordinates(collocation.semantic_map.id, requested_items)]
 
         # discourseme coordinates
         discourseme_coordinates = get_discourseme_coordinates(collocation.semantic_map, description.discourseme_descriptions, collocation.p)
@@ -254,6 +268,7 @@ def get_collo_items(description, collocation, page_size, page_number, sort_order
         'page_size': page_size,
         'page_number': page_number,
         'page_count': page_count,
+        'next_cursor': scores.next_cursor,
         'items': items,
         'coordinates': coordinates,
         'discourseme_scores': discourseme_scores,
@@ -264,7 +279,7 @@ def get_collo_items(description, collocation, page_size, page_number, sort_order
 
 
 def get_collo_map(description, collocation, page_size, page_number, sort_order, sort_by, min_score=None,
-                  hide_focus_unigrams=True, hide_discourseme_unigrams=True, return_coordinates=True):
+                  hide_focus_unigrams=True, hide_discourseme_unigrams=True, return_coordinates=True, cursor=None):
     """
 
     NB min_score is exclusive
@@ -317,14 +332,9 @@ def get_collo_map(description, collocation, page_size, page_number, sort_order,
         else:
             min_score = sorted_scores[n - 1]
 
-    # order
-    if sort_order == 'ascending':
-        scores = scores.order_by(CollocationItemScore.score)
-    elif sort_order == 'descending':
-        scores = scores.order_by(CollocationItemScore.score.desc())
-
-    # pagination
-    scores = scores.paginate(page=page_number, per_page=page_size)
+    # order and paginate
+    scores = paginate_keyset(scores, [CollocationItemScore.score, CollocationItemScore.id],
+                             sort_order == 'descending', page_number, page_size, cursor)
     nr_items = scores.total
     page_count = scores.pages
 
@@ -365,7 +375,7 @@ def get_collo_map(description, collocation, page_size, page_number, sort_order,
             requested_items += (list(df_discourseme_unigram_item_scores['item']) if len(df_discourseme_unigram_item_scores) > 0 else [])
             ccc_semmap_update(collocation.semantic_map, list(set(requested_items)))
             coordinates = DataFrame(
-                [CoordinatesOut().dump(coordinates) for coordinates in collocation.semantic_map.coordinates if coordinates.item in requested_items]
+                [CoordinatesOut().dump(coordinates) for coordinates in get_item_coordinates(collocation.semantic_map.id, requested_items)]
             )
             if len(df_scores) > 0:
                 df_scores = merge(df_scores, coordinates, on='item', how='left')
@@ -413,6 +423,7 @@ def get_collo_map(description, collocation, page_size, page_number, sort_order,
         'page_size': page_size,
         'page_number': page_number,
         'page_count': page_count,
+        'next_cursor': scores.next_cursor,
         'map': _map,
         'min_score': min_score,
         'score_deciles': decile_list
@@ -756,6 +767,7 @@ class ConstellationMapOut(Schema):
     page_size = Integer(required=True)
     page_number = Integer(required=True)
     page_count = Integer(required=True)
+    next_cursor = String(required=False, allow_none=True, dump_default=None)
     map = Nested(ConstellationMapItemOut(many=True))
     min_score = Float(required=True)
     score_deciles = Nested(ScoreDeciles(many=True))
@@ -862,8 +874,10 @@ def create_collocation(constellation_id, description_id, json_data):
 @bp.put("/")
 @bp.input(ConstellationCollocationIn)
 @bp.input({'create_map': Boolean(required=False, load_default=False)}, location='query', arg_name='query_coord')
+@bp.input(JobIn, location='query', arg_name='query_job')
 @bp.output(ConstellationCollocationOut)
 @bp.auth_required(auth)
+@asynchronous
 def get_or_create_collocation(constellation_id, description_id, json_data, query_coord):
     """Get collocation analysis of constellation description; create if necessary.
 
@@ -955,6 +969,7 @@ def get_collocation_items(constellation_id, description_id, collocation_id, quer
 
     page_size = query_data.pop('page_size')
     page_number = query_data.pop('page_number')
+    cursor = query_data.pop('cursor')
     sort_order = query_data.pop('sort_order')
     sort_by = query_data.pop('sort_by')
 
@@ -964,7 +979,8 @@ def get_collocation_items(constellation_id, description_id, collocation_id, quer
     )
     # TODO remove scaling
     collocation_items = get_collo_items(
-        description, collocation, page_size, page_number, sort_order, sort_by, hide_focus, hide_filter, query_coord['return_coordinates']
+        description, collocation, page_size, page_number, sort_order, sort_by, hide_focus, hide_filter, query_coord['return_coordinates'],
+        cursor=cursor
     )
 
     return ConstellationCollocationItemsOut().dump(collocation_items), 200
@@ -987,6 +1003,7 @@ def get_collocation_map(constellation_id, description_id, collocation_id, query_
 
     page_size = query_data.pop('page_size')
     page_number = query_data.pop('page_number')
+    cursor = query_data.pop('cursor')
     sort_order = query_data.pop('sort_order')
     sort_by = query_data.pop('sort_by')
     min_score = query_data.pop('min_score')
@@ -1000,7 +1017,8 @@ def get_collocation_map(constellation_id, description_id, collocation_id, query_
     )
     collocation_map = get_collo_map(
         description, collocation, page_size, page_number, sort_order, sort_by, min_score,
-        hide_focus_unigrams=hide_focus_unigrams, hide_discourseme_unigrams=hide_discourseme_unigrams, return_coordinates=return_coordinates
+        hide_focus_unigrams=hide_focus_unigrams, hide_discourseme_unigrams=hide_discourseme_unigrams, return_coordinates=return_coordinates,
+        cursor=cursor
     )
 
     return ConstellationMapOut().dump(collocation_map), 200
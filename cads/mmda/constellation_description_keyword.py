@@ -12,10 +12,13 @@ from pandas import DataFrame, concat, merge, to_numeric
 
 from .. import db
 from ..database import Corpus, Keyword, KeywordItem, KeywordItemScore
+from ..jobs import JobIn, asynchronous
 from ..keyword import (KeywordItemOut, KeywordItemsIn, KeywordItemsOut,
                        KeywordOut, ccc_keywords)
+from ..pagination import paginate_keyset
 from ..query import ccc_query
-from ..semantic_map import CoordinatesOut, ccc_semmap_init, ccc_semmap_update
+from ..semantic_map import (CoordinatesOut, ccc_semmap_init, ccc_semmap_update,
+                            get_item_coordinates)
 from ..users import auth
 from .constellation_description import expand_scores_dataframe
 from .constellation_description_collocation import (ConstellationMapItemOut,
@@ -32,21 +35,16 @@ from .discourseme_description import (DiscoursemeCoordinatesOut,
 bp = APIBlueprint('keyword', __name__, url_prefix='/<description_id>/keyword')
 
 
-def get_kw_items(description, keyword, page_size, page_number, sort_order, sort_by, return_coordinates):
+def get_kw_items(description, keyword, page_size, page_number, sort_order, sort_by, return_coordinates, cursor=None):
 
     scores = KeywordItemScore.query.filter(
         KeywordItemScore.keyword_id == keyword.id,
         KeywordItemScore.measure == sort_by
     )
 
-    # order
-    if sort_order == 'ascending':
-        scores = scores.order_by(KeywordItemScore.score)
-    elif sort_order == 'descending':
-        scores = scores.order_by(KeywordItemScore.score.desc())
-
-    # paginate
-    scores = scores.paginate(page=page_number, per_page=page_size)
+    # order and paginate
+    scores = paginate_keyset(scores, [KeywordItemScore.score, KeywordItemScore.id],
+                             sort_order == 'descending', page_number, page_size, cursor)
     nr_items = scores.total
     page_count = scores.pages
 
@@ -68,7 +66,7 @@ def get_kw_items(description, keyword, page_size, page_number, sort_order, sort_
         for discourseme_score in discourseme_scores:
             requested_items.extend([d['item'] for d in discourseme_score['item_scores']])
         ccc_semmap_update(keyword.semantic_map, requested_items)
-        coordinates = [CoordinatesOut().dump(coordinates) for coordinates in keyword.semantic_map.coordinates if coordinates.item in requested_items]
+        coordinates = [CoordinatesOut().dump(coordinates) for coordinates in get_item_coordinates(keyword.semantic_map.id, requested_items)]
 
         # discourseme coordinates
         discourseme_coordinates = get_discourseme_coordinates(keyword.semantic_map, description.discourseme_descriptions, keyword.p)
@@ -81,6 +79,7 @@ def get_kw_items(description, keyword, page_size, page_number, sort_order, sort_
         'page_size': page_size,
         'page_number': page_number,
         'page_count': page_count,
+        'next_cursor': scores.next_cursor,
         'items': items,
         'coordinates': coordinates,
         'discourseme_scores': discourseme_scores,
@@ -90,7 +89,7 @@ def get_kw_items(description, keyword, page_size, page_number, sort_order, sort_
     return keyword_items
 
 
-def get_kw_map(description, keyword, page_size, page_number, sort_order, sort_by):
+def get_kw_map(description, keyword, page_size, page_number, sort_order, sort_by, cursor=None):
 
     # filter out all items that are included in any discourseme unigram breakdown
     blacklist = []
@@ -112,14 +111,9 @@ def get_kw_map(description, keyword, page_size, page_number, sort_order, sort_by
         ~ KeywordItemScore.keyword_item_id.in_(blacklist)
     )
 
-    # order
-    if sort_order == 'ascending':
-        scores = scores.order_by(KeywordItemScore.score)
-    elif sort_order == 'descending':
-        scores = scores.order_by(KeywordItemScore.score.desc())
-
-    # pagination
-    scores = scores.paginate(page=page_number, per_page=page_size)
+    # order and paginate
+    scores = paginate_keyset(scores, [KeywordItemScore.score, KeywordItemScore.id],
+                             sort_order == 'descending', page_number, page_size, cursor)
     nr_items = scores.total
     page_count = scores.pages
 
@@ -164,7 +158,7 @@ def get_kw_map(description, keyword, page_size, page_number, sort_order, sort_by
             requested_items += list(df_discourseme_unigram_item_scores['item'])
             ccc_semmap_update(keyword.semantic_map, list(set(requested_items)))
             coordinates = DataFrame(
-                [CoordinatesOut().dump(coordinates) for coordinates in keyword.semantic_map.coordinates if coordinates.item in requested_items]
+                [CoordinatesOut().dump(coordinates) for coordinates in get_item_coordinates(keyword.semantic_map.id, requested_items)]
             )
             df_scores = merge(df_scores, coordinates, on='item', how='left')
             df_discourseme_item_scores = merge(df_discourseme_item_scores, coordinates, on='item', how='left')
@@ -192,6 +186,7 @@ def get_kw_map(description, keyword, page_size, page_number, sort_order, sort_by
         'page_size': page_size,
         'page_number': page_number,
         'page_count': page_count,
+        'next_cursor': scores.next_cursor,
         'map': _map
     }
 
@@ -445,8 +440,10 @@ class ConstellationKeywordItemsOut(KeywordItemsOut):
 
 @bp.post("/")
 @bp.input(ConstellationKeywordIn)
+@bp.input(JobIn, location='query', arg_name='query_job')
 @bp.output(KeywordOut)
 @bp.auth_required(auth)
+@asynchronous
 def create_keyword(constellation_id, description_id, json_data):
     """DEPRECATED. USE PUT INSTEAD.
 
@@ -618,6 +615,7 @@ def get_keyword_items(constellation_id, description_id, keyword_id, query_data,
 
     page_size = query_data.pop('page_size')
     page_number = query_data.pop('page_number')
+    cursor = query_data.pop('cursor')
     sort_order = query_data.pop('sort_order')
     sort_by = query_data.pop('sort_by')
 
@@ -626,7 +624,7 @@ def get_keyword_items(constellation_id, description_id, keyword_id, query_data,
         keyword, [desc for desc in description.discourseme_descriptions if desc.filter_sequence is None]
     )
     keyword_items = get_kw_items(
-        description, keyword, page_size, page_number, sort_order, sort_by, query_coord['return_coordinates']
+        description, keyword, page_size, page_number, sort_order, sort_by, query_coord['return_coordinates'], cursor
     )
 
     return ConstellationKeywordItemsOut().dump(keyword_items), 200
@@ -646,6 +644,7 @@ def get_keyword_map(constellation_id, description_id, keyword_id, query_data):
 
     page_size = query_data.pop('page_size')
     page_number = query_data.pop('page_number')
+    cursor = query_data.pop('cursor')
     sort_order = query_data.pop('sort_order')
     sort_by = query_data.pop('sort_by')
 
@@ -654,7 +653,7 @@ def get_keyword_map(constellation_id, description_id, keyword_id, query_data):
         keyword, [desc for desc in description.discourseme_descriptions if desc.filter_sequence is None]
     )
     keyword_map = get_kw_map(
-        description, keyword, page_size, page_number, sort_order, sort_by
+        description, keyword, page_size, page_number, sort_order, sort_by, cursor
     )
 
     return ConstellationMapOut().dump(keyword_map), 200
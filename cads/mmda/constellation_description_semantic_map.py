@@ -2,12 +2,11 @@
 # -*- coding: utf-8 -*-
 
 from apiflask import APIBlueprint
-from pandas import DataFrame
 
 from .. import db
 from ..breakdown import ccc_breakdown
 from ..database import Breakdown, SemanticMap, get_or_create
-from ..semantic_map import ccc_semmap_update
+from ..semantic_map import ccc_semmap_update, get_item_coordinates_df
 from ..users import auth
 from .database import ConstellationDescription, DiscoursemeCoordinates
 from .discourseme_description import (DiscoursemeCoordinatesIn,
@@ -42,8 +41,7 @@ def get_discourseme_coordinates(semantic_map, discourseme_descriptions, p=None):
             else:
                 continue
             ccc_semmap_update(semantic_map, items)  # just to be sure
-            coordinates = DataFrame([vars(s) for s in semantic_map.coordinates], columns=['x', 'y', 'x_user', 'y_user', 'item']).set_index('item')
-            item_coordinates = coordinates.loc[items]
+            item_coordinates = get_item_coordinates_df(semantic_map.id, items)
 
             # discourseme coordinates = centroid of items
             if len(item_coordinates) == 0:
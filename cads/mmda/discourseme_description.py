@@ -3,6 +3,7 @@
 
 import os
 from collections import defaultdict
+from datetime import datetime
 
 from apiflask import APIBlueprint, Schema
 from apiflask.fields import Boolean, Float, Integer, List, Nested, String
@@ -10,15 +11,19 @@ from apiflask.validators import OneOf
 from ccc.cache import generate_idx
 from ccc.utils import cqp_escape
 from flask import abort, current_app
-from semmap import SemanticSpace
 
 from .. import db
 from ..breakdown import BreakdownIn, BreakdownOut, ccc_breakdown
 from ..collocation import CollocationItemOut, CollocationScoreOut
+from ..concordance import forget_matches
 from ..corpus import rename_meta_freq
 from ..database import Breakdown, Corpus, Query, get_or_create
+from ..embeddings import most_similar
+from ..pagination import clear_count_cache
 from ..query import (QueryMetaFrequenciesIn, QueryMetaFrequenciesOut,
-                     QueryMetaFrequencyOut, get_query_meta_freq_breakdown)
+                     QueryMetaFrequencyOut, ccc_query, ccc_query_sliced,
+                     get_query_meta_freq_breakdown)
+from ..ufa import forget_ranked_lists
 from ..users import auth
 from ..utils import paginate_dataframe
 from .database import (CollocationDiscoursemeItem, Discourseme,
@@ -49,6 +54,9 @@ def delete_description_children(discourseme_description):
 
     db.session.commit()
 
+    # items of discoursemes are hidden from rankings of UFAs
+    forget_ranked_lists('collocation')
+
 
 def description_items_to_query(description_items, s_query, corpus, subcorpus=None, match_strategy='longest'):
     """query corpus or subcorpus for discourseme provided items (p + item or cqp_query)
@@ -146,7 +154,10 @@ def description_items_to_query(description_items, s_query, corpus, subcorpus=Non
     matches_df['query_id'] = query.id
     current_app.logger.debug(f"description_items_to_query :: saving {len(matches_df)} lines to database")
     matches_df.to_sql('matches', con=db.engine, if_exists='append', index=False)
+    query.modified = datetime.utcnow()
     db.session.commit()
+    clear_count_cache()
+    forget_matches(query.id)
     current_app.logger.debug("description_items_to_query :: saved to database")
 
     return query
@@ -187,6 +198,71 @@ def discourseme_template_to_description(discourseme, items, corpus_id, subcorpus
 
     return description
 
+def discourseme_descriptions_sliced(discourseme, corpus_id, subcorpus_id, slice_ids, s_query, match_strategy):
+    """get or create discourseme descriptions on disjoint subcorpora (slices) of corpus or subcorpus
+    - the query is run once on the (sub)corpus, its matches are assigned to the slices (see ccc_query_sliced)
+
+    returns description on (sub)corpus and dictionary of descriptions on slices
+    """
+
+    def get_description(subcorpus_id):
+        return DiscoursemeDescription.query.filter_by(discourseme_id=discourseme.id,
+                                                      corpus_id=corpus_id,
+                                                      subcorpus_id=subcorpus_id,
+                                                      filter_sequence=None,
+                                                      s=s_query,
+                                                      match_strategy=match_strategy).first()
+
+    descriptions = {slice_id: get_description(slice_id) for slice_id in slice_ids}
+
+    # description on (sub)corpus: use the items of existing slices
+    parent = get_description(subcorpus_id)
+    if not parent:
+        existing = [description for description in descriptions.values() if description]
+        items = [{'surface': item.surface, 'p': item.p, 'cqp_query': item.cqp_query} for item in existing[0].items] if existing else []
+        parent = discourseme_template_to_description(discourseme, items, corpus_id, subcorpus_id, s_query, match_strategy)
+    parent_query = parent._query
+
+    # new descriptions on slices share the query of the parent
+    queries = list()
+    for slice_id, description in descriptions.items():
+        if description:
+            continue
+        current_app.logger.debug(f"discourseme_descriptions_sliced :: creating description on subcorpus {slice_id}")
+        description = DiscoursemeDescription(
+            discourseme_id=discourseme.id,
+            corpus_id=corpus_id,
+            subcorpus_id=slice_id,
+            s=s_query,
+            match_strategy=match_strategy
+        )
+        db.session.add(description)
+        db.session.commit()
+        for item in parent.items:
+            description.items.append(DiscoursemeDescriptionItems(discourseme_description_id=description.id,
+                                                                 p=item.p,
+                                                                 surface=item.surface))
+        query = Query(
+            corpus_id=corpus_id,
+            subcorpus_id=slice_id,
+            cqp_query=parent_query.cqp_query,
+            s=s_query,
+            match_strategy=match_strategy
+        )
+        db.session.add(query)
+        db.session.commit()
+        description.query_id = query.id
+        db.session.commit()
+        descriptions[slice_id] = description
+        queries.append(query)
+
+    if not ccc_query_sliced(parent_query, queries):
+        for query in queries:
+            ccc_query(query, return_df=False)
+
+    return parent, descriptions
+
+
 
 ################
 # API schemata #
@@ -210,6 +286,7 @@ class DiscoursemeDescriptionSimilarIn(Schema):
     number = Integer(required=False, load_default=200)
     # min_freq = Integer(required=False, load_default=2)
     embeddings = String(required=False, load_default=None, allow_none=True)
+    nprobe = Integer(required=False, load_default=None, allow_none=True)  # recall vs. speed of ANN search; 0 = exact
 
 
 class DiscoursemeCoordinatesIn(Schema):
@@ -451,8 +528,7 @@ def description_get_similar(discourseme_id, description_id, breakdown_id, query_
     # similar
     embeddings = query_data.get('embeddings')
     embeddings = embeddings if embeddings is not None else description.corpus.embeddings
-    semspace = SemanticSpace(embeddings)
-    similar = semspace.most_similar(positive=items, n=number)
+    similar = most_similar(embeddings, positive=items, n=number, nprobe=query_data.get('nprobe'))
 
     # marginals
     freq_similar = description.corpus.ccc().marginals(similar.index, p_atts=[p])[['freq']]
@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""keyset pagination
+
+Pages are selected via `WHERE (sort key, id) > (cursor)` instead of
+`OFFSET n`, so that later pages are as fast as the first one. The total
+number of rows is counted once per statement (analysis and filters) and
+cached until matches or scores are written or deleted in this process
+(see clear_count_cache), at most for COUNT_CACHE_TTL seconds (rows
+written by other processes).
+
+"""
+
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from math import ceil
+from threading import Lock
+from time import monotonic
+
+from apiflask import abort
+from flask import current_app
+from sqlalchemy import func, select, tuple_
+
+from . import db
+
+COUNT_CACHE_SIZE = 4096
+
+_counts = OrderedDict()
+_counts_lock = Lock()
+
+
+def encode_cursor(values):
+
+    return urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+
+    try:
+        values = json.loads(urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        abort(400, 'invalid cursor')
+    if not isinstance(values, list):
+        abort(400, 'invalid cursor')
+
+    return values
+
+
+def count_key(query):
+    """canonical key of a query (SQL + parameters) for caching its row count
+
+    """
+
+    compiled = query.statement.compile(db.engine)
+    params = sorted((k, repr(v)) for k, v in compiled.params.items())
+
+    return str(compiled), tuple(params)
+
+
+def cached_count(query):
+    """count rows of query; cached per statement for at most COUNT_CACHE_TTL seconds
+
+    """
+
+    key = count_key(query)
+    ttl = current_app.config.get('COUNT_CACHE_TTL', 30)
+    with _counts_lock:
+        if key in _counts:
+            total, counted = _counts[key]
+            if monotonic() - counted < ttl:
+                _counts.move_to_end(key)
+                return total
+            del _counts[key]
+
+    counted = monotonic()
+    total = db.session.execute(
+        select(func.count()).select_from(query.order_by(None).subquery())
+    ).scalar()
+
+    with _counts_lock:
+        _counts[key] = (total, counted)
+        while len(_counts) > COUNT_CACHE_SIZE:
+            _counts.popitem(last=False)
+
+    return total
+
+
+def clear_count_cache():
+    """forget all counts; to be called whenever rows that are paginated (matches, items, scores) change
+
+    """
+
+    with _counts_lock:
+        _counts.clear()
+
+
+class KeysetPage:
+    """one page of a keyset-paginated query; mimics flask-sqlalchemy's Pagination
+
+    """
+
+    def __init__(self, items, total, page, per_page, next_cursor):
+
+        self.items = items
+        self.total = total
+        self.page = page
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+
+    @property
+    def pages(self):
+        if self.total == 0 or not self.per_page:
+            return 0
+        return ceil(self.total / self.per_page)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def paginate_keyset(query, keys, descending=False, page_number=1, page_size=10, cursor=None, total=None):
+    """paginate query on ordered (unique) keys, e.g. (score, id)
+
+    - with cursor: rows after the cursor, no OFFSET
+    - without cursor: page_number (OFFSET) for random access
+
+    always returns the cursor of the next page (None on the last page);
+    total can be provided if it has been counted on an equivalent query
+
+    rows with NULL keys cannot be compared to a cursor and are left out in both modes
+
+    """
+
+    if page_number < 1 or page_size < 1:
+        abort(404)
+
+    query = query.filter(*[key.is_not(None) for key in keys])
+    total = cached_count(query) if total is None else total
+
+    ordered = query.add_columns(*keys).order_by(*[key.desc() if descending else key for key in keys])
+    if cursor:
+        values = decode_cursor(cursor)
+        if len(values) != len(keys):
+            abort(400, 'invalid cursor')
+        if descending:
+            ordered = ordered.filter(tuple_(*keys) < tuple_(*values))
+        else:
+            ordered = ordered.filter(tuple_(*keys) > tuple_(*values))
+        rows = ordered.limit(page_size).all()
+    else:
+        rows = ordered.offset((page_number - 1) * page_size).limit(page_size).all()
+        if not rows and page_number != 1:
+            abort(404)
+
+    items = [row[0] for row in rows]
+    next_cursor = None
+    if len(rows) == page_size and (cursor or page_number * page_size < total):
+        next_cursor = encode_cursor(list(rows[-1][1:]))
+
+    return KeysetPage(items, total, page_number, page_size, next_cursor)
@@ -1,7 +1,11 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime
 from random import randint
+from threading import Lock
 
 from apiflask import APIBlueprint, Schema, abort
 from apiflask.fields import (Boolean, Float, Integer, List, Nested, String,
@@ -9,24 +13,43 @@ from apiflask.fields import (Boolean, Float, Integer, List, Nested, String,
 from apiflask.validators import OneOf
 from ccc.collocates import dump2cooc
 from ccc.utils import format_cqp_query
-from flask import current_app
-from pandas import DataFrame, read_sql
+from flask import current_app, jsonify
+from numpy import (append, arange, clip, cumsum, searchsorted, sort, unique,
+                   where)
+from numpy.random import default_rng
+from pandas import DataFrame, concat, read_sql
 from sqlalchemy import select
 from sqlalchemy.orm import aliased
 
 from . import db
 from .breakdown import BreakdownIn, BreakdownOut, ccc_breakdown
-from .collocation import CollocationIn, CollocationOut, put_counts
-from .concordance import (ConcordanceIn, ConcordanceLineIn, ConcordanceLineOut,
-                          ConcordanceOut, ccc_concordance)
-from .database import (Breakdown, Collocation, Corpus, Cotext, CotextLines,
-                       Matches, Query, get_or_create)
+from .collocation import (CollocationIn, CollocationOut, CollocationPreviewIn,
+                          CollocationPreviewOut, preview_counts,
+                          preview_scores, put_counts)
+from .concordance import (ConcordanceCacheOut, ConcordanceIn,
+                          ConcordanceLineIn, ConcordanceLineOut,
+                          ConcordanceOut, ccc_concordance, forget_matches,
+                          page_cache)
+from .cwb import corpus_streams
+from .database import (Breakdown, Collocation, CollocationItemScore, Corpus,
+                       Cotext, CotextLines, Matches, Query, SegmentationSpan,
+                       get_or_create, single_flight,
+                       subcorpus_segmentation_span)
+from .jobs import (JobIn, asynchronous, cancellable, checkpoint,
+                   current_token, default_timeout, defer, enqueue,
+                   in_background, report)
+from .pagination import clear_count_cache
 from .semantic_map import ccc_semmap_init
+from .ufa import forget_ranked_lists
 from .users import auth
-from .utils import paginate_dataframe, translate_flags
+from .utils import AMS_CUTOFF, paginate_dataframe, translate_flags
 
 bp = APIBlueprint('query', __name__, url_prefix='/query')
 
+_prefetcher = ThreadPoolExecutor(max_workers=2, thread_name_prefix='concordance-prefetch')
+_prefetching = set()
+_prefetching_lock = Lock()
+
 
 def ccc_query(query, return_df=True):
     """get or create matches of this query
@@ -42,44 +65,69 @@ def ccc_query(query, return_df=True):
     matches = Matches.query.filter_by(query_id=query.id)
 
     if not matches.first():
-
-        if query.subcorpus:
-            corpus = query.subcorpus.ccc()
-        else:
-            corpus = query.corpus.ccc()
-
-        # query corpus
-        current_app.logger.debug('ccc_query :: querying')
-        matches = corpus.query(cqp_query=query.cqp_query,
-                               context_break=query.s,
-                               match_strategy=query.match_strategy,
-                               propagate_error=True)
-
-        if isinstance(matches, str):  # error
-            current_app.logger.error(f"ccc_query :: error: '{matches}'")
-            query.error = True
-            db.session.commit()
-            return DataFrame()
-
-        if len(matches.df) == 0:  # no matches
-            current_app.logger.debug("ccc_query :: 0 matches")
-            query.zero_matches = True
+        # identical queries of other requests wait for this one
+        with single_flight('matches', query.id) as waited:
+            if waited:
+                db.session.refresh(query)
+                if query.zero_matches or query.error:
+                    return DataFrame()
+            if matches.first():
+                return ccc_query(query, return_df)
+
+            # query corpus (in parallel on shards of large corpora)
+            shards = get_shards(query)
+            if shards is not None:
+                current_app.logger.debug(f'ccc_query :: querying {len(shards)} shards')
+                matches = ccc_query_sharded(query, shards)
+            else:
+                if query.subcorpus:
+                    corpus = query.subcorpus.ccc()
+                else:
+                    corpus = query.corpus.ccc()
+                current_app.logger.debug('ccc_query :: querying')
+                report(stage='query')
+                matches = cancellable(corpus).query(cqp_query=query.cqp_query,
+                                                    context_break=query.s,
+                                                    match_strategy=query.match_strategy,
+                                                    propagate_error=True)
+            # output of killed CQP process must not be saved
+            checkpoint()
+
+            if isinstance(matches, str):  # error
+                current_app.logger.error(f"ccc_query :: error: '{matches}'")
+                query.error = True
+                db.session.commit()
+                return DataFrame()
+
+            if len(matches.df) == 0:  # no matches
+                current_app.logger.debug("ccc_query :: 0 matches")
+                query.zero_matches = True
+                db.session.commit()
+                return DataFrame()
+
+            # update name
+            query.nqr_cqp = matches.subcorpus_name
+
+            # save matches (seeded random sample if there are too many)
+            matches_df = matches.df.reset_index()[['match', 'matchend', 'contextid']]
+            query.nr_matches_total = len(matches_df)
+            cap = matches_cap(query)
+            if cap is not None and len(matches_df) > cap:
+                current_app.logger.warning(f"ccc_query :: sampling {cap} of {len(matches_df)} matches")
+                matches_df = sample_matches(matches_df, cap, query.random_seed)
+                query.sampled = True
+            matches_df['contextid'] = matches_df['contextid'].astype(int)
+            matches_df['query_id'] = query.id
+            current_app.logger.debug(f"ccc_query :: saving {len(matches_df)} lines to database")
+            report(stage='saving matches', done=0, total=len(matches_df))
+            matches_df.to_sql('matches', con=db.engine, if_exists='append', index=False)
+            query.modified = datetime.utcnow()
             db.session.commit()
-            return DataFrame()
-
-        # update name
-        query.nqr_cqp = matches.subcorpus_name
-
-        # save matches
-        matches_df = matches.df.reset_index()[['match', 'matchend', 'contextid']]
-        matches_df['contextid'] = matches_df['contextid'].astype(int)
-        matches_df['query_id'] = query.id
-        current_app.logger.debug(f"ccc_query :: saving {len(matches_df)} lines to database")
-        matches_df.to_sql('matches', con=db.engine, if_exists='append', index=False)
-        db.session.commit()
-        current_app.logger.debug("ccc_query :: saved to database")
+            clear_count_cache()
+            forget_matches(query.id)
+            current_app.logger.debug("ccc_query :: saved to database")
 
-        matches_df = matches_df.drop('query_id', axis=1).set_index(['match', 'matchend'])
+            matches_df = matches_df.drop('query_id', axis=1).set_index(['match', 'matchend'])
 
     elif return_df:
         current_app.logger.debug("ccc_query :: getting matches from database")
@@ -94,6 +142,255 @@ def ccc_query(query, return_df=True):
     return matches_df
 
 
+def matches_cap(query):
+    """maximum number of matches stored for query (None: all), see MATCHES_CAP(S)
+
+    """
+
+    if query.exact:
+        return None
+    caps = current_app.config.get('MATCHES_CAPS', {})
+    return caps.get(query.corpus.cwb_id, current_app.config.get('MATCHES_CAP'))
+
+
+def sample_matches(matches_df, size, seed):
+    """uniform random sample of matches (reproducible via seed), in corpus order
+
+    """
+
+    index = sort(default_rng(seed).choice(len(matches_df), size=size, replace=False))
+    return matches_df.iloc[index].reset_index(drop=True)
+
+
+def get_exact_query(query):
+    """get or create query with same parameters whose matches are never sampled
+
+    """
+
+    return get_or_create(Query, corpus_id=query.corpus_id, subcorpus_id=query.subcorpus_id,
+                         filter_sequence=query.filter_sequence, match_strategy=query.match_strategy,
+                         cqp_query=query.cqp_query, s=query.s, exact=True)
+
+
+def shard_spans(match, matchend, nr_shards):
+    """split sorted disjoint spans into at most nr_shards groups of consecutive spans with similar numbers of tokens
+
+    returns index of first span of each group
+    """
+
+    sizes = cumsum(matchend - match + 1)
+    # a group ends with the span that reaches its share of tokens
+    firsts = searchsorted(sizes, sizes[-1] * arange(1, nr_shards) / nr_shards) + 1
+    return unique(append(0, firsts[firsts < len(sizes)]))
+
+
+def get_shards(query):
+    """cpos ranges of the (sub)corpus of query for parallel querying (None: query in one process), see QUERY_SHARDS
+    - shards of corpora start at regions of the context break s (matches do not cross regions)
+    - shards of subcorpora are groups of consecutive subcorpus spans
+
+    returns list of DataFrames (columns: match, matchend)
+    """
+
+    nr_shards = current_app.config.get('QUERY_SHARDS', 1)
+    min_size = current_app.config.get('QUERY_SHARDS_MIN_SIZE', 0)
+    if nr_shards < 2:
+        return None
+
+    if query.subcorpus:
+        spans = DataFrame([vars(s) for s in query.subcorpus.spans], columns=['match', 'matchend']).sort_values(by='match')
+        if len(spans) < 2 or (spans['matchend'] - spans['match'] + 1).sum() < min_size:
+            return None
+        firsts = shard_spans(spans['match'].values, spans['matchend'].values, nr_shards)
+        lasts = append(firsts[1:], len(spans))
+        shards = [spans.iloc[first:last].reset_index(drop=True) for first, last in zip(firsts, lasts)]
+
+    else:
+        if query.s is None:
+            return None
+        try:
+            streams = corpus_streams(query.corpus.cwb_id, current_app.config['CCC_REGISTRY_DIR'])
+            corpus_size = streams.p('word').size
+            regions = streams.s(query.s)
+        except (FileNotFoundError, OSError) as e:
+            current_app.logger.warning(f"get_shards :: cannot read regions of '{query.s}' ({e}), querying in one process")
+            return None
+        if len(regions) < 2 or corpus_size < min_size:
+            return None
+        # shards cover the whole corpus, including tokens outside of regions
+        starts = regions.starts[shard_spans(regions.starts, regions.ends, nr_shards)]
+        starts[0] = 0
+        ends = append(starts[1:] - 1, corpus_size - 1)
+        shards = [DataFrame({'match': [start], 'matchend': [end]}) for start, end in zip(starts, ends)]
+
+    return shards if len(shards) > 1 else None
+
+
+def _query_shard(corpus, shard, token, cqp_query, context_break, match_strategy):
+
+    subcorpus = cancellable(corpus.subcorpus(subcorpus_name=None, df_dump=shard, overwrite=False), token)
+    return subcorpus.query(cqp_query=cqp_query, context_break=context_break,
+                           match_strategy=match_strategy, propagate_error=True)
+
+
+def ccc_query_sharded(query, shards):
+    """run query on shards (see get_shards) in parallel CQP processes and merge their matches in corpus order
+
+    returns ccc SubCorpus of all matches (as querying the (sub)corpus in one process) or error message of CQP
+    """
+
+    token = current_token()
+    with ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix='query-shard') as pool:
+        futures = [pool.submit(_query_shard, query.corpus.ccc(), shard, token,
+                               query.cqp_query, query.s, query.match_strategy) for shard in shards]
+        results = list()
+        try:
+            for future in futures:
+                results.append(future.result())
+                report(stage='query', done=len(results), total=len(shards))
+        except Exception:
+            # killed CQP processes of cancelled queries
+            checkpoint()
+            raise
+
+    errors = [result for result in results if isinstance(result, str)]
+    if len(errors) > 0:
+        return errors[0]
+
+    # saved as NQR like the result of querying in one process
+    df_dump = concat([result.df for result in results]).sort_index()
+    return query.corpus.ccc().subcorpus(subcorpus_name=None, df_dump=df_dump, overwrite=False)
+
+
+def preview_matches(query, nr_regions):
+    """matches of query for estimates (collocation previews) without querying the whole (sub)corpus
+    - stored matches are reused
+    - otherwise, the query is run on a random sample of nr_regions regions of its context break (spans of its
+      subcorpus) in one CQP process; the whole (sub)corpus is queried (see ccc_query) if it does not have more regions
+
+    returns matches (columns: match, matchend, ...) and sample factor (all / returned matches)
+    """
+
+    if query.zero_matches or query.error or Matches.query.filter_by(query_id=query.id).first():
+        return ccc_query(query), query.sample_factor
+
+    regions = None
+    if query.subcorpus:
+        regions = DataFrame([vars(s) for s in query.subcorpus.spans], columns=['match', 'matchend']).sort_values(by='match')
+    elif query.s is not None:
+        try:
+            structural = corpus_streams(query.corpus.cwb_id, current_app.config['CCC_REGISTRY_DIR']).s(query.s)
+            regions = DataFrame({'match': structural.starts, 'matchend': structural.ends})
+        except (FileNotFoundError, OSError) as e:
+            current_app.logger.warning(f"preview_matches :: cannot read regions of '{query.s}' ({e})")
+    if regions is None or len(regions) <= nr_regions:
+        return ccc_query(query), query.sample_factor
+
+    current_app.logger.debug(f'preview_matches :: querying {nr_regions} of {len(regions)} regions')
+    report(stage='query')
+    index = sort(default_rng(query.random_seed).choice(len(regions), size=nr_regions, replace=False))
+    matches = _query_shard(query.corpus.ccc(), regions.iloc[index].reset_index(drop=True), current_token(),
+                           query.cqp_query, query.s, query.match_strategy)
+    checkpoint()
+    if isinstance(matches, str) or len(matches.df) == 0:
+        return DataFrame(), None
+
+    return matches.df.reset_index()[['match', 'matchend']], len(regions) / nr_regions
+
+
+def get_subcorpus_spans(subcorpus_ids):
+    """get spans of subcorpora sorted by position (columns: subcorpus_id, match, matchend)
+
+    """
+
+    spans_stmt = select(
+        subcorpus_segmentation_span.c.subcorpus_id, SegmentationSpan.match, SegmentationSpan.matchend
+    ).join(
+        SegmentationSpan, SegmentationSpan.id == subcorpus_segmentation_span.c.segmentation_span_id
+    ).where(
+        subcorpus_segmentation_span.c.subcorpus_id.in_(subcorpus_ids)
+    )
+
+    return read_sql(spans_stmt, con=db.engine).sort_values(by='match').reset_index(drop=True)
+
+
+def cpos2slice(match, matchend, spans):
+    """get subcorpus of each match via the (sorted, disjoint) spans of subcorpora; -1 if match is not within any span
+
+    """
+
+    starts = spans['match'].values
+    span = clip(searchsorted(starts, match, side='right') - 1, 0, None)
+    inside = (match >= starts[span]) & (matchend <= spans['matchend'].values[span])
+
+    return where(inside, spans['subcorpus_id'].values[span], -1)
+
+
+def ccc_query_sliced(parent_query, queries):
+    """get or create matches of queries on disjoint subcorpora (slices) of the (sub)corpus of parent query
+    - the parent query is run once, its matches are assigned to the slices
+    - parent query and queries must only differ in their subcorpus
+
+    returns False if matches cannot be derived from parent query (queries have to be run on their own)
+    """
+
+    def missing(queries):
+        return [query for query in queries if not (query.zero_matches or query.error or Matches.query.filter_by(query_id=query.id).first())]
+
+    queries = missing(queries)
+    if len(queries) == 0:
+        current_app.logger.debug("ccc_query_sliced :: matches exist in database")
+        return True
+
+    subcorpus2query = {query.subcorpus_id: query for query in queries}
+    spans = get_subcorpus_spans(list(subcorpus2query.keys()))
+    if len(set(subcorpus2query.keys()) - set(spans['subcorpus_id'])) > 0 or \
+       not (spans['match'].values[1:] > spans['matchend'].values[:-1]).all():
+        current_app.logger.debug("ccc_query_sliced :: slices are not disjoint sets of spans")
+        return False
+
+    # identical queries of other requests (see ccc_query) wait for this one; locks are taken in order of ids
+    with ExitStack() as stack:
+        if any([stack.enter_context(single_flight('matches', query.id)) for query in sorted(queries, key=lambda q: q.id)]):
+            for query in queries:
+                db.session.refresh(query)
+            queries = missing(queries)
+            if len(queries) == 0:
+                return True
+            subcorpus2query = {query.subcorpus_id: query for query in queries}
+
+        current_app.logger.debug(f'ccc_query_sliced :: slicing matches of query {parent_query.id} into {len(queries)} queries')
+        matches_df = ccc_query(parent_query)
+        if parent_query.error or len(matches_df) == 0:
+            for query in queries:
+                query.error = parent_query.error
+                query.zero_matches = not parent_query.error
+            db.session.commit()
+            return True
+
+        matches_df = matches_df.reset_index()
+        subcorpus_ids = cpos2slice(matches_df['match'].values, matches_df['matchend'].values, spans)
+        matches_df['query_id'] = [subcorpus2query[s].id if s in subcorpus2query else -1 for s in subcorpus_ids]
+        matches_df = matches_df.loc[matches_df['query_id'] >= 0]
+
+        # slices of a sample are samples at the same rate
+        nr_matches = matches_df['query_id'].value_counts()
+        for query in queries:
+            query.zero_matches = query.id not in nr_matches.index
+            query.sampled = parent_query.sampled
+            query.nr_matches_total = round(int(nr_matches.get(query.id, 0)) * parent_query.sample_factor)
+            query.modified = datetime.utcnow()
+
+        current_app.logger.debug(f"ccc_query_sliced :: saving {len(matches_df)} lines to database")
+        matches_df.to_sql('matches', con=db.engine, if_exists='append', index=False)
+        db.session.commit()
+        clear_count_cache()
+        for query in queries:
+            forget_matches(query.id)
+
+    return True
+
+
 def get_or_create_query_assisted(corpus_id, subcorpus_id, items, p, s,
                                  escape, ignore_case, ignore_diacritics,
                                  focus_query=None, execute=True):
@@ -188,6 +485,15 @@ def get_or_create_query_iterative(focus_query, filter_queries, window, overlap='
     ).first()
 
     if not matches:
+        # presence of filters cannot be estimated from samples: use all their matches
+        filter_queries = dict(filter_queries)
+        for key, fq in list(filter_queries.items()):
+            ccc_query(fq, return_df=False)
+            if fq.sampled:
+                current_app.logger.debug(f"get_or_create_query_iterative :: using exact matches of filter query {fq.id}")
+                filter_queries[key] = get_exact_query(fq)
+                ccc_query(filter_queries[key], return_df=False)
+
         # create matches
         matches = filter_matches(focus_query, filter_queries, window, overlap)
         if matches is None:
@@ -196,6 +502,14 @@ def get_or_create_query_iterative(focus_query, filter_queries, window, overlap='
         df_matches['query_id'] = query.id
         df_matches.to_sql('matches', con=db.engine, if_exists='append', index=False)
 
+        # matches filtered from a sample are a sample at the same rate
+        query.sampled = focus_query.sampled
+        query.nr_matches_total = round(len(df_matches) * focus_query.sample_factor)
+        query.modified = datetime.utcnow()
+        db.session.commit()
+        clear_count_cache()
+        forget_matches(query.id)
+
     return query
 
 
@@ -205,52 +519,112 @@ def get_or_create_cotext(query, window, context_break):
 
     """
 
-    cotext = Cotext.query.filter(
-        Cotext.query_id == query.id,
-        Cotext.context >= window,
-        Cotext.context_break == context_break
-    ).first()
+    # identical requests wait for this one (cotext and its lines are saved at once, see save_cotext)
+    with single_flight('cotext', query.id, context_break):
+
+        cotext = Cotext.query.filter(
+            Cotext.query_id == query.id,
+            Cotext.context >= window,
+            Cotext.context_break == context_break
+        ).first()
+
+        if not cotext:
+
+            matches_df = ccc_query(query)
+            if len(matches_df) == 0:
+                current_app.logger.debug("get_or_create_context :: empty query")
+                return
+
+            current_app.logger.debug("get_or_create_cotext :: creating from scratch")
+
+            # create temporary ccc subcorpus (its CQP processes are registered as well, see cancellable)
+            corpus = cancellable(query.corpus.ccc())
+            subcorpus_cotext = corpus.subcorpus(
+                subcorpus_name=None,
+                df_dump=matches_df,
+                overwrite=False
+            ).set_context(
+                window,
+                context_break,
+                overwrite=False
+            )
 
-    if not cotext:
+            current_app.logger.debug("get_or_create_cotext :: .. dump2cooc")
+            report(stage='cotext', done=0, total=len(matches_df))
+            df_cooc = dump2cooc(subcorpus_cotext.df, rm_nodes=False, drop_duplicates=False)
+            df_cooc = df_cooc.rename({'match': 'match_pos'}, axis=1).reset_index(drop=True)
 
-        matches_df = ccc_query(query)
-        if len(matches_df) == 0:
-            current_app.logger.debug("get_or_create_context :: empty query")
-            return
+            current_app.logger.debug(f"get_or_create_cotext :: .. saving {len(df_cooc)} lines to database")
+            report(stage='saving cotext', done=0, total=len(df_cooc))
+            cotext = save_cotext(query.id, window, context_break, df_cooc)
+            current_app.logger.debug("get_or_create_cotext :: .. saved to database")
 
-        current_app.logger.debug("get_or_create_cotext :: creating from scratch")
-        cotext = Cotext(query_id=query.id, context=window, context_break=context_break)
-        db.session.add(cotext)
-        db.session.commit()
+        else:
+            current_app.logger.debug("get_or_create_cotext :: cotext already exists")
 
-        # create temporary ccc subcorpus
-        corpus = query.corpus.ccc()
-        subcorpus_cotext = corpus.subcorpus(
-            subcorpus_name=None,
-            df_dump=matches_df,
-            overwrite=False
-        ).set_context(
-            window,
-            context_break,
-            overwrite=False
-        )
+    return cotext
 
-        current_app.logger.debug("get_or_create_cotext :: .. dump2cooc")
-        df_cooc = dump2cooc(subcorpus_cotext.df, rm_nodes=False, drop_duplicates=False)
-        df_cooc = df_cooc.rename({'match': 'match_pos'}, axis=1).reset_index(drop=True)
-        df_cooc['cotext_id'] = cotext.id
 
-        current_app.logger.debug(f"get_or_create_cotext :: .. saving {len(df_cooc)} lines to database")
-        df_cooc.to_sql("cotext_lines", con=db.engine, if_exists='append', index=False)
-        db.session.commit()
-        current_app.logger.debug("get_or_create_cotext :: .. saved to database")
+def save_cotext(query_id, context, context_break, df_cooc):
+    """save cotext and its lines in one transaction: the cotext only becomes visible once its lines are complete
 
-    else:
-        current_app.logger.debug("get_or_create_cotext :: cotext already exists")
+    """
+
+    cotext = Cotext(query_id=query_id, context=context, context_break=context_break)
+    db.session.add(cotext)
+    db.session.flush()
+    try:
+        df_cooc.assign(cotext_id=cotext.id).to_sql("cotext_lines", con=db.session.connection(), if_exists='append', index=False)
+    except Exception:
+        db.session.rollback()
+        raise
+    db.session.commit()
 
     return cotext
 
 
+def get_or_create_cotext_sliced(parent_query, queries, window, context_break):
+    """get or create cotexts of queries on disjoint subcorpora (slices) from the cotext of parent query
+    - matches of queries must be a partition of (a subset of) the matches of parent query (see ccc_query_sliced)
+    - each line of the parent cotext is assigned to the slice its match belongs to
+
+    """
+
+    todo = list()
+    for query in queries:
+        if query.zero_matches or query.error:
+            continue
+        if not Cotext.query.filter(Cotext.query_id == query.id, Cotext.context >= window, Cotext.context_break == context_break).first():
+            todo.append(query)
+    if len(todo) == 0:
+        current_app.logger.debug("get_or_create_cotext_sliced :: cotexts already exist")
+        return
+
+    parent_cotext = get_or_create_cotext(parent_query, window, context_break)
+    if parent_cotext is None:
+        return
+
+    current_app.logger.debug(f"get_or_create_cotext_sliced :: slicing cotext of query {parent_query.id} into {len(todo)} cotexts")
+
+    # match → query
+    matches_stmt = select(Matches.match, Matches.query_id).filter(Matches.query_id.in_([query.id for query in todo]))
+    match2query = dict(db.session.execute(matches_stmt).all())
+
+    lines_stmt = select(CotextLines.match_pos, CotextLines.cpos, CotextLines.offset).filter(CotextLines.cotext_id == parent_cotext.id)
+    df_cooc = read_sql(lines_stmt, con=db.engine)
+    df_cooc['query_id'] = df_cooc['match_pos'].map(match2query)
+    lines = dict(list(df_cooc.dropna(subset=['query_id']).groupby('query_id')))
+
+    # identical requests (see get_or_create_cotext) wait for each slice
+    for query in todo:
+        with single_flight('cotext', query.id, context_break):
+            if Cotext.query.filter(Cotext.query_id == query.id, Cotext.context >= window, Cotext.context_break == context_break).first():
+                continue
+            df_query = lines.get(query.id, DataFrame(columns=['match_pos', 'cpos', 'offset']))
+            current_app.logger.debug(f"get_or_create_cotext_sliced :: saving {len(df_query)} lines of query {query.id} to database")
+            save_cotext(query.id, parent_cotext.context, context_break, df_query[['match_pos', 'cpos', 'offset']])
+
+
 def filter_matches(focus_query, filter_queries, window, overlap):
     """filter matches of focus query according to presence of filter queries in window (and focus_query.s)
 
@@ -348,6 +722,7 @@ def get_concordance_lines(query_id, query_data):
     # pagination
     page_size = query_data.get('page_size')
     page_number = query_data.get('page_number')
+    cursor = query_data.get('cursor')
 
     # sorting
     sort_order = query_data.get('sort_order')
@@ -387,13 +762,115 @@ def get_concordance_lines(query_id, query_data):
                                   highlight_queries=highlight_queries,
                                   match_id=None,
                                   filter_queries=filter_queries, overlap='partial',
-                                  page_number=page_number, page_size=page_size,
+                                  page_number=page_number, page_size=page_size, cursor=cursor,
                                   sort_order=sort_order,
                                   sort_by_offset=sort_by_offset, sort_by_p_att=sort_by_p_att, sort_by_s_att=sort_by_s_att)
 
     return concordance
 
 
+def prefetch_concordance_lines(app, query_id, query_data, keys):
+    """render concordance page in background and put it in the page cache
+
+    """
+
+    with app.app_context():
+        try:
+            concordance = ConcordanceOut().dump(get_concordance_lines(query_id, query_data))
+        except Exception as e:
+            app.logger.warning(f"prefetch_concordance_lines :: could not prefetch page of query {query_id}: {e}")
+        else:
+            for key in keys:
+                page_cache.put(key, concordance, prefetched=True)
+        finally:
+            with _prefetching_lock:
+                for key in keys:
+                    _prefetching.discard(key)
+
+
+def get_concordance_lines_cached(query, query_data):
+    """get rendered concordance page from page cache (create if necessary) and prefetch next page
+
+    """
+
+    key = page_cache.key(query, query_data)
+    concordance = page_cache.get(key)
+    if concordance is None:
+        concordance = ConcordanceOut().dump(get_concordance_lines(query.id, query_data))
+        page_cache.put(key, concordance)
+
+    # prefetch next page (to be requested via cursor or, after a page number request, via page number)
+    next_cursor = concordance.get('next_cursor')
+    if current_app.config.get('CONCORDANCE_PREFETCH', True) and next_cursor:
+        page_number = query_data.get('page_number') or 1
+        next_data = dict(query_data, page_number=page_number + 1, cursor=next_cursor)
+        keys = [page_cache.key(query, next_data)]
+        if not query_data.get('cursor'):
+            keys.append(page_cache.key(query, next_data, cursor=None))
+        with _prefetching_lock:
+            keys = [k for k in keys if k not in _prefetching and k not in page_cache]
+            _prefetching.update(keys)
+        if keys:
+            _prefetcher.submit(prefetch_concordance_lines, current_app._get_current_object(), query.id, next_data, keys)
+
+    return concordance
+
+
+def get_collocation_preview(query, p, window, s_break, marginals, query_data, arguments):
+    """response with scores of collocation analysis estimated on a random sample of matches (see preview_counts)
+    - exact analysis (get_or_create_collocation with arguments) is processed as background job unless it already exists
+      (or is already queued or running)
+
+    """
+
+    counts, sample_factor = preview_counts(query, p, window, s_break, marginals,
+                                           current_app.config.get('PREVIEW_MATCHES', 10000),
+                                           current_app.config.get('PREVIEW_BUDGET', 1),
+                                           current_app.config.get('PREVIEW_REGIONS', 10000))
+    if counts is None:
+        abort(406, 'specified cotext is empty')
+
+    # top items with scores and bounds
+    sort_by = query_data['sort_by']
+    confidence = current_app.config.get('PREVIEW_CONFIDENCE', .95)
+    scores = preview_scores(counts, sample_factor, confidence)
+    top = scores.loc[(scores['measure'] == sort_by) & (scores['score'] > AMS_CUTOFF.get(sort_by, 0))].sort_values('score', ascending=False)
+    items = [{'item': item, 'scores': scores.loc[scores['item'] == item].to_dict('records')}
+             for item in top['item'][:query_data['page_size']]]
+
+    # exact analysis
+    collocation = None
+    if not (arguments['json_data'].get('exact') and query.sampled):
+        collocation = Collocation.query.filter_by(
+            query_id=query.id,
+            p=p,
+            s_break=s_break,
+            window=window,
+            marginals=marginals
+        ).order_by(Collocation.id.desc()).first()
+    if collocation and CollocationItemScore.query.filter_by(collocation_id=collocation.id).first():
+        job = None
+    else:
+        collocation = None
+        # reloading the preview does not queue the same analysis again
+        job = defer(get_or_create_collocation, arguments, default_timeout(), reuse=True)
+
+    return jsonify(CollocationPreviewOut().dump({
+        'query_id': query.id,
+        'p': p,
+        'window': window,
+        'marginals': marginals,
+        's_break': s_break,
+        'sort_by': sort_by,
+        'nr_items': len(top),
+        'sample_factor': sample_factor,
+        'confidence': confidence,
+        'items': items,
+        'collocation_id': collocation.id if collocation else None,
+        'job': job
+    }))
+
+
 def get_query_meta_freq_breakdown(query, level, key, p, nr_bins, time_interval):
     """
 
@@ -500,6 +977,9 @@ class QueryOut(Schema):
     cqp_query = String(required=True)
     random_seed = Integer(required=True)
     number_matches = Integer(required=True)
+    sampled = Boolean(required=True, dump_default=False)
+    nr_matches_total = Integer(required=True, allow_none=True, dump_default=None,
+                               metadata={'description': 'number of matches before sampling'})
 
 
 class QueryMetaFrequencyOut(Schema):
@@ -691,8 +1171,13 @@ def delete_query(query_id):
     # TODO queries belong to users
 
     query = db.get_or_404(Query, query_id)
+    query_id = query.id
     db.session.delete(query)
     db.session.commit()
+    # including ranked lists and counts of its analyses
+    forget_ranked_lists('collocation')
+    clear_count_cache()
+    forget_matches(query_id)
 
     return 'Deletion successful.', 200
 
@@ -724,11 +1209,23 @@ def concordance_lines(query_id, query_data):
 
     """
 
-    concordance = get_concordance_lines(query_id, query_data)
+    query = db.get_or_404(Query, query_id)
+    concordance = get_concordance_lines_cached(query, query_data)
 
     return ConcordanceOut().dump(concordance), 200
 
 
+@bp.get("/concordance-cache")
+@bp.output(ConcordanceCacheOut)
+@bp.auth_required(auth)
+def concordance_cache():
+    """Get statistics of the cache of rendered concordance pages.
+
+    """
+
+    return ConcordanceCacheOut().dump(page_cache.stats()), 200
+
+
 @bp.post("/<query_id>/concordance/shuffle")
 @bp.auth_required(auth)
 @bp.output(QueryOut)
@@ -866,14 +1363,29 @@ def get_meta(query_id, query_data):
 #####################
 @bp.put("/<query_id>/collocation")
 @bp.input(CollocationIn)
+@bp.input(CollocationPreviewIn, location='query')
+@bp.input(JobIn, location='query', arg_name='query_job')
 @bp.output(CollocationOut)
 @bp.auth_required(auth)
-def get_or_create_collocation(query_id, json_data):
+@asynchronous
+def get_or_create_collocation(query_id, json_data, query_data):
     """Get collocation analysis of query (create if doesn't exist). TODO should be PUT instead?
 
+    With `preview=true`, scores are estimated on a random sample of matches within PREVIEW_BUDGET seconds
+    (CollocationPreviewOut) and the exact analysis is processed as background job.
+
     """
 
     query = db.get_or_404(Query, query_id)
+    arguments = {'query_id': query_id, 'json_data': dict(json_data), 'query_data': {**query_data, 'preview': False}}
+    preview = query_data['preview'] and not in_background()
+
+    # exact analysis of sampled query: on all matches, as background job
+    if json_data.get('exact') and query.sampled and not preview:
+        if not in_background():
+            return enqueue(get_or_create_collocation, arguments)
+        query = get_exact_query(query)
+        ccc_query(query, return_df=False)
 
     p = json_data.get('p')
     window = json_data.get('window')
@@ -902,27 +1414,32 @@ def get_or_create_collocation(query_id, json_data):
     if query.zero_matches:
         abort(406, 'query has no matches')
 
+    # preview: estimated scores now, exact analysis later
+    if preview:
+        return get_collocation_preview(query, p, window, s_break, marginals, query_data, arguments)
+
     # create collocation if doesn't exist
-    collocation = Collocation.query.filter_by(
-        query_id=query.id,
-        p=p,
-        s_break=s_break,
-        window=window,
-        marginals=marginals
-    ).order_by(Collocation.id.desc()).first()
-    if not collocation:
-        current_app.logger.debug("creating collocation analysis")
-        collocation = Collocation(
+    with single_flight('collocation', query.id, p, s_break, window, marginals):
+        collocation = Collocation.query.filter_by(
             query_id=query.id,
             p=p,
             s_break=s_break,
             window=window,
             marginals=marginals
-        )
-        db.session.add(collocation)
-        db.session.commit()
-    else:
-        current_app.logger.debug("collocation object already exists")
+        ).order_by(Collocation.id.desc()).first()
+        if not collocation:
+            current_app.logger.debug("creating collocation analysis")
+            collocation = Collocation(
+                query_id=query.id,
+                p=p,
+                s_break=s_break,
+                window=window,
+                marginals=marginals
+            )
+            db.session.add(collocation)
+            db.session.commit()
+        else:
+            current_app.logger.debug("collocation object already exists")
 
     # create counts
     counts_status = put_counts(collocation, remove_focus_cpos=True)
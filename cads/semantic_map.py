@@ -1,18 +1,26 @@
 # !/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import click
 from apiflask import APIBlueprint, Schema
 from apiflask.fields import Float, Integer, List, String
 from apiflask.validators import OneOf
 from flask import current_app
 from pandas import DataFrame
-from semmap import SemanticSpace
+from sqlalchemy import select
 
 from . import db
-from .database import Collocation, Coordinates, Keyword, SemanticMap
+from .database import (Collocation, Coordinates, Keyword, SemanticMap,
+                       single_flight)
+from .embeddings import (add2d, benchmark, build_global_layout, build_index,
+                         embedding_store, generate2d)
+from .jobs import report
 from .users import auth
 
-bp = APIBlueprint('semantic-map', __name__, url_prefix='/semantic-map')
+bp = APIBlueprint('semantic-map', __name__, url_prefix='/semantic-map', cli_group='semantic-map')
+
+# number of items per IN clause
+COORDINATES_CHUNK_SIZE = 500
 
 
 def ccc_semmap(analyses, embeddings, per_am=200, method='tsne', blacklist_items=[]):
@@ -40,8 +48,7 @@ def ccc_semmap(analyses, embeddings, per_am=200, method='tsne', blacklist_items=
         all_items = all_items.union(items)
 
     current_app.logger.debug(f'ccc_semmap :: creating coordinates for {len(all_items)} items')
-    semspace = SemanticSpace(semantic_map.embeddings, normalise=True)
-    coordinates = semspace.generate2d(list(all_items), method=semantic_map.method, parameters=None)
+    coordinates = generate2d(semantic_map.embeddings, list(all_items), method=semantic_map.method, parameters=None)
     coordinates.index.name = 'item'
     coordinates['semantic_map_id'] = semantic_map.id
     coordinates.to_sql('coordinates', con=db.engine, if_exists='append')
@@ -51,33 +58,72 @@ def ccc_semmap(analyses, embeddings, per_am=200, method='tsne', blacklist_items=
     return semantic_map
 
 
-def ccc_semmap_update(semantic_map, items):
-    """make sure there's coordinates for all items on the semantic map
+def get_item_coordinates(semantic_map_id, items=None):
+    """get coordinates of items on semantic map (all if items is None)
+
+    only requested items are fetched (index on semantic_map_id + item)
 
     """
 
-    coordinates = DataFrame([vars(s) for s in semantic_map.coordinates], columns=['x', 'y', 'x_user', 'y_user', 'item'])
-    coordinates = coordinates.set_index('item')
+    query = Coordinates.query.filter(Coordinates.semantic_map_id == semantic_map_id)
+    if items is None:
+        return query.all()
 
-    # items without coordinates
-    new_items = list(set(items) - set(coordinates.index))
-    if len(new_items) > 0:
-        current_app.logger.debug(f'ccc_semmap_update :: creating coordinates for {len(new_items)} new items')
-        semspace = SemanticSpace(semantic_map.embeddings, normalise=True)
+    items = list(dict.fromkeys(items))
+    coordinates = list()
+    for start in range(0, len(items), COORDINATES_CHUNK_SIZE):
+        coordinates.extend(query.filter(Coordinates.item.in_(items[start:start + COORDINATES_CHUNK_SIZE])).all())
 
-        if len(coordinates) == 0:
-            # create new semantic map
-            new_coordinates = semspace.generate2d(new_items, method=semantic_map.method, parameters=None)
-        else:
-            semspace.coordinates = coordinates[['x', 'y']]
-            new_coordinates = semspace.add(new_items)
+    # keep order of requested items
+    position = {item: i for i, item in enumerate(items)}
+    return sorted(coordinates, key=lambda c: position[c.item])
 
-        new_coordinates.index.name = 'item'
-        new_coordinates['semantic_map_id'] = semantic_map.id
-        new_coordinates.to_sql('coordinates', con=db.engine, if_exists='append')
-        db.session.commit()
+
+def get_item_coordinates_df(semantic_map_id, items=None):
+    """get coordinates of items on semantic map as DataFrame (index: item; columns: x, y, x_user, y_user)
+
+    """
+
+    columns = [Coordinates.item, Coordinates.x, Coordinates.y, Coordinates.x_user, Coordinates.y_user]
+    query = select(*columns).where(Coordinates.semantic_map_id == semantic_map_id)
+    if items is None:
+        rows = db.session.execute(query).all()
     else:
-        current_app.logger.debug('ccc_semmap_update :: all requested items already have coordinates')
+        items = list(dict.fromkeys(items))
+        rows = list()
+        for start in range(0, len(items), COORDINATES_CHUNK_SIZE):
+            rows.extend(db.session.execute(query.where(Coordinates.item.in_(items[start:start + COORDINATES_CHUNK_SIZE]))).all())
+
+    return DataFrame(rows, columns=['item', 'x', 'y', 'x_user', 'y_user']).set_index('item')
+
+
+def ccc_semmap_update(semantic_map, items):
+    """make sure there's coordinates for all items on the semantic map
+
+    """
+
+    # coordinates of new items depend on the existing ones: one update per semantic map at a time
+    with single_flight('coordinates', semantic_map.id):
+
+        # items without coordinates
+        existing = get_item_coordinates_df(semantic_map.id, items)
+        new_items = list(set(items) - set(existing.index))
+        if len(new_items) > 0:
+            current_app.logger.debug(f'ccc_semmap_update :: creating coordinates for {len(new_items)} new items')
+            coordinates = get_item_coordinates_df(semantic_map.id)
+
+            if len(coordinates) == 0:
+                # create new semantic map
+                new_coordinates = generate2d(semantic_map.embeddings, new_items, method=semantic_map.method, parameters=None)
+            else:
+                new_coordinates = add2d(semantic_map.embeddings, coordinates, new_items, method=semantic_map.method)
+
+            new_coordinates.index.name = 'item'
+            new_coordinates['semantic_map_id'] = semantic_map.id
+            new_coordinates.to_sql('coordinates', con=db.engine, if_exists='append')
+            db.session.commit()
+        else:
+            current_app.logger.debug('ccc_semmap_update :: all requested items already have coordinates')
 
     current_app.logger.debug('ccc_semmap_update :: exit')
 
@@ -92,6 +138,7 @@ def ccc_semmap_init(analysis, semantic_map_id=None, per_am=200, method='tsne'):
 
     """
 
+    report(stage='semantic map')
     items = analysis.top_items(per_am)
 
     if semantic_map_id:
@@ -112,8 +159,7 @@ def ccc_semmap_init(analysis, semantic_map_id=None, per_am=200, method='tsne'):
         analysis.semantic_map_id = semantic_map.id
         db.session.commit()
 
-        semspace = SemanticSpace(semantic_map.embeddings, normalise=True)
-        coordinates = semspace.generate2d(items, method=semantic_map.method, parameters=None)
+        coordinates = generate2d(semantic_map.embeddings, items, method=semantic_map.method, parameters=None)
         coordinates.index.name = 'item'
         coordinates['semantic_map_id'] = semantic_map.id
         coordinates.to_sql('coordinates', con=db.engine, if_exists='append')
@@ -287,3 +333,58 @@ def set_coordinates(id, json_data):
     db.session.commit()
 
     return [CoordinatesOut().dump(coordinates) for coordinates in semantic_map.coordinates], 200
+
+
+################
+# CLI commands #
+################
+@bp.cli.command('convert-embeddings')
+@click.argument('embeddings')
+def convert_embeddings(embeddings):
+    """Convert embeddings to shared memory-mapped matrix (done lazily otherwise).
+
+    """
+
+    store = embedding_store(embeddings)
+    if store is None:
+        raise click.ClickException(f"could not convert {embeddings}")
+    click.echo(f"{embeddings}: {len(store)} items, {store.vectors.shape[1]} dimensions")
+
+
+@bp.cli.command('build-index')
+@click.argument('embeddings')
+@click.option('--nlist', default=None, type=int, help='number of buckets (default: square root of vocabulary size)')
+@click.option('--iterations', default=10)
+@click.option('--benchmark', 'k', default=None, type=int, help='report recall@k against exact search')
+@click.option('--nprobe', default=32, help='buckets to search in benchmark')
+def build_ann_index(embeddings, nlist, iterations, k, nprobe):
+    """Build approximate nearest neighbour index for similar items.
+
+    """
+
+    store = embedding_store(embeddings)
+    if store is None:
+        raise click.ClickException(f"could not convert {embeddings}")
+    index = build_index(store, nlist=nlist, iterations=iterations)
+    click.echo(f"{embeddings}: index with {len(index)} buckets for {len(store)} items")
+
+    if k:
+        result = benchmark(store, k=k, nprobe=nprobe)
+        click.echo(f"recall@{k} (nprobe={nprobe}): {result['recall']:.3f}, "
+                   f"{result['ms_ann']:.2f} ms (exact: {result['ms_exact']:.2f} ms)")
+
+
+@bp.cli.command('build-layout')
+@click.argument('embeddings')
+@click.option('--method', default='tsne', type=click.Choice(['tsne', 'umap']))
+@click.option('--n', default=20000, help='number of (most frequent) items to lay out')
+def build_layout(embeddings, method, n):
+    """Build global 2d layout of embedding space (used if SEMANTIC_MAP_GLOBAL_LAYOUT).
+
+    """
+
+    store = embedding_store(embeddings)
+    if store is None:
+        raise click.ClickException(f"could not convert {embeddings}")
+    global_layout = build_global_layout(store, method=method, n=n)
+    click.echo(f"{embeddings}: {method} layout of {len(global_layout)} items")
@@ -1,15 +1,25 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from hashlib import sha1
+from itertools import repeat
 
 import numpy as np
 from pandas import DataFrame
 from scipy.stats import norm
 from statsmodels.gam.api import BSplines, GLMGam
-from statsmodels.nonparametric.smoothers_lowess import lowess
 from statsmodels.tools.sm_exceptions import PerfectSeparationError
 
+from .cwb import BlockCache
+
+# smoothed series per (series, method, parameters)
+_smoothings = BlockCache(256)
+
+# quantiles of confidence bands
+CI_COLUMNS = {'ci_025': 2.5, 'ci_050': 5, 'ci_950': 95, 'ci_975': 97.5}
+
 
 def calculate_time_diff(time_strings, unit='minutes'):
     """
@@ -48,27 +58,137 @@ def calculate_time_diff(time_strings, unit='minutes'):
     return time_diffs
 
 
-def loess_smoothing(x, scores, frac=.2, n_boot=10):
+def series_key(x, scores, *parameters):
+    """cache key of series and smoothing parameters
+
+    """
+
+    digest = sha1(np.asarray(x, dtype=float).tobytes())
+    digest.update(np.asarray(scores, dtype=float).tobytes())
+
+    return (digest.hexdigest(),) + parameters
+
+
+def bootstrap_indices(n, n_boot, seed=42):
+    """all bootstrap resamples of a series of length n as one (n_boot × n) array
+
+    """
+
+    return np.random.default_rng(seed).integers(0, n, size=(n_boot, n))
+
+
+def local_linear(x, y, x0, frac, robustness=None):
+    """tricube-weighted local linear fits of several series at once (LOWESS)
+
+    x, y: (series × n) observations; x0: (series × m) evaluation points;
+    each fit uses the int(frac * n) nearest neighbours of the evaluation point,
+    i.e. a window of the observations sorted by x
+    robustness: (series × n) weights of observations (default: 1)
+
+    returns (series × m) fitted values
+    """
+
+    nr_series, n = x.shape
+    k = min(max(int(frac * n + 1e-10), 2), n)
+    rows = np.arange(nr_series)[:, None]
+
+    order = np.argsort(x, axis=1, kind='stable')
+    x, y = x[rows, order], y[rows, order]
+    robustness = np.ones_like(x) if robustness is None else robustness[rows, order]
+
+    # first neighbour of each evaluation point: the window moves right while x0 is closer to its next point than to its first
+    # (one searchsorted over all series, which are shifted apart)
+    lowest = 2 * min(x.min(), x0.min())
+    shift = 2 * (max(x.max(), x0.max()) - lowest / 2) + 1
+    bounds = (x[:, :n - k] + x[:, k:] - lowest + shift * rows).ravel()
+    first = np.searchsorted(bounds, (2 * x0 - lowest + shift * rows).ravel()).reshape(x0.shape) - (n - k) * rows
+    window = (np.clip(first, 0, n - k) + rows * n)[:, :, None] + np.arange(k)
 
-    y_smoothed = lowess(scores, x, frac=frac, return_sorted=False)
+    # tricube weights within window (radius: distance to farthest neighbour)
+    dx = x.ravel()[window] - x0[:, :, None]
+    distance = np.abs(dx)
+    radius = distance.max(axis=2, keepdims=True)
+    weights = np.clip(1 - (distance / np.where(radius > 0, radius, 1)) ** 3, 0, None) ** 3 * robustness.ravel()[window]
 
-    y_boots = np.zeros((n_boot, len(x)))
-    for i in range(n_boot):
-        sample_indices = np.random.choice(np.arange(len(x)), size=len(x), replace=True)
-        y_boots[i, :] = lowess(np.array(scores)[sample_indices], np.array(x)[sample_indices], frac=frac, return_sorted=False)
+    # weighted least squares on x centred on the evaluation point
+    yw = y.ravel()[window]
+    s0, s1, s2 = weights.sum(axis=2), (weights * dx).sum(axis=2), (weights * dx ** 2).sum(axis=2)
+    t0, t1 = (weights * yw).sum(axis=2), (weights * dx * yw).sum(axis=2)
+    determinant = s0 * s2 - s1 ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fit = np.where(determinant > 1e-12 * np.maximum(s0 * s2, 1e-300),
+                       (s2 * t0 - s1 * t1) / determinant,
+                       t0 / s0)  # all neighbours at the same x: weighted mean
 
-    return DataFrame({
-        'x': x,
-        'ci_025': np.percentile(y_boots, 2.5, axis=0),
-        'ci_050': np.percentile(y_boots, 5, axis=0),
-        'smooth': y_smoothed,
-        'ci_950': np.percentile(y_boots, 95, axis=0),
-        'ci_975': np.percentile(y_boots, 97.5, axis=0)
-    })
+    return fit
+
+
+def lowess_fits(x, y, x0, frac, it=3):
+    """LOWESS of several series at once, with it robustifying iterations (bisquare weights of residuals)
+
+    """
+
+    robustness = None
+    for _ in range(it):
+        residuals = y - local_linear(x, y, x, frac, robustness)
+        scale = 6 * np.median(np.abs(residuals), axis=1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            robustness = np.where(scale > 0, np.clip(1 - (residuals / scale) ** 2, 0, None) ** 2, 1)
+
+    return local_linear(x, y, x0, frac, robustness)
+
+
+def _lowess_boot(x, scores, indices, frac):
+
+    # evaluate all resamples on the original x so that bands are aligned;
+    # chunks of resamples keep the (resamples × n × neighbours) weights small
+    chunk = max(1, 2**22 // len(x) ** 2)
+    return np.concatenate([
+        lowess_fits(x[i], scores[i], np.broadcast_to(x, (len(i), len(x))), frac)
+        for i in np.array_split(indices, range(chunk, len(indices), chunk))
+    ]) if len(indices) else np.empty((0, len(x)))
+
+
+def loess_smoothing(x, scores, frac=.2, n_boot=10, workers=1, seed=42):
+
+    key = series_key(x, scores, 'loess', frac, n_boot, seed)
+    d = _smoothings.get(key)
+    if d is not None:
+        return d.copy()
+
+    # x is scaled to [0, 1] for numerical stability of the local fits
+    x, scores = np.asarray(x, dtype=float), np.asarray(scores, dtype=float)
+    x_scaled = (x - x.min()) / (np.ptp(x) or 1)
+    y_smoothed = lowess_fits(x_scaled[None, :], scores[None, :], x_scaled[None, :], frac)[0]
+
+    # numpy releases the GIL on the large arrays of the fits
+    indices = bootstrap_indices(len(x), n_boot, seed)
+    workers = max(1, min(workers, n_boot // 100))  # threads do not pay off for few resamples
+    if workers > 1:
+        with ThreadPoolExecutor(workers, thread_name_prefix='bootstrap') as pool:
+            y_boots = np.concatenate(list(pool.map(_lowess_boot, repeat(x_scaled), repeat(scores),
+                                                   np.array_split(indices, workers), repeat(frac))))
+    else:
+        y_boots = _lowess_boot(x_scaled, scores, indices, frac)
+
+    # degenerate resamples (no weighted neighbours) yield NaNs
+    bands = np.nanpercentile(y_boots, list(CI_COLUMNS.values()), axis=0)
+    d = DataFrame({'x': x, 'smooth': y_smoothed, **dict(zip(CI_COLUMNS, bands))})
+    d = d[['x', 'ci_025', 'ci_050', 'smooth', 'ci_950', 'ci_975']]
+    _smoothings.put(key, d)
+
+    return d.copy()
 
 
 def gam_smoothing(d, df=5, degree=3):
 
+    key = series_key(d['x'], d['score'], 'gam', df, degree)
+    smoothed = _smoothings.get(key)
+    if smoothed is not None:
+        for column in smoothed.columns:
+            d[column] = smoothed[column].values
+        return d
+
     bs = BSplines(d[['x']], df=[df], degree=[degree])
     gam_bs = GLMGam.from_formula('score ~ x', data=d, smoother=bs)
     try:
@@ -89,4 +209,6 @@ def gam_smoothing(d, df=5, degree=3):
         d['ci_950'] = (d['smooth'] + norm.ppf(.95) * se_pred).clip(0, 1)
         d['ci_975'] = (d['smooth'] + norm.ppf(.975) * se_pred).clip(0, 1)
 
+    _smoothings.put(key, d[['smooth', *CI_COLUMNS]].copy())
+
     return d
@@ -1,17 +1,207 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-from apiflask import APIBlueprint, Schema
-from apiflask.fields import Float, Integer, String
-from apiflask.validators import OneOf
-from association_measures.comparisons import cohens_kappa, gwets_ac1, rbo
+from hashlib import sha1
 
-from .database import CollocationItemScore, KeywordItemScore
+from apiflask import APIBlueprint, Schema, abort
+from apiflask.fields import Float, Integer, List, Nested, String
+from apiflask.validators import Length, OneOf, Range
+from flask import Response, current_app
+from numpy import (arange, array, concatenate, errstate, full, int64, isnan,
+                   minimum, nan, unique, where, zeros)
+from sqlalchemy import select
+
+from . import db
+from .cwb import BlockCache
+from .database import (Collocation, CollocationItem, CollocationItemScore,
+                       Keyword, KeywordItem, KeywordItemScore)
 from .users import auth
 from .utils import AMS_DICT
 
 bp = APIBlueprint('ufa', __name__, url_prefix='/ufa')
 
+# score table, analysis column, item column, item table, analysis table
+ANALYSES = {
+    'collocation': (CollocationItemScore, 'collocation_id', 'collocation_item_id', CollocationItem, Collocation),
+    'keyword': (KeywordItemScore, 'keyword_id', 'keyword_item_id', KeywordItem, Keyword)
+}
+
+# limits of requests (similarities of n lists up to depth d take O(n²·d) time)
+MAX_DEPTH = 1000
+MAX_ANALYSES = 100
+
+# ranked lists per (analysis, analysis id, measure, depth, blacklist)
+_ranked_lists = BlockCache(4096)
+
+
+def forget_ranked_lists(analysis=None, analysis_ids=None):
+    """remove cached ranked lists of analyses whose scores have changed (all if analysis is None)
+
+    """
+
+    analysis_ids = None if analysis_ids is None else set(analysis_ids)
+    _ranked_lists.clear(lambda key: analysis is None or (key[0] == analysis and (analysis_ids is None or key[1] in analysis_ids)))
+
+
+def ranked_list(analysis, analysis_id, sort_by, max_depth, blacklist=None):
+    """the (at most) max_depth top-ranked items with positive scores of a collocation or keyword analysis
+
+    - ties are broken by item (in ascending order), so rankings do not depend on the order of the scores in the database
+    - blacklist: items that are not part of the ranking
+    - non-empty lists are cached per (analysis, measure, depth, blacklist)
+
+    """
+
+    blacklist = None if blacklist is None else sorted(set(blacklist))
+    key = (analysis, analysis_id, sort_by, max_depth,
+           None if blacklist is None else sha1("\n".join(blacklist).encode()).hexdigest())
+    items = _ranked_lists.get(key)
+    if items is not None:
+        return items
+
+    model, id_field, item_field, item_model, _ = ANALYSES[analysis]
+    ranking = select(item_model.item, model.score).join(
+        item_model, item_model.id == getattr(model, item_field)
+    ).where(
+        getattr(model, id_field) == analysis_id,
+        model.measure == sort_by
+    )
+    if blacklist is not None:
+        ranking = ranking.where(item_model.item.not_in(blacklist))
+    ranking = ranking.order_by(model.score.desc(), item_model.item).limit(max_depth)
+
+    items = array([item for item, score in db.session.execute(ranking) if score > 0], dtype=object)
+    if len(items) > 0:
+        _ranked_lists.put(key, items)
+
+    return items
+
+
+def prefix_overlaps(lists):
+    """sizes of intersections of all prefixes of all pairs of ranked lists, one depth at a time
+
+    yields arrays X of shape (n, n) with X[i, j] = |lists[i][:d] ∩ lists[j][:d]| for d = 1, ..., max. length
+
+    the intersection grows by the item at rank d of list i if it is within the first d items of list j and by the item
+    at rank d of list j if it is within the first d-1 items of list i; both are looked up for all pairs at once
+    (binary search in the sorted (list, item) pairs), so memory is O(n²) independent of the depth
+
+    """
+
+    n = len(lists)
+    depth = max([len(ids) for ids in lists], default=0)
+    vocabulary, inverse = unique(concatenate([zeros(0, dtype=int64)] + list(lists)), return_inverse=True)
+
+    # items per rank (padded with sentinel)
+    sentinel = len(vocabulary)
+    items = full((n, depth), sentinel, dtype=int64)
+    start = 0
+    for i, ids in enumerate(lists):
+        items[i, :len(ids)] = inverse[start:start + len(ids)]
+        start += len(ids)
+
+    # ranks of (list, item) pairs (depth + 1 = not in list)
+    keys = arange(n, dtype=int64)[:, None] * (sentinel + 1) + items
+    ranks = arange(1, depth + 1, dtype=int64)[None, :].repeat(n, axis=0)
+    listed = items != sentinel
+    keys, ranks = keys[listed], ranks[listed]
+    order = keys.argsort()
+    keys, ranks = concatenate([keys[order], [-1]]), concatenate([ranks[order], [depth + 1]])
+
+    current = zeros((n, n), dtype=int64)
+    for d in range(1, depth + 1):
+        lookup = arange(n, dtype=int64)[:, None] * (sentinel + 1) + items[None, :, d - 1]
+        position = minimum(keys[:-1].searchsorted(lookup), len(keys) - 1)
+        rank = where(keys[position] == lookup, ranks[position], depth + 1)  # rank[j, i] = rank in list j of item at rank d of list i
+        current = current + (rank.T <= d) + (rank <= d - 1)
+        yield current
+
+
+def similarity_matrix(lists, measure='rbo', p=.95):
+    """pairwise similarities of ranked lists of items
+
+    - rbo: extrapolated rank-biased overlap of the lists truncated to the shorter one (0 if lists are disjoint)
+    - gwets_ac1, cohens_kappa: agreement of sets of items, the union of both lists being the candidates
+      (1 for identical sets, nan if undefined)
+
+    agrees with the corresponding functions of association_measures.comparisons
+
+    """
+
+    if not 0 < p < 1:
+        raise ValueError("The ``p`` parameter must be between 0 and 1.")
+
+    n = len(lists)
+    if n == 0:
+        return zeros((0, 0))
+
+    lengths = array([len(ids) for ids in lists], dtype=int64)
+    if lengths.max() == 0:
+        return full((n, n), 0. if measure == 'rbo' else nan)
+
+    # RBO is accumulated over depth up to the length of the shorter list of each pair
+    s = minimum(lengths[:, None], lengths[None, :])
+    weighted = zeros((n, n))
+    weighted_s = zeros((n, n))
+    overlaps_s = zeros((n, n))
+    for d, overlaps in enumerate(prefix_overlaps(lists), 1):
+        if measure == 'rbo':
+            weighted += overlaps * (p ** d / d)
+            reached = s == d
+            weighted_s[reached] = weighted[reached]
+            overlaps_s[reached] = overlaps[reached]
+
+    # sizes of intersection and union of complete lists
+    a = overlaps.astype(float)
+    b = lengths[:, None] - a
+    c = lengths[None, :] - a
+    N = a + b + c
+
+    with errstate(divide='ignore', invalid='ignore'):
+
+        if measure == 'rbo':
+            scores = (1 - p) / p * weighted_s + p ** s * overlaps_s / where(s > 0, s, 1)
+            scores = where((a > 0) & (s > 0), scores, 0.)
+
+        elif measure == 'cohens_kappa':
+            ao = a / N
+            ae = ((a + c) * (a + b) + b * c) / N ** 2
+            scores = where(ao == 1, 1., where(ae == 1, nan, (ao - ae) / (1 - ae)))
+
+        elif measure == 'gwets_ac1':
+            ao = a / N
+            q = (a + c + a) / 2 / N
+            ae = 2 * q * (1 - q)
+            scores = where(ao == 1, 1., where(ae == 1, nan, (ao - ae) / (1 - ae)))
+
+        else:
+            raise ValueError(f"unknown measure '{measure}'")
+
+    return where(N > 0, scores, nan) if measure != 'rbo' else scores
+
+
+def matrix_to_arrow(analyses, matrix):
+    """serialise similarity matrix as Arrow IPC stream (one row and one column per analysis)
+
+    """
+
+    import pyarrow as pa
+
+    columns = {
+        'collocation_id': pa.array([a['collocation_id'] for a in analyses], type=pa.int64()),
+        'keyword_id': pa.array([a['keyword_id'] for a in analyses], type=pa.int64())
+    }
+    for k, a in enumerate(analyses):
+        name = f"collocation_{a['collocation_id']}" if a['collocation_id'] is not None else f"keyword_{a['keyword_id']}"
+        columns[name] = pa.array(matrix[:, k], type=pa.float64(), from_pandas=True)
+    table = pa.table(columns)
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue().to_pybytes()
+
 
 class UFAComparisonIn(Schema):
 
@@ -19,7 +209,7 @@ class UFAComparisonIn(Schema):
     collocation_id_right = Integer(required=False)
     keyword_id_left = Integer(required=False)
     keyword_id_right = Integer(required=False)
-    max_depth = Integer(required=False, load_default=50)
+    max_depth = Integer(required=False, load_default=50, validate=Range(min=1, max=MAX_DEPTH))
     p = Float(required=False, load_default=.95)
     sort_by = String(required=False, load_default='conservative_log_ratio', validate=OneOf(AMS_DICT.keys()))
     measure = String(required=False, load_default='rbo', validate=OneOf(['rbo', 'gwets_ac1', 'cohens_kappa']))
@@ -38,18 +228,30 @@ class UFAComparisonOut(Schema):
     measure = String(required=True)
 
 
-def get_scores(model, item_attr, id_field, id_value, sort_by, max_depth):
+class UFAMatrixIn(Schema):
+
+    collocation_ids = List(Integer, required=False, load_default=[], validate=Length(max=MAX_ANALYSES))
+    keyword_ids = List(Integer, required=False, load_default=[], validate=Length(max=MAX_ANALYSES))
+    max_depth = Integer(required=False, load_default=50, validate=Range(min=1, max=MAX_DEPTH))
+    p = Float(required=False, load_default=.95)
+    sort_by = String(required=False, load_default='conservative_log_ratio', validate=OneOf(AMS_DICT.keys()))
+    measure = String(required=False, load_default='rbo', validate=OneOf(['rbo', 'gwets_ac1', 'cohens_kappa']))
+
+
+class UFAAnalysisOut(Schema):
+
+    collocation_id = Integer(required=True, allow_none=True, dump_default=None)
+    keyword_id = Integer(required=True, allow_none=True, dump_default=None)
+
+
+class UFAMatrixOut(Schema):
 
-    if id_value is None:
-        return []
-    return [
-        (score.score, getattr(score, item_attr).item)
-        for score in model.query.filter(
-            getattr(model, id_field) == id_value,
-            model.measure == sort_by
-        ).order_by(model.score.desc())
-        .paginate(page=1, per_page=max_depth)
-    ]
+    analyses = Nested(UFAAnalysisOut(many=True), required=True)
+    matrix = List(List(Float(allow_none=True)), required=True)
+    max_depth = Integer(required=True)
+    p = Float(required=True)
+    sort_by = String(required=True)
+    measure = String(required=True)
 
 
 @bp.get("/score")
@@ -73,24 +275,16 @@ def get_score(query_data):
     if not ((collocation_id_right is None) ^ (keyword_id_right is None)):
         raise ValueError()
 
-    scores_left = get_scores(CollocationItemScore, "collocation_item", "collocation_id", collocation_id_left, sort_by, max_depth) \
-        or get_scores(KeywordItemScore, "keyword_item", "keyword_id", keyword_id_left, sort_by, max_depth)
-
-    scores_right = get_scores(CollocationItemScore, "collocation_item", "collocation_id", collocation_id_right, sort_by, max_depth) \
-        or get_scores(KeywordItemScore, "keyword_item", "keyword_id", keyword_id_right, sort_by, max_depth)
+    items_left = ranked_list('collocation', collocation_id_left, sort_by, max_depth) if collocation_id_left is not None \
+        else ranked_list('keyword', keyword_id_left, sort_by, max_depth)
 
-    items_left = [score[1] for score in scores_left if score[0] > 0]
-    items_right = [score[1] for score in scores_right if score[0] > 0]
+    items_right = ranked_list('collocation', collocation_id_right, sort_by, max_depth) if collocation_id_right is not None \
+        else ranked_list('keyword', keyword_id_right, sort_by, max_depth)
 
-    if measure == 'rbo':
-        score = rbo(items_left, items_right, p=p)[2]
-    elif measure == 'gwets_ac1':
-        score = gwets_ac1(items_left, items_right)
-    elif measure == 'cohens_kappa':
-        score = cohens_kappa(items_left, items_right)
+    score = similarity_matrix([items_left, items_right], measure, p)[0, 1]
 
     return UFAComparisonOut().dump({
-        'score': score,
+        'score': None if isnan(score) else float(score),
         'p': p,
         'max_depth': max_depth,
         'sort_by': sort_by,
@@ -100,3 +294,53 @@ def get_score(query_data):
         'keyword_id_right': keyword_id_right,
         'measure': measure
     })
+
+
+@bp.post("/matrix")
+@bp.input(UFAMatrixIn)
+@bp.input({'format': String(load_default='json', validate=OneOf(['json', 'arrow']))}, location='query')
+@bp.output(UFAMatrixOut)
+@bp.auth_required(auth)
+def get_matrix(json_data, query_data):
+    """Get pairwise similarities of collocation and keyword analyses (collocation analyses first, in given order).
+
+    Optionally as Arrow IPC stream (requires pyarrow).
+    """
+
+    max_depth = json_data.get('max_depth')
+    p = json_data.get('p')
+    sort_by = json_data.get('sort_by')
+    measure = json_data.get('measure')
+
+    analyses = [('collocation', i) for i in json_data.get('collocation_ids')] + \
+        [('keyword', i) for i in json_data.get('keyword_ids')]
+    if len(analyses) == 0:
+        return abort(400, 'no analyses to compare')
+    if len(analyses) > MAX_ANALYSES:
+        return abort(400, f'at most {MAX_ANALYSES} analyses can be compared')
+
+    lists = list()
+    for analysis, analysis_id in analyses:
+        db.get_or_404(ANALYSES[analysis][4], analysis_id)
+        lists.append(ranked_list(analysis, analysis_id, sort_by, max_depth))
+
+    current_app.logger.debug(f'get_matrix :: comparing {len(lists)} analyses')
+    matrix = similarity_matrix(lists, measure, p)
+    analyses = [{'collocation_id': i if a == 'collocation' else None,
+                 'keyword_id': i if a == 'keyword' else None} for a, i in analyses]
+
+    if query_data['format'] == 'arrow':
+        try:
+            stream = matrix_to_arrow(analyses, matrix)
+        except ImportError:
+            return abort(406, 'Arrow output requires pyarrow')
+        return Response(stream, mimetype='application/vnd.apache.arrow.stream')
+
+    return UFAMatrixOut().dump({
+        'analyses': analyses,
+        'matrix': [[None if isnan(score) else float(score) for score in row] for row in matrix],
+        'max_depth': max_depth,
+        'p': p,
+        'sort_by': sort_by,
+        'measure': measure
+    }), 200
@@ -44,6 +44,47 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     CCC_CQP_BIN = str(getenv('CQP_BIN', default='cqp'))
 
+    CONCORDANCE_CACHE_BYTES = 256 * 1024**2  # rendered concordance pages kept in memory
+    COUNT_CACHE_TTL = 30  # seconds the number of rows of paginated results is cached (rows written by other processes)
+    CONCORDANCE_PREFETCH = True  # render next concordance page in background
+
+    EMBEDDINGS_DIR = None  # converted embeddings (default: instance/embeddings)
+    EMBEDDINGS_NPROBE = 32  # buckets searched in ANN index of similar items (0 = exact search)
+    SEMANTIC_MAP_GLOBAL_LAYOUT = False  # slice semantic maps from global layouts (flask semantic-map build-layout)
+    SEMANTIC_MAP_LAYOUT_CACHE_BYTES = 512 * 1024**2  # computed layouts kept on disk
+    SEMANTIC_MAP_WARM_START_OVERLAP = .5  # minimum share of items in a cached layout to start from it
+
+    UFA_WORKERS = 4  # threads processing the slices of usage fluctuation analyses in parallel
+    UFA_ONE_PASS = True  # query and count all slices of a subcorpus collection in one pass over the (sub)corpus
+    COUNT_WORKERS = 4  # threads counting items on token streams (keyword marginals, collocation counts)
+    SMOOTHING_WORKERS = 1  # threads fitting chunks of bootstrap resamples for LOESS smoothing of UFA scores (pays off for large n_boot)
+    SMOOTHING_BOOTSTRAP = 50  # default number of bootstrap resamples for LOESS confidence bands (`?smoothing=loess`)
+
+    JOB_WORKERS = 2  # threads per process for background jobs (`?async=true`)
+    JOB_POLL_INTERVAL = 2  # seconds between checks of the job table
+    JOB_HEARTBEAT_TIMEOUT = 60  # seconds without heartbeat after which running jobs are queued again
+    JOB_EVENTS_INTERVAL = .5  # seconds between checks for progress events (server-sent events)
+    JOB_TIMEOUT = None  # default deadline in seconds of requests to heavy endpoints (None: no deadline)
+    JOB_TIMEOUTS = {}  # deadlines per endpoint, e.g. {'keyword.create_keyword': 600}
+    LOCK_DIR = None  # lock files for identical computations in concurrent requests (default: instance/locks)
+
+    MATCHES_CAP = None  # store a random sample of matches beyond this number (None: store all matches)
+    MATCHES_CAPS = {}  # caps per corpus, e.g. {'GERMAPARL1386': 100000}
+    QUERY_SHARDS = 1  # parallel CQP processes for queries on large (sub)corpora (1: query in one process)
+    QUERY_SHARDS_MIN_SIZE = 100000000  # minimum number of tokens of (sub)corpora that are queried in shards
+
+    PREVIEW_MATCHES = 10000  # maximum number of randomly sampled matches for collocation previews (`?preview=true`)
+    PREVIEW_BUDGET = 1  # seconds for querying and counting cotexts of sampled matches in collocation previews
+    PREVIEW_REGIONS = 10000  # random regions of the context break queried for previews of queries without stored matches
+    PREVIEW_CONFIDENCE = .95  # confidence level of score bounds in collocation previews
+
+    ASGI_WORKERS = 16  # threads serving light requests in ASGI mode (see cads.asgi)
+    ASGI_HEAVY_WORKERS = 4  # maximum number of heavy requests processed concurrently in ASGI mode
+    ASGI_QUEUE_TIMEOUT = 60  # seconds heavy requests wait for a free worker before 503
+    ASGI_HEAVY_ENDPOINTS = []  # further heavy endpoints besides the ones with background jobs, e.g. ['query.get_concordance']
+    ASGI_STREAM_WORKERS = 64  # maximum number of concurrently open event streams in ASGI mode
+    ASGI_STREAM_ENDPOINTS = ['job.get_job_events', 'job.get_request_events']  # long-lived streaming endpoints
+
 
 class ProdConfig(Config):
 
@@ -88,6 +129,7 @@ class TestConfig(Config):
     APP_ENV = 'testing'
 
     DB_NAME = 'mmda-test.sqlite'
+    CONCORDANCE_PREFETCH = False
     ADMIN_PASSWORD = '0000'
 
     CORPORA = 'tests/corpora/corpora.json'
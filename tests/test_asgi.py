@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+from flask import url_for
+
+from cads.asgi import ASGIApp, wsgi_environ
+
+from .test_jobs import wait_for_job
+
+
+async def asgi_request(asgi, method, path, query_string=b'', headers=dict(), disconnect=False):
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string,
+             'headers': [(name.lower().encode(), value.encode()) for name, value in headers.items()]}
+    messages = list()
+    received = list()
+
+    async def receive():
+        if not received:
+            received.append(True)
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        if disconnect:
+            return {'type': 'http.disconnect'}
+        # client stays connected
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi(scope, receive, send)
+
+    return messages
+
+
+def asgi_get(asgi, path, query_string=b'', headers=dict(), disconnect=False):
+
+    return asyncio.run(asgi_request(asgi, 'GET', path, query_string, headers, disconnect))
+
+
+def test_asgi_heavy(client):
+
+    with client:
+        client.get("/")
+        asgi = ASGIApp(client.application)
+
+        scope = {'method': 'PUT', 'path': url_for('query.get_or_create_collocation', query_id=1)}
+        assert asgi.is_heavy(wsgi_environ(scope, b''))
+        assert not asgi.is_heavy(wsgi_environ({**scope, 'query_string': b'async=true'}, b''))
+        assert not asgi.is_heavy(wsgi_environ({'method': 'GET', 'path': url_for('corpus.get_corpora')}, b''))
+
+        messages = asgi_get(asgi, "/")
+        assert messages[0]['type'] == 'http.response.start'
+        assert not messages[-1]['more_body']
+
+
+def test_asgi_unavailable(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+        asgi = ASGIApp(client.application)
+        asgi.queue_timeout = .1
+
+        async def saturated():
+            # all heavy workers busy
+            for _ in range(asgi.heavy_workers):
+                await asgi.limit.acquire()
+            heavy = await asgi_request(asgi, 'PUT', url_for('query.get_or_create_collocation', query_id=1), headers=auth_header)
+            light = await asgi_request(asgi, 'GET', url_for('corpus.get_corpora'), headers=auth_header)
+            return heavy, light
+
+        heavy, light = asyncio.run(saturated())
+        assert heavy[0]['status'] == 503
+        assert light[0]['status'] == 200
+
+
+def test_asgi_stream(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+        asgi = ASGIApp(client.application)
+
+        query = client.post(url_for('query.create'),
+                            json={
+                                'corpus_id': 1,
+                                'cqp_query': '[lemma="Bundesregierung"]',
+                                's': 's'
+                            },
+                            headers=auth_header)
+        collocation = client.put(url_for('query.get_or_create_collocation', query_id=query.json['id'], **{'async': True}),
+                                 json={'p': 'word', 'window': 7},
+                                 headers=auth_header)
+        assert collocation.status_code == 202
+        wait_for_job(client, collocation.json['id'], auth_header)
+
+        path = url_for('job.get_job_events', id=collocation.json['id'])
+        assert asgi.is_stream(wsgi_environ({'method': 'GET', 'path': path}, b''))
+        messages = asgi_get(asgi, path, headers=auth_header)
+        assert messages[0]['status'] == 200
+        assert (b'content-type', b'text/event-stream; charset=utf-8') in messages[0]['headers']
+        assert messages[-2]['more_body']
+        assert messages[-2]['body'].decode().startswith("event: finished")
+        assert not messages[-1]['more_body']
+
+        # request never arrives: events are sent until the client disconnects
+        start = time.time()
+        messages = asgi_get(asgi, url_for('job.get_request_events', request_id='test-asgi-disconnect'),
+                            headers=auth_header, disconnect=True)
+        assert time.time() - start < 10
+        assert all(message.get('more_body', True) for message in messages)
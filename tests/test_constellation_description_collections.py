@@ -231,6 +231,19 @@ def test_constellation_description_collection_ufa(client, auth):
 
         pprint(collocation_collection.json)
 
+        # bootstrapped LOESS smoothing
+        loess = client.put(url_for('mmda.constellation.description.collection.get_or_create_ufa',
+                                   constellation_id=constellation.json['id'],
+                                   collection_id=collection.json['id'],
+                                   sort_by='O11', smoothing='loess', n_boot=200),
+                           json={
+                               'focus_discourseme_id': discourseme1.json['id'],
+                               'p': 'lemma'
+                           },
+                           headers=auth_header)
+        assert loess.status_code == 200
+        assert [u['score'] for u in loess.json['ufa']] == [u['score'] for u in collocation_collection.json['ufa']]
+
 
 @pytest.mark.now
 def test_constellation_description_collection_ufa_empty(client, auth):
@@ -0,0 +1,94 @@
+import numpy as np
+
+from cads.concordance import IntervalIndex, context_boundaries
+from cads.cwb import corpus_streams, count_ids, split_spans
+
+REGISTRY_DIR = 'tests/corpora/registry/'
+
+
+def test_p_stream():
+
+    streams = corpus_streams('GERMAPARL1386', REGISTRY_DIR)
+    lemma = streams.p('lemma')
+
+    assert lemma.size == 149800
+
+    # decoded token stream agrees with frequency list
+    ids = lemma.cpos2id(np.arange(lemma.size))
+    counts = np.fromfile(f'{streams.home}/lemma.corpus.cnt', dtype='>i4')
+    assert (np.bincount(ids, minlength=len(lemma.lexicon)) == counts).all()
+
+    assert lemma.cpos2str([0, 1, 2, 3]).tolist() == ['lieb', 'Kollegin', 'und', 'Kollege']
+
+    # huffman blocks decoded together agree with blocks decoded one by one
+    blocks = np.arange(len(lemma.sync))
+    assert (lemma.decode_blocks(blocks).ravel()[:lemma.size] == np.concatenate([lemma._block(b) for b in blocks])).all()
+    assert (lemma.decode_blocks(blocks[::-1])[-1] == lemma._block(0)).all()
+    assert streams.p('word').cpos2str([1, 3]).tolist() == ['Kolleginnen', 'Kollegen']
+
+
+def test_s_stream():
+
+    streams = corpus_streams('GERMAPARL1386', REGISTRY_DIR)
+    s = streams.s('s')
+
+    assert s.cpos2struc([0, 9, 10, 18, 19]).tolist() == [0, 0, 1, 1, 2]
+
+    text_id = streams.s('text_id')
+    assert text_id.cpos2str([0]).tolist() == ['i13_86_1_1']
+    assert text_id.struc2str([-1]).tolist() == [None]
+
+
+def test_count_ids():
+
+    streams = corpus_streams('GERMAPARL1386', REGISTRY_DIR)
+    lemma = streams.p('lemma')
+    ids = lemma.cpos2id(np.arange(lemma.size))
+
+    assert (lemma.span2id(1000, 1300) == ids[1000:1301]).all()
+
+    # whole corpus in shards (in parallel threads)
+    for workers in [1, 3]:
+        counts = count_ids(lemma, match=np.array([0]), matchend=np.array([lemma.size - 1]), workers=workers, shard_size=10000)
+        assert (counts == lemma.frequencies()).all()
+
+    # spans and positions
+    match, matchend = np.array([10, 500, 90000]), np.array([20, 30000, 90005])
+    cpos = np.concatenate([np.arange(m, e + 1) for m, e in zip(match, matchend)])
+    expected = np.bincount(ids[cpos], minlength=len(lemma.lexicon))
+    assert (count_ids(lemma, match=match, matchend=matchend, workers=2, shard_size=4096) == expected).all()
+    assert (count_ids(lemma, cpos=cpos[::-1], workers=2, shard_size=4096) == expected).all()
+
+    starts, ends = split_spans(np.array([0, 10]), np.array([24, 12]), 10)
+    assert starts.tolist() == [0, 10, 20, 10]
+    assert ends.tolist() == [9, 19, 24, 12]
+
+
+def test_context_boundaries():
+
+    streams = corpus_streams('GERMAPARL1386', REGISTRY_DIR)
+    size = streams.p('word').size
+    match = np.array([0, 12, 149799])
+    matchend = np.array([1, 12, 149799])
+
+    start, end = context_boundaries(match, matchend, 5, size)
+    assert start.tolist() == [0, 7, 149794]
+    assert end.tolist() == [6, 17, 149799]
+
+    start, end = context_boundaries(match, matchend, 5, size, streams.s('s'))
+    assert start.tolist() == [0, 10, 149795]
+    assert end.tolist() == [6, 17, 149799]
+
+    start, end = context_boundaries(match, matchend, None, size, streams.s('s'))
+    assert start.tolist() == [0, 10, 149795]
+    assert end.tolist() == [9, 18, 149799]
+
+
+def test_interval_index():
+
+    index = IntervalIndex(np.array([30, 10, 20, 50]), np.array([32, 10, 25, 50]))
+    line, match, matchend = index.overlapping(np.array([0, 22, 40]), np.array([15, 31, 49]))
+
+    assert line.tolist() == [0, 1, 1]
+    assert match.tolist() == [10, 20, 30]
+    assert matchend.tolist() == [10, 25, 32]
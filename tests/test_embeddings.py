@@ -0,0 +1,97 @@
+import numpy as np
+
+from cads.embeddings import (EmbeddingStore, LayoutCache, PhraseCache,
+                             benchmark, build_global_layout, build_index,
+                             convert_embeddings)
+from pandas import DataFrame
+
+EMBEDDINGS = 'tests/corpora/embeddings/germaparl.semmap'
+
+
+def test_embedding_store(tmp_path):
+
+    paths = convert_embeddings(EMBEDDINGS, str(tmp_path))
+    assert convert_embeddings(EMBEDDINGS, str(tmp_path)) == paths
+
+    store = EmbeddingStore(*paths)
+    assert len(store) == 300
+    assert 'Regierung' in store
+    assert np.allclose(np.linalg.norm(store.get(['die', 'Regierung']).values, axis=1), 1)
+
+    similar = store.most_similar(['Regierung', 'Bundesregierung'], n=5)
+    assert len(similar) == 5
+    assert similar['similarity'].is_monotonic_decreasing
+
+
+def test_ann_index(tmp_path):
+
+    store = EmbeddingStore(*convert_embeddings(EMBEDDINGS, str(tmp_path)))
+    assert store.ann is None
+
+    index = build_index(store, nlist=8)
+    assert len(index) == 8
+    assert sorted(index.order.tolist()) == list(range(len(store)))
+
+    # probing all buckets is exact
+    exact = store.most_similar(['Regierung', 'Bundesregierung'], n=10)
+    approximate = store.most_similar(['Regierung', 'Bundesregierung'], n=10, nprobe=8)
+    assert list(approximate.index) == list(exact.index)
+
+    # index is persisted
+    assert EmbeddingStore(*convert_embeddings(EMBEDDINGS, str(tmp_path))).ann is not None
+
+    assert benchmark(store, k=10, nprobe=8, nr_queries=20)['recall'] == 1
+    assert benchmark(store, k=10, nprobe=2, nr_queries=20)['recall'] > .2
+
+
+def test_global_layout(tmp_path):
+
+    store = EmbeddingStore(*convert_embeddings(EMBEDDINGS, str(tmp_path)))
+    assert store.global_layout('tsne') is None
+
+    build_global_layout(store, method='tsne', n=100)
+    global_layout = EmbeddingStore(*convert_embeddings(EMBEDDINGS, str(tmp_path))).global_layout('tsne')
+    assert len(global_layout) == 100
+
+    # items in the layout are sliced, others are projected
+    items = store.vocabulary[:5] + store.vocabulary[-5:]
+    coordinates = global_layout.get(store, items)
+    assert list(coordinates.index) == items
+    assert np.allclose(coordinates.values[:5], global_layout.xy[:5])
+    assert not coordinates.isna().any().any()
+
+
+def test_layout_cache(tmp_path):
+
+    cache = LayoutCache(str(tmp_path), max_bytes=10000)
+    prefix = cache.prefix(EMBEDDINGS, 'tsne', None)
+    assert prefix != cache.prefix(EMBEDDINGS, 'umap', None)
+
+    items = ['a', 'b', 'c', 'd']
+    coordinates = DataFrame({'x': [0., 1., 2., 3.], 'y': [3., 2., 1., 0.]}, index=items)
+    assert cache.get(prefix, items) is None
+    cache.put(prefix, items, coordinates)
+
+    # item sets are identified regardless of order
+    assert cache.get(prefix, ['d', 'c', 'b', 'a'])['x'].tolist() == [3., 2., 1., 0.]
+
+    assert cache.most_similar(prefix, ['a', 'b', 'c', 'e'], .5) is not None
+    assert cache.most_similar(prefix, ['a', 'e', 'f', 'g'], .5) is None
+
+    # eviction by size budget
+    for i in range(50):
+        cache.put(prefix, [str(i)], DataFrame({'x': [0.], 'y': [0.]}, index=[str(i)]))
+    assert sum(path.stat().st_size for path in tmp_path.glob('*.npz')) <= 10000
+    assert cache.get(prefix, items) is None
+
+
+def test_phrase_cache(tmp_path):
+
+    cache = PhraseCache(str(tmp_path / 'phrases.sqlite'))
+    assert cache.get('germaparl', ['Angela Merkel']) == dict()
+
+    vector = np.arange(4, dtype=np.float32)
+    cache.put('germaparl', {'Angela Merkel': vector})
+
+    assert (cache.get('germaparl', ['Angela Merkel', 'Helmut Kohl'])['Angela Merkel'] == vector).all()
+    assert cache.get('other', ['Angela Merkel']) == dict()
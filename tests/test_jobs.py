@@ -0,0 +1,214 @@
+import time
+
+from flask import url_for
+
+from cads import db
+from cads.database import Corpus
+from cads.jobs import cancellable, tracking
+
+
+def wait_for_job(client, job_id, auth_header, timeout=60):
+
+    for _ in range(timeout * 10):
+        job = client.get(url_for('job.get_job', id=job_id), headers=auth_header)
+        assert job.status_code == 200
+        if job.json['state'] in ['finished', 'failed', 'cancelled']:
+            return job
+        time.sleep(.1)
+
+    raise TimeoutError(f'job {job_id} did not finish')
+
+
+def test_query_collocation_async(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        query = client.post(url_for('query.create'),
+                            json={
+                                'corpus_id': 1,
+                                'cqp_query': '[lemma="Bundesregierung"]',
+                                's': 's'
+                            },
+                            headers=auth_header)
+        assert query.status_code == 200
+
+        collocation = client.put(url_for('query.get_or_create_collocation', query_id=query.json['id'], **{'async': True}),
+                                 json={'p': 'word', 'window': 7},
+                                 headers=auth_header)
+        assert collocation.status_code == 202
+        assert collocation.json['state'] == 'queued'
+        assert collocation.headers['Location'] == url_for('job.get_job', id=collocation.json['id'])
+
+        job = wait_for_job(client, collocation.json['id'], auth_header)
+        assert job.json['state'] == 'finished'
+        assert job.json['progress'] == 1
+
+        result = client.get(job.json['result_url'], headers=auth_header)
+        assert result.status_code == 200
+
+        # same analysis as synchronous request
+        collocation = client.put(url_for('query.get_or_create_collocation', query_id=query.json['id']),
+                                 json={'p': 'word', 'window': 7},
+                                 headers=auth_header)
+        assert collocation.status_code == 200
+        assert collocation.json['id'] == result.json['id']
+
+        jobs = client.get(url_for('job.get_jobs'), headers=auth_header)
+        assert jobs.status_code == 200
+        assert job.json['id'] in [j['id'] for j in jobs.json]
+
+
+def test_job_failed(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        collocation = client.put(url_for('query.get_or_create_collocation', query_id=999999, **{'async': True}),
+                                 json={'p': 'word', 'window': 7},
+                                 headers=auth_header)
+        assert collocation.status_code == 202
+
+        job = wait_for_job(client, collocation.json['id'], auth_header)
+        assert job.json['state'] == 'failed'
+        assert job.json['result_url'] is None
+
+        result = client.get(url_for('job.get_job_result', id=job.json['id']), headers=auth_header)
+        assert result.status_code == 404
+
+
+def test_job_events(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        query = client.post(url_for('query.create'),
+                            json={
+                                'corpus_id': 1,
+                                'cqp_query': '[lemma="Regierung"]',
+                                's': 's'
+                            },
+                            headers=auth_header)
+        assert query.status_code == 200
+
+        # asynchronous
+        collocation = client.put(url_for('query.get_or_create_collocation', query_id=query.json['id'], **{'async': True}),
+                                 json={'p': 'lemma', 'window': 5},
+                                 headers=auth_header)
+        assert collocation.status_code == 202
+
+        events = client.get(url_for('job.get_job_events', id=collocation.json['id']), headers=auth_header)
+        assert events.status_code == 200
+        assert events.mimetype == 'text/event-stream'
+        events = events.get_data(as_text=True).strip().split("\n\n")
+        assert events[-1].startswith("event: finished")
+
+        # synchronous with request id
+        collocation = client.put(url_for('query.get_or_create_collocation', query_id=query.json['id']),
+                                 json={'p': 'lemma', 'window': 4},
+                                 headers={**auth_header, 'X-Request-ID': 'test-job-events'})
+        assert collocation.status_code == 200
+
+        events = client.get(url_for('job.get_request_events', request_id='test-job-events'), headers=auth_header)
+        assert events.status_code == 200
+        events = events.get_data(as_text=True).strip().split("\n\n")
+        assert events[-1].startswith("event: finished")
+        assert '"stage": "scoring"' in events[-1] or '"stage": "semantic map"' in events[-1]
+
+
+def test_job_cancel(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        query = client.post(url_for('query.create'),
+                            json={
+                                'corpus_id': 1,
+                                'cqp_query': '[lemma="Haushalt"]',
+                                's': 's'
+                            },
+                            headers=auth_header)
+        assert query.status_code == 200
+
+        collocation = client.put(url_for('query.get_or_create_collocation', query_id=query.json['id'], **{'async': True}),
+                                 json={'p': 'lemma', 'window': 6},
+                                 headers=auth_header)
+        assert collocation.status_code == 202
+
+        job = client.post(url_for('job.cancel_job', id=collocation.json['id']), headers=auth_header)
+        assert job.status_code == 200
+        assert job.json['cancel_requested']
+
+        # cancelled before or while running (or already finished)
+        job = wait_for_job(client, collocation.json['id'], auth_header)
+        assert job.json['state'] in ['cancelled', 'finished']
+        if job.json['state'] == 'cancelled':
+            result = client.get(url_for('job.get_job_result', id=job.json['id']), headers=auth_header)
+            assert result.status_code == 409
+
+
+def test_request_deadline(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        collocation = client.put(url_for('query.get_or_create_collocation', query_id=1, timeout=0),
+                                 json={'p': 'lemma', 'window': 6},
+                                 headers=auth_header)
+        assert collocation.status_code == 422
+
+
+def test_job_other_user(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        collocation = client.put(url_for('query.get_or_create_collocation', query_id=1, **{'async': True}),
+                                 json={'p': 'lemma', 'window': 5},
+                                 headers=auth_header)
+        assert collocation.status_code == 202
+        job_id = collocation.json['id']
+
+        client.post(url_for('user.create_user'),
+                    json={'username': 'jobs-other', 'password': '1111', 'confirm_password': '1111',
+                          'first_name': None, 'last_name': None, 'email': None},
+                    headers=auth_header)
+        other_header = auth.login('jobs-other', '1111')
+
+        assert client.get(url_for('job.get_job', id=job_id), headers=other_header).status_code == 404
+        assert client.get(url_for('job.get_job_result', id=job_id), headers=other_header).status_code == 404
+        assert client.get(url_for('job.get_job_events', id=job_id), headers=other_header).status_code == 404
+        assert client.post(url_for('job.cancel_job', id=job_id), headers=other_header).status_code == 404
+        assert job_id not in [job['id'] for job in client.get(url_for('job.get_jobs'), headers=other_header).json]
+
+        job = client.get(url_for('job.get_job', id=job_id), headers=auth_header)
+        assert job.status_code == 200
+        assert not job.json['cancel_requested']
+        wait_for_job(client, job_id, auth_header)
+
+
+def test_cancellable_subcorpus(client):
+
+    with client:
+        client.get("/")
+
+        with tracking() as token:
+            registered = list()
+            register = token.register
+            token.register = lambda cqp: registered.append(cqp) or register(cqp)
+
+            corpus = cancellable(db.session.get(Corpus, 1).ccc())
+            matches = corpus.query(cqp_query='[lemma="Arbeit"]', context_break='s')
+            nr_registered = len(registered)
+            assert nr_registered > 0
+
+            # subcorpora start CQP while they are initialised (and for set_context)
+            subcorpus = corpus.subcorpus(subcorpus_name=None, df_dump=matches.df, overwrite=False).set_context(5, 's', overwrite=False)
+            assert len(registered) > nr_registered
+            assert len(subcorpus.df) == len(matches.df)
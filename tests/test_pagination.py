@@ -0,0 +1,82 @@
+import time
+
+from flask import url_for
+
+from cads import db
+from cads.database import CollocationItemScore
+from cads.pagination import cached_count, clear_count_cache, paginate_keyset
+
+
+def test_paginate_keyset_null_scores(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        query = client.post(url_for('query.create'),
+                            json={
+                                'corpus_id': 1,
+                                'cqp_query': '[lemma="Arbeit"]',
+                                's': 's'
+                            },
+                            headers=auth_header)
+        assert query.status_code == 200
+
+        collocation = client.put(url_for('query.get_or_create_collocation', query_id=query.json['id']),
+                                 json={'p': 'lemma', 'window': 3},
+                                 headers=auth_header)
+        assert collocation.status_code == 200
+
+        scores = CollocationItemScore.query.filter_by(collocation_id=collocation.json['id'], measure='log_likelihood')
+        keys = [CollocationItemScore.score, CollocationItemScore.id]
+        total = paginate_keyset(scores, keys, True, 1, 5).total
+
+        # rows with NULL scores are left out in both modes (once counts are cleared)
+        score = scores.order_by(CollocationItemScore.id).first()
+        score.score = None
+        db.session.commit()
+        clear_count_cache()
+
+        page = paginate_keyset(scores, keys, True, 1, 5)
+        assert page.total == total - 1
+        offset_ids = [s.id for number in range(1, page.pages + 1) for s in paginate_keyset(scores, keys, True, number, 5)]
+
+        cursor_ids = [s.id for s in page]
+        while page.next_cursor:
+            page = paginate_keyset(scores, keys, True, 1, 5, page.next_cursor)
+            cursor_ids += [s.id for s in page]
+
+        assert offset_ids == cursor_ids
+        assert len(cursor_ids) == total - 1
+        assert score.id not in cursor_ids
+
+
+def test_cached_count_expires(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        collocation = client.put(url_for('query.get_or_create_collocation', query_id=1),
+                                 json={'p': 'lemma', 'window': 4},
+                                 headers=auth_header)
+        assert collocation.status_code == 200
+
+        scores = CollocationItemScore.query.filter_by(collocation_id=collocation.json['id'], measure='log_likelihood')
+        client.application.config['COUNT_CACHE_TTL'] = .5
+        total = cached_count(scores)
+
+        # row written without clearing the cache (e.g. by another process)
+        score = scores.first()
+        row = CollocationItemScore(collocation_id=score.collocation_id, collocation_item_id=score.collocation_item_id,
+                                   measure=score.measure, score=score.score)
+        db.session.add(row)
+        db.session.commit()
+        try:
+            time.sleep(.6)
+            assert cached_count(scores) == total + 1
+            assert paginate_keyset(scores, [CollocationItemScore.score, CollocationItemScore.id], True, 1, 5).total == total + 1
+        finally:
+            client.application.config['COUNT_CACHE_TTL'] = 30
+            db.session.delete(row)
+            db.session.commit()
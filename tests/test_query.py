@@ -1,6 +1,24 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
 from flask import url_for
 import pytest
+from numpy import array
+from pandas import DataFrame
 from pprint import pprint
+from sqlalchemy import inspect, text
+
+from cads.collocation import get_contexts, preview_scores
+from cads.concordance import (_interval_indices, forget_matches,
+                               interval_index, page_cache)
+from cads.cwb import corpus_streams
+from cads import db
+from cads.database import Matches, Query, migrate_db
+from cads.query import (ccc_query, ccc_query_sliced, cpos2slice,
+                        sample_matches, shard_spans)
+
+from .test_jobs import wait_for_job
 
 
 # @pytest.mark.now
@@ -483,3 +501,519 @@ def test_query_collocation_scores(client, auth):
         assert collocation_items.status_code == 200
 
         assert 'scaled_scores' in collocation_items.json['items'][0]
+
+
+def test_query_concordance_cursor(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        query = client.post(url_for('query.create'),
+                            json={
+                                'corpus_id': 1,
+                                'cqp_query': '[lemma="Wirtschaft"]',
+                                's': 's'
+                            },
+                            headers=auth_header)
+
+        page_1 = client.get(url_for('query.concordance_lines', query_id=query.json['id'], page_size=10, page_number=1,
+                                    sort_by_p_att='word', sort_order='ascending'),
+                            headers=auth_header)
+        assert page_1.status_code == 200
+        assert page_1.json['next_cursor'] is not None
+
+        page_2 = client.get(url_for('query.concordance_lines', query_id=query.json['id'], page_size=10, page_number=2,
+                                    sort_by_p_att='word', sort_order='ascending'),
+                            headers=auth_header)
+
+        page_2_cursor = client.get(url_for('query.concordance_lines', query_id=query.json['id'], page_size=10, page_number=2,
+                                           sort_by_p_att='word', sort_order='ascending', cursor=page_1.json['next_cursor']),
+                                   headers=auth_header)
+        assert page_2_cursor.status_code == 200
+        assert page_2_cursor.json['nr_lines'] == page_1.json['nr_lines']
+        assert [line['match_id'] for line in page_2_cursor.json['lines']] == [line['match_id'] for line in page_2.json['lines']]
+
+
+def test_query_concordance_sort_s_att(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        query = client.post(url_for('query.create'),
+                            json={
+                                'corpus_id': 1,
+                                'cqp_query': '[lemma="Wirtschaft"]',
+                                's': 's'
+                            },
+                            headers=auth_header)
+
+        lines = client.get(url_for('query.concordance_lines', query_id=query.json['id'], page_size=100, page_number=1,
+                                   sort_by_s_att='text_name', sort_order='ascending'),
+                           headers=auth_header)
+        assert lines.status_code == 200
+
+        values = [line['structural']['text_name'] for line in lines.json['lines']]
+        assert list(sorted(values)) == values
+
+        lines = client.get(url_for('query.concordance_lines', query_id=query.json['id'], page_size=100, page_number=1,
+                                   sort_by_s_att='text_name', sort_order='descending'),
+                           headers=auth_header)
+        assert lines.status_code == 200
+
+        values = [line['structural']['text_name'] for line in lines.json['lines']]
+        assert list(reversed(sorted(values))) == values
+
+
+def test_query_concordance_cache(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        query = client.post(url_for('query.create'),
+                            json={
+                                'corpus_id': 1,
+                                'cqp_query': '[lemma="Wirtschaft"]',
+                                's': 's'
+                            },
+                            headers=auth_header)
+
+        stats = client.get(url_for('query.concordance_cache'), headers=auth_header)
+        assert stats.status_code == 200
+
+        lines = client.get(url_for('query.concordance_lines', query_id=query.json['id'], page_size=5, page_number=3),
+                           headers=auth_header)
+        lines_cached = client.get(url_for('query.concordance_lines', query_id=query.json['id'], page_size=5, page_number=3),
+                                  headers=auth_header)
+        assert lines_cached.json == lines.json
+
+        stats_after = client.get(url_for('query.concordance_cache'), headers=auth_header)
+        assert stats_after.json['hits'] == stats.json['hits'] + 1
+
+
+def test_query_concordance_cache_invalidation(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        query = client.post(url_for('query.create'),
+                            json={
+                                'corpus_id': 1,
+                                'cqp_query': '[lemma="Wirtschaft"]',
+                                's': 's'
+                            },
+                            headers=auth_header)
+        url = url_for('query.concordance_lines', query_id=query.json['id'], page_size=5, page_number=3)
+        prefetch = client.application.config.get('CONCORDANCE_PREFETCH', True)
+        client.application.config['CONCORDANCE_PREFETCH'] = False
+        try:
+            lines = client.get(url, headers=auth_header)
+            assert lines.status_code == 200
+            assert any(key[0] == query.json['id'] for key in page_cache._pages)
+
+            # matches rewritten (e.g. by another process): cached pages are not used anymore
+            db.session.get(Query, query.json['id']).modified = datetime.utcnow()
+            db.session.commit()
+            stats = client.get(url_for('query.concordance_cache'), headers=auth_header)
+            client.get(url, headers=auth_header)
+            stats_after = client.get(url_for('query.concordance_cache'), headers=auth_header)
+            assert stats_after.json['misses'] == stats.json['misses'] + 1
+        finally:
+            client.application.config['CONCORDANCE_PREFETCH'] = prefetch
+
+        # deleted query: its pages are removed
+        assert client.delete(url_for('query.delete_query', query_id=query.json['id']), headers=auth_header).status_code == 200
+        assert not any(key[0] == query.json['id'] for key in page_cache._pages)
+
+
+def test_query_interval_index_invalidation(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        query = client.post(url_for('query.create'),
+                            json={
+                                'corpus_id': 1,
+                                'cqp_query': '[lemma="Wirtschaft"]',
+                                's': 's'
+                            },
+                            headers=auth_header)
+        query = db.session.get(Query, query.json['id'])
+        index = interval_index(query)
+        assert len(index) == query.number_matches
+        assert interval_index(query) is index
+
+        # new version of matches
+        query.modified = datetime.utcnow()
+        db.session.commit()
+        assert interval_index(query) is not index
+
+        forget_matches(query.id)
+        assert not any(key[0] == query.id for key in _interval_indices._data)
+
+
+def test_query_concordance_prefetch_cursor(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        query = client.post(url_for('query.create'),
+                            json={
+                                'corpus_id': 1,
+                                'cqp_query': '[lemma="Wirtschaft"]',
+                                's': 's'
+                            },
+                            headers=auth_header)
+
+        prefetch = client.application.config.get('CONCORDANCE_PREFETCH', True)
+        client.application.config['CONCORDANCE_PREFETCH'] = True
+        try:
+            # client that only follows cursors (page number is never set)
+            stats = client.get(url_for('query.concordance_cache'), headers=auth_header)
+            lines = client.get(url_for('query.concordance_lines', query_id=query.json['id'], page_size=3, sort_order='first'),
+                               headers=auth_header)
+            cursor = lines.json['next_cursor']
+            for _ in range(2):
+                for _ in range(100):
+                    if client.get(url_for('query.concordance_cache'), headers=auth_header).json['prefetches'] > stats.json['prefetches']:
+                        break
+                    time.sleep(.1)
+                stats = client.get(url_for('query.concordance_cache'), headers=auth_header)
+                lines = client.get(url_for('query.concordance_lines', query_id=query.json['id'], page_size=3, sort_order='first',
+                                           cursor=cursor),
+                                   headers=auth_header)
+                assert lines.status_code == 200
+                stats_after = client.get(url_for('query.concordance_cache'), headers=auth_header)
+                assert stats_after.json['prefetch_hits'] == stats.json['prefetch_hits'] + 1
+                cursor = lines.json['next_cursor']
+        finally:
+            client.application.config['CONCORDANCE_PREFETCH'] = prefetch
+
+
+def test_cpos2slice():
+
+    spans = DataFrame({'subcorpus_id': [2, 1, 2], 'match': [0, 10, 20], 'matchend': [5, 15, 30]})
+    slices = cpos2slice(array([0, 4, 7, 12, 14, 25]), array([1, 6, 8, 13, 14, 30]), spans)
+
+    assert slices.tolist() == [2, -1, -1, 1, 1, 2]
+
+
+# @pytest.mark.now
+def test_query_collocation_concurrent(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        query = client.post(url_for('query.create'),
+                            json={
+                                'corpus_id': 1,
+                                'cqp_query': '[lemma="Opposition"]',
+                                's': 's'
+                            },
+                            headers=auth_header)
+        assert query.status_code == 200
+        path = url_for('query.get_or_create_collocation', query_id=query.json['id'])
+
+    def put_collocation(_):
+        with client.application.test_client() as c:
+            return c.put(path, json={'p': 'lemma', 'window': 8}, headers=auth_header)
+
+    with ThreadPoolExecutor(4) as pool:
+        collocations = list(pool.map(put_collocation, range(4)))
+
+    # one computation, shared by all requests
+    assert all(collocation.status_code == 200 for collocation in collocations)
+    assert len(set(collocation.json['id'] for collocation in collocations)) == 1
+    assert len(set(collocation.json['nr_items'] for collocation in collocations)) == 1
+
+    # no duplicate matches
+    with client.application.app_context():
+        matches = Matches.query.filter_by(query_id=query.json['id']).all()
+        assert len(matches) == len(set(match.match for match in matches))
+
+
+def test_sample_matches():
+
+    matches = DataFrame({'match': range(0, 1000, 10), 'matchend': range(5, 1005, 10), 'contextid': range(100)})
+    sample = sample_matches(matches, 10, 42)
+
+    assert len(sample) == 10
+    assert sample['match'].is_monotonic_increasing
+    assert sample.equals(sample_matches(matches, 10, 42))
+    assert not sample.equals(sample_matches(matches, 10, 43))
+
+
+# @pytest.mark.now
+def test_query_collocation_sampled(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+        client.application.config['MATCHES_CAPS'] = {'GERMAPARL1386': 20}
+
+        try:
+            query = client.post(url_for('query.create'),
+                                json={
+                                    'corpus_id': 1,
+                                    'cqp_query': '[lemma="die"]',
+                                    's': 's'
+                                },
+                                headers=auth_header)
+        finally:
+            client.application.config['MATCHES_CAPS'] = {}
+
+        assert query.status_code == 200
+        assert query.json['sampled']
+        assert query.json['number_matches'] == 20
+        assert query.json['nr_matches_total'] > 20
+
+        collocation = client.put(url_for('query.get_or_create_collocation', query_id=query.json['id']),
+                                 json={'p': 'lemma', 'window': 5},
+                                 headers=auth_header)
+        assert collocation.status_code == 200
+        assert collocation.json['sampled']
+        assert abs(collocation.json['sample_factor'] - query.json['nr_matches_total'] / 20) < 1e-9
+
+        # exact analysis is processed in background
+        collocation = client.put(url_for('query.get_or_create_collocation', query_id=query.json['id']),
+                                 json={'p': 'lemma', 'window': 5, 'exact': True},
+                                 headers=auth_header)
+        assert collocation.status_code == 202
+
+
+# @pytest.mark.now
+def test_query_sliced_sampled(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        corpus = client.get(url_for('corpus.get_corpora'), headers=auth_header).json[1]
+        meta = client.get(url_for('corpus.set_meta', id=corpus['id']),
+                          json={'level': 'article', 'key': 'date', 'value_type': 'datetime'},
+                          headers=auth_header)
+        assert meta.status_code == 200
+        subcorpus_collection = client.put(url_for('corpus.create_subcorpus_collection', id=corpus['id']),
+                                          json={'level': 'article', 'key': 'date', 'time_interval': 'week', 'name': 'weeks'},
+                                          headers=auth_header)
+        assert subcorpus_collection.status_code == 200
+
+        # capped parent query
+        client.application.config['MATCHES_CAPS'] = {corpus['cwb_id']: 50}
+        try:
+            parent = client.post(url_for('query.create'),
+                                 json={'corpus_id': corpus['id'], 'cqp_query': '[lemma="der"]', 's': 's'},
+                                 headers=auth_header)
+        finally:
+            client.application.config['MATCHES_CAPS'] = {}
+        assert parent.status_code == 200
+        assert parent.json['sampled']
+
+        # slices of the sample are samples at the same rate
+        parent = db.session.get(Query, parent.json['id'])
+        queries = [Query(corpus_id=corpus['id'], subcorpus_id=subcorpus['id'], cqp_query=parent.cqp_query, s='s')
+                   for subcorpus in subcorpus_collection.json['subcorpora']]
+        db.session.add_all(queries)
+        db.session.commit()
+        assert ccc_query_sliced(parent, queries)
+
+        queries = [query for query in queries if not query.zero_matches]
+        assert len(queries) > 0
+        assert sum(query.number_matches for query in queries) <= 50
+        for query in queries:
+            assert query.sampled
+            assert abs(query.sample_factor - parent.sample_factor) / parent.sample_factor < .1
+
+
+# @pytest.mark.now
+def test_migrate_db(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        query = client.post(url_for('query.create'),
+                            json={'corpus_id': 1, 'cqp_query': '[lemma="Bundesregierung"]', 's': 's'},
+                            headers=auth_header)
+        assert query.status_code == 200
+
+        # database created before matches could be sampled
+        with db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE "query" DROP COLUMN "sampled"'))
+            connection.execute(text('ALTER TABLE "collocation" DROP COLUMN "sample_factor"'))
+        migrate_db()
+
+        columns = {column['name'] for column in inspect(db.engine).get_columns('query')}
+        assert 'sampled' in columns
+        columns = {column['name'] for column in inspect(db.engine).get_columns('collocation')}
+        assert 'sample_factor' in columns
+
+        db.session.expire_all()
+        assert db.session.get(Query, query.json['id']).sampled is False
+        collocation = client.put(url_for('query.get_or_create_collocation', query_id=query.json['id']),
+                                 json={'p': 'lemma', 'window': 5},
+                                 headers=auth_header)
+        assert collocation.status_code == 200
+
+
+def test_preview_scores():
+
+    counts = DataFrame({
+        'f': [5, 40, 1],
+        'f1': [200, 200, 200],
+        'f2': [500, 60, 1000],
+        'N': [100000, 100000, 100000]
+    }, index=['a', 'b', 'c'])
+    counts.index.name = 'id'
+
+    scores = preview_scores(counts, sample_factor=10, confidence=.95).set_index(['item', 'measure'])
+    assert (scores['lower'] <= scores['score'] + 1e-9).all()
+    assert (scores['score'] <= scores['upper'] + 1e-9).all()
+
+    # estimated frequency on all matches, clipped to marginal frequency
+    assert scores.loc[('a', 'O11'), 'score'] == 50
+    assert scores.loc[('b', 'O11'), 'score'] == 60
+    assert scores.loc[('a', 'O11'), 'lower'] < 50 < scores.loc[('a', 'O11'), 'upper']
+
+
+def test_query_collocation_preview(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        query = client.post(url_for('query.create'),
+                            json={
+                                'corpus_id': 1,
+                                'cqp_query': '[lemma="sein"]',
+                                's': 's'
+                            },
+                            headers=auth_header)
+        assert query.status_code == 200
+
+        client.application.config['PREVIEW_MATCHES'] = 50
+        try:
+            preview = client.put(url_for('query.get_or_create_collocation', query_id=query.json['id'], preview=True),
+                                 json={'p': 'lemma', 'window': 5},
+                                 headers=auth_header)
+        finally:
+            client.application.config['PREVIEW_MATCHES'] = 10000
+        assert preview.status_code == 200
+        assert preview.json['sample_factor'] >= 1
+        assert len(preview.json['items']) > 0
+        for score in preview.json['items'][0]['scores']:
+            assert score['lower'] <= score['score'] <= score['upper']
+
+        # exact analysis in background (queued only once)
+        assert preview.json['collocation_id'] is None
+        reload = client.put(url_for('query.get_or_create_collocation', query_id=query.json['id'], preview=True),
+                            json={'p': 'lemma', 'window': 5},
+                            headers=auth_header)
+        assert reload.status_code == 200
+        assert reload.json['job'] is None or reload.json['job']['id'] == preview.json['job']['id']
+        job = wait_for_job(client, preview.json['job']['id'], auth_header)
+        assert job.json['state'] == 'finished'
+        collocation = client.get(job.json['result_url'], headers=auth_header)
+        assert collocation.status_code == 200
+
+        # exact analysis exists
+        preview = client.put(url_for('query.get_or_create_collocation', query_id=query.json['id'], preview=True),
+                             json={'p': 'lemma', 'window': 5},
+                             headers=auth_header)
+        assert preview.status_code == 200
+        assert preview.json['collocation_id'] == collocation.json['id']
+        assert preview.json['job'] is None
+
+
+def test_get_contexts(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        query = client.post(url_for('query.create'),
+                            json={'corpus_id': 1, 'cqp_query': '[lemma="Bundesregierung"]', 's': 's'},
+                            headers=auth_header)
+        assert query.status_code == 200
+
+        # same contexts as cwb-ccc
+        query = db.session.get(Query, query.json['id'])
+        matches_df = ccc_query(query)
+        contexts = get_contexts(query.corpus, matches_df, 5, 's')
+        expected = query.corpus.ccc().subcorpus(subcorpus_name=None, df_dump=matches_df, overwrite=False).set_context(5, 's', overwrite=False).df
+        assert contexts[['context', 'contextend']].sort_index().equals(expected[['context', 'contextend']].astype(contexts['context'].dtype).sort_index())
+
+
+def test_query_collocation_preview_not_executed(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        query = client.post(url_for('query.create', execute=False),
+                            json={'corpus_id': 1, 'cqp_query': '[lemma="sein"]', 's': 's'},
+                            headers=auth_header)
+        assert query.status_code == 200
+
+        # query is run on a sample of sentences
+        client.application.config['PREVIEW_REGIONS'] = 1000
+        try:
+            preview = client.put(url_for('query.get_or_create_collocation', query_id=query.json['id'], preview=True),
+                                 json={'p': 'lemma', 'window': 5},
+                                 headers=auth_header)
+        finally:
+            client.application.config['PREVIEW_REGIONS'] = 10000
+        assert preview.status_code == 200
+        assert preview.json['sample_factor'] > 1
+        assert len(preview.json['items']) > 0
+
+        job = wait_for_job(client, preview.json['job']['id'], auth_header)
+        assert job.json['state'] == 'finished'
+
+
+def test_shard_spans():
+
+    assert shard_spans(array([0, 10, 20, 30]), array([9, 19, 29, 39]), 2).tolist() == [0, 2]
+    assert shard_spans(array([0, 10, 20, 30]), array([9, 19, 29, 39]), 8).tolist() == [0, 1, 2, 3]
+    assert shard_spans(array([0, 100, 110]), array([99, 109, 119]), 3).tolist() == [0, 1]
+
+    # shards of test corpus start at sentences and have similar sizes
+    regions = corpus_streams('GERMAPARL1386', 'tests/corpora/registry/').s('s')
+    firsts = shard_spans(regions.starts, regions.ends, 4)
+    assert len(firsts) == 4
+    sizes = [b - a for a, b in zip(regions.starts[firsts], list(regions.starts[firsts[1:]]) + [regions.ends[-1] + 1])]
+    assert max(sizes) - min(sizes) < 1000
+
+
+def test_query_sharded(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        matches = dict()
+        for shards in [1, 4]:
+            client.application.config.update(QUERY_SHARDS=shards, QUERY_SHARDS_MIN_SIZE=0)
+            try:
+                query = client.post(url_for('query.create'),
+                                    json={
+                                        'corpus_id': 1,
+                                        'cqp_query': '[pos="ADJA"] [lemma="Antrag"]',
+                                        's': 's'
+                                    },
+                                    headers=auth_header)
+            finally:
+                client.application.config.update(QUERY_SHARDS=1)
+            assert query.status_code == 200
+            matches[shards] = [(m.match, m.matchend, m.contextid) for m in
+                               Matches.query.filter_by(query_id=query.json['id']).order_by(Matches.match)]
+
+        # same matches as in one process
+        assert len(matches[1]) > 0
+        assert matches[4] == matches[1]
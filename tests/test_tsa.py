@@ -0,0 +1,41 @@
+from numpy import arange, sin
+from numpy.random import default_rng
+from pandas import DataFrame
+
+from statsmodels.nonparametric.smoothers_lowess import lowess
+
+from cads.tsa import bootstrap_indices, gam_smoothing, loess_smoothing
+
+
+def test_bootstrap_indices():
+
+    indices = bootstrap_indices(20, 100)
+    assert indices.shape == (100, 20)
+    assert indices.min() >= 0 and indices.max() < 20
+    assert (indices == bootstrap_indices(20, 100)).all()
+
+
+def test_loess_smoothing():
+
+    x = arange(30) * 86400.
+    scores = .5 + .2 * sin(arange(30) / 5) + default_rng(1).normal(0, .05, 30)
+
+    d = loess_smoothing(x, scores, n_boot=200)
+    assert len(d) == 30
+    assert not d.isna().any().any()
+    assert (d['ci_025'] <= d['ci_050']).all() and (d['ci_950'] <= d['ci_975']).all()
+
+    # cached
+    assert d.equals(loess_smoothing(x, scores, n_boot=200))
+
+    # resamples in threads
+    parallel = loess_smoothing(x, scores, n_boot=200, workers=2, seed=1)
+    assert (parallel['smooth'] == d['smooth']).all()
+    assert not parallel.isna().any().any()
+
+    # same fit as statsmodels (on distinct x)
+    assert abs(d['smooth'] - lowess(scores, x, frac=.2, return_sorted=False)).max() < 1e-8
+
+    # GAM smoothing is cached as well
+    gam = gam_smoothing(DataFrame({'x': x, 'score': scores}))
+    assert gam.equals(gam_smoothing(DataFrame({'x': x, 'score': scores})))
@@ -0,0 +1,143 @@
+from association_measures.comparisons import cohens_kappa, gwets_ac1, rbo
+from flask import url_for
+from numpy import array, isnan
+from pandas import read_sql
+from sqlalchemy import select
+
+from cads import db
+from cads.database import CollocationItem, CollocationItemScore
+from cads.ufa import (MAX_ANALYSES, MAX_DEPTH, forget_ranked_lists,
+                      prefix_overlaps, ranked_list, similarity_matrix)
+
+
+def test_prefix_overlaps():
+
+    overlaps = array(list(prefix_overlaps([array([1, 2, 3]), array([3, 2]), array([])])))
+
+    assert overlaps[:, 0, 1].tolist() == [0, 1, 2]
+    assert overlaps[:, 1, 0].tolist() == [0, 1, 2]
+    assert overlaps[:, 0, 0].tolist() == [1, 2, 3]
+    assert overlaps[:, 0, 2].tolist() == [0, 0, 0]
+
+
+def test_similarity_matrix():
+
+    lists = [
+        array([1, 2, 3, 4, 5, 6]),
+        array([2, 1, 7, 3]),
+        array([8, 9]),
+        array([6, 5, 4, 3, 2, 1, 10]),
+        array([])
+    ]
+
+    for measure, comparison in [('rbo', lambda left, right: rbo(left, right, p=.9)[2]),
+                                ('gwets_ac1', gwets_ac1),
+                                ('cohens_kappa', cohens_kappa)]:
+        matrix = similarity_matrix(lists, measure, p=.9)
+        assert matrix.shape == (5, 5)
+        assert (abs(matrix.diagonal()[:4] - 1) < 1e-9).all()
+        for i, left in enumerate(lists):
+            for j, right in enumerate(lists):
+                if i == j:
+                    continue
+                try:
+                    expected = comparison(left.tolist(), right.tolist())
+                except ZeroDivisionError:
+                    expected = None
+                if expected is None:
+                    assert isnan(matrix[i, j])
+                else:
+                    assert abs(matrix[i, j] - expected) < 1e-9
+
+
+def test_ufa_matrix(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        collocation_ids = list()
+        for cqp_query in ['[lemma="CDU"]', '[lemma="CSU"]', '[lemma="SPD"]']:
+            query = client.post(url_for('query.create'),
+                                json={
+                                    'corpus_id': 1,
+                                    'cqp_query': cqp_query,
+                                    's': 's'
+                                },
+                                headers=auth_header)
+            assert query.status_code == 200
+
+            collocation = client.put(url_for('query.get_or_create_collocation', query_id=query.json['id']),
+                                     json={'p': 'lemma', 'window': 10},
+                                     headers=auth_header)
+            assert collocation.status_code == 200
+            collocation_ids.append(collocation.json['id'])
+
+        matrix = client.post(url_for('ufa.get_matrix'),
+                             json={'collocation_ids': collocation_ids},
+                             headers=auth_header)
+        assert matrix.status_code == 200
+        assert len(matrix.json['matrix']) == 3
+
+        # agrees with pairwise comparison
+        score = client.get(url_for('ufa.get_score',
+                                   collocation_id_left=collocation_ids[0],
+                                   collocation_id_right=collocation_ids[2]),
+                           headers=auth_header)
+        assert score.status_code == 200
+        assert abs(matrix.json['matrix'][0][2] - score.json['score']) < 1e-9
+
+        # size of requests is bounded
+        matrix = client.post(url_for('ufa.get_matrix'),
+                             json={'collocation_ids': collocation_ids, 'max_depth': MAX_DEPTH + 1},
+                             headers=auth_header)
+        assert matrix.status_code == 422
+        matrix = client.post(url_for('ufa.get_matrix'),
+                             json={'collocation_ids': collocation_ids * MAX_ANALYSES},
+                             headers=auth_header)
+        assert matrix.status_code == 422
+        matrix = client.post(url_for('ufa.get_matrix'),
+                             json={'collocation_ids': collocation_ids, 'keyword_ids': list(range(MAX_ANALYSES))},
+                             headers=auth_header)
+        assert matrix.status_code == 400
+
+        # rankings are cached per blacklist
+        ranking = ranked_list('collocation', collocation_ids[0], 'conservative_log_ratio', 10)
+        assert len(ranking) > 0
+        hidden = ranked_list('collocation', collocation_ids[0], 'conservative_log_ratio', 10, blacklist=[ranking[0]])
+        assert ranking[0] not in hidden
+        assert ranked_list('collocation', collocation_ids[0], 'conservative_log_ratio', 10)[0] == ranking[0]
+
+        forget_ranked_lists('collocation', [collocation_ids[0]])
+        assert (ranked_list('collocation', collocation_ids[0], 'conservative_log_ratio', 10) == ranking).all()
+
+
+def test_ranked_list_ties(client, auth):
+
+    auth_header = auth.login()
+    with client:
+        client.get("/")
+
+        query = client.post(url_for('query.create'),
+                            json={'corpus_id': 1, 'cqp_query': '[lemma="Bundesregierung"]', 's': 's'},
+                            headers=auth_header)
+        assert query.status_code == 200
+        collocation = client.put(url_for('query.get_or_create_collocation', query_id=query.json['id']),
+                                 json={'p': 'lemma', 'window': 10},
+                                 headers=auth_header)
+        assert collocation.status_code == 200
+
+        # frequencies are tied for many items
+        scores = read_sql(select(CollocationItem.item, CollocationItemScore.score).join(
+            CollocationItem, CollocationItem.id == CollocationItemScore.collocation_item_id
+        ).where(
+            CollocationItemScore.collocation_id == collocation.json['id'],
+            CollocationItemScore.measure == 'O11'
+        ), con=db.engine)
+        expected = scores.loc[scores['score'] > 0].sort_values(['score', 'item'], ascending=[False, True]).head(50)
+        assert expected['score'].duplicated().any()
+
+        # ties are broken by item
+        forget_ranked_lists('collocation', [collocation.json['id']])
+        ranking = ranked_list('collocation', collocation.json['id'], 'O11', 50)
+        assert ranking.tolist() == expected['item'].tolist()